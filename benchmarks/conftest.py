@@ -0,0 +1,155 @@
+"""
+Offline benchmarks for the image preparation hot paths.
+
+Run with ``pytest benchmarks`` (requires ``pytest-benchmark``). Each benchmark also records how much one (untimed) call
+raises the process's peak resident set size in its ``extra_info``, which is included in the ``--benchmark-json``
+output. Unlike ``tracemalloc``, this includes memory allocated outside the Python heap (e.g. Pillow's pixel buffers).
+Remote images are served by a local stub server, so no network access is needed. To compare against a baseline::
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+
+import asyncio
+import gc
+from io import BytesIO
+
+import pytest
+from aiohttp import web
+from PIL import Image
+
+from kani import ChatMessage
+from kani.ext.vision import ImagePart, utils
+from kani.ext.vision.cache import encoding_cache
+from kani.ext.vision.engines.openai import OpenAIVisionEngine
+from tests.conftest import WhitespaceTokenizer
+
+SIZES = [(256, 256), (1024, 768), (2048, 2048)]
+FORMATS = ["PNG", "JPEG", "WEBP"]
+HISTORY_LENGTHS = [10, 100, 1000]
+
+
+def make_image(size) -> Image.Image:
+    # noise doesn't compress well, so this is close to the worst case for encoders
+    return Image.effect_noise(size, 64).convert("RGB")
+
+
+def encode(image: Image.Image, fmt: str) -> bytes:
+    io = BytesIO()
+    image.save(io, format=fmt)
+    return io.getvalue()
+
+
+def make_history(n: int, image_every: int = 5) -> list[ChatMessage]:
+    """A synthetic chat history of *n* messages, where every *image_every*-th user message contains a small image."""
+    messages = []
+    for idx in range(n):
+        if idx % 2:
+            messages.append(ChatMessage.assistant(f"This is response number {idx}. " * 4))
+        elif idx // 2 % image_every == 0:
+            image = Image.new("RGB", (64 + idx % 512, 64), (idx % 256, 0, 0))
+            messages.append(ChatMessage.user([f"What is in image {idx}?", ImagePart.from_image(image)]))
+        else:
+            messages.append(ChatMessage.user(f"This is question number {idx}. " * 4))
+    return messages
+
+
+@pytest.fixture(autouse=True)
+def cold_encoding_cache():
+    """Disable the process-wide encoding cache so that benchmarks measure the cost of encoding each time."""
+    max_bytes = encoding_cache.max_bytes
+    encoding_cache.max_bytes = 0
+    encoding_cache.cache_clear()
+    yield
+    encoding_cache.max_bytes = max_bytes
+
+
+@pytest.fixture
+def offline_engine(monkeypatch):
+    """Create OpenAIVisionEngines that count tokens by whitespace rather than with tiktoken."""
+    monkeypatch.setattr(
+        OpenAIVisionEngine, "_load_tokenizer", lambda self: setattr(self, "tokenizer", WhitespaceTokenizer())
+    )
+    return lambda **kwargs: OpenAIVisionEngine("sk-test", **kwargs)
+
+
+def _proc_status(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def peak_rss_increase(fn, *args) -> int | None:
+    """Call *fn* and return how much it raised the peak resident set size of this process, in bytes.
+
+    This resets the kernel's RSS high-water mark before the call, so it is only supported on Linux; returns None
+    elsewhere. Memory that the allocator reuses from earlier (freed) allocations is not counted, but large buffers (like
+    decoded images) are allocated fresh.
+    """
+    gc.collect()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        before = _proc_status("VmRSS")
+    except OSError:
+        return None
+    fn(*args)
+    return max(_proc_status("VmHWM") - before, 0)
+
+
+@pytest.fixture
+def measure(benchmark):
+    """Benchmark a function, and record how much one call raises the peak RSS as ``extra_info["peak_rss_bytes"]`` (see
+    :func:`peak_rss_increase`).
+
+    If *setup* is given, it is called before each call to create the function's arguments (untimed), so that each call
+    starts from a cold state.
+    """
+
+    def run(fn, setup=None, rounds: int = 10):
+        args = setup() if setup is not None else ()
+        benchmark.extra_info["peak_rss_bytes"] = peak_rss_increase(fn, *args)
+        if setup is None:
+            return benchmark(fn)
+        return benchmark.pedantic(fn, setup=lambda: (setup(), {}), rounds=rounds)
+
+    return run
+
+
+@pytest.fixture
+def loop():
+    """An event loop for running async code inside (synchronous) benchmarks."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.run_until_complete(utils.close_http_session())
+    loop.close()
+
+
+@pytest.fixture
+def stub_server(loop):
+    """A local HTTP server (with range request support) serving a PNG of each size at ``/<width>x<height>.png``."""
+    images = {f"/{w}x{h}.png": encode(make_image((w, h)), "PNG") for w, h in SIZES}
+
+    async def image(request):
+        data = images[request.path]
+        if request.http_range.start is None:
+            return web.Response(body=data, content_type="image/png")
+        start, stop = request.http_range.start, min(request.http_range.stop, len(data))
+        return web.Response(
+            status=206,
+            body=data[start:stop],
+            content_type="image/png",
+            headers={"Content-Range": f"bytes {start}-{stop - 1}/{len(data)}"},
+        )
+
+    app = web.Application()
+    for path in images:
+        app.router.add_get(path, image)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    yield f"http://127.0.0.1:{runner.addresses[0][1]}"
+    loop.run_until_complete(runner.cleanup())
@@ -0,0 +1,39 @@
+import pytest
+
+from .conftest import HISTORY_LENGTHS, make_history
+
+
+@pytest.mark.parametrize("n", HISTORY_LENGTHS)
+def test_message_len(measure, offline_engine, n):
+    """Counting the tokens of every message in a history, with a cold cache."""
+    history = make_history(n)
+    measure(lambda engine: [engine.message_len(m) for m in history], setup=lambda: (offline_engine(),))
+
+
+@pytest.mark.parametrize("n", HISTORY_LENGTHS)
+def test_message_len_cached(measure, offline_engine, n):
+    """Counting the tokens of every message in a history again (e.g. in the next chat round)."""
+    engine = offline_engine()
+    history = make_history(n)
+    measure(lambda: [engine.message_len(m) for m in history])
+
+
+@pytest.mark.parametrize("n", HISTORY_LENGTHS)
+def test_translate_messages(measure, offline_engine, n):
+    """Translating a history into OpenAI's format, with a cold cache."""
+    measure(
+        lambda engine, history: engine.translate_messages(history),
+        setup=lambda: (offline_engine(), make_history(n)),
+        rounds=5,
+    )
+
+
+@pytest.mark.parametrize("n", HISTORY_LENGTHS)
+def test_prepare_and_translate(measure, loop, offline_engine, n):
+    """Preparing (resizing and encoding) the images in a history and translating it, as in predict()."""
+
+    def prepare_and_translate(engine, history):
+        messages = loop.run_until_complete(engine.aprepare_messages(history))
+        return engine.translate_messages(messages)
+
+    measure(prepare_and_translate, setup=lambda: (offline_engine(resize_images=True), make_history(n)), rounds=5)
@@ -0,0 +1,60 @@
+import pytest
+
+from kani.ext.vision import ImagePart
+from kani.ext.vision.cli import parts_from_cli_query
+from .conftest import FORMATS, SIZES, encode, make_image
+
+
+@pytest.mark.parametrize("size", SIZES, ids=lambda s: f"{s[0]}x{s[1]}")
+def test_pillow_bytes(measure, size):
+    """Encoding a Pillow image to PNG."""
+    image = make_image(size)
+    measure(lambda part: part.bytes, setup=lambda: (ImagePart.from_image(image),), rounds=5)
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("size", SIZES, ids=lambda s: f"{s[0]}x{s[1]}")
+def test_b64_uri(measure, size, fmt):
+    """Base64-encoding an image's binary data into a data URI."""
+    data = encode(make_image(size), fmt)
+    measure(lambda part: part.b64_uri, setup=lambda: (ImagePart.from_bytes(data),))
+
+
+@pytest.mark.parametrize("size", SIZES, ids=lambda s: f"{s[0]}x{s[1]}")
+def test_iter_b64_uri(measure, size):
+    """Streaming an image's data URI in chunks."""
+    data = encode(make_image(size), "PNG")
+    measure(lambda part: sum(map(len, part.iter_b64_uri())), setup=lambda: (ImagePart.from_bytes(data),))
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("size", SIZES, ids=lambda s: f"{s[0]}x{s[1]}")
+def test_file_metadata(measure, tmp_path, size, fmt):
+    """Reading the size and MIME type of an image file."""
+    fp = tmp_path / f"image.{fmt.lower()}"
+    fp.write_bytes(encode(make_image(size), fmt))
+    measure(lambda: (part := ImagePart.from_path(fp)).size and part.mime)
+
+
+@pytest.mark.parametrize("size", SIZES, ids=lambda s: f"{s[0]}x{s[1]}")
+def test_from_url_remote(measure, loop, stub_server, size):
+    """Reading the metadata of a remote image (with range requests)."""
+    url = f"{stub_server}/{size[0]}x{size[1]}.png"
+    measure(lambda: loop.run_until_complete(ImagePart.from_url(url, remote=True)))
+
+
+@pytest.mark.parametrize("size", SIZES, ids=lambda s: f"{s[0]}x{s[1]}")
+def test_from_url_download(measure, loop, stub_server, size):
+    """Downloading a remote image."""
+    url = f"{stub_server}/{size[0]}x{size[1]}.png"
+    measure(lambda: loop.run_until_complete(ImagePart.from_url(url, remote=False)))
+
+
+@pytest.mark.parametrize("n_images", [0, 1, 10])
+def test_parts_from_cli_query(measure, loop, tmp_path, n_images):
+    """Parsing a CLI query with image paths in it."""
+    fp = tmp_path / "image.png"
+    fp.write_bytes(encode(make_image((64, 64)), "PNG"))
+    query = "Describe these images, and compare them to each other in detail. " * 5
+    query += " ".join(f"!{fp} and" for _ in range(n_images))
+    measure(lambda: loop.run_until_complete(parts_from_cli_query(query)))
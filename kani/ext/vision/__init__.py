@@ -1,2 +1,3 @@
 from .cli import chat_in_terminal_vision, chat_in_terminal_vision_async
+from .kani import VisionKani
 from .parts import ImagePart
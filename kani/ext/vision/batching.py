@@ -0,0 +1,71 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class BatchScheduler(Generic[T, R]):
+    """Collects concurrent requests into batches so that they can be processed together (e.g. in one forward pass).
+
+    When a request is submitted, the scheduler waits up to *window* seconds for more requests with the same *key*
+    before processing the batch, or until *max_batch_size* requests have been collected. Batches are processed one at
+    a time, so requests submitted while a batch is being processed are collected into the next batch.
+    """
+
+    def __init__(
+        self, process_batch: Callable[[list[T]], Awaitable[list[R]]], max_batch_size: int = 8, window: float = 0.01
+    ):
+        """
+        :param process_batch: An async function that takes a list of requests and returns a list of results, in the
+            same order.
+        :param max_batch_size: The maximum number of requests to process at once.
+        :param window: How long to wait for more requests before processing a batch, in seconds.
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._pending: dict[Hashable, list[tuple[T, asyncio.Future]]] = {}
+        self._timers: dict[Hashable, asyncio.TimerHandle] = {}
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def submit(self, request: T, key: Hashable = None) -> R:
+        """Submit a request to be processed in the next batch with the same *key*, and wait for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((request, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key: Hashable):
+        if timer := self._timers.pop(key, None):
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch))
+        # keep a reference to the task so it doesn't get garbage collected
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[T, asyncio.Future]]):
+        async with self._lock:
+            # skip any requests that were cancelled while waiting
+            batch = [(request, future) for request, future in batch if not future.done()]
+            if not batch:
+                return
+            try:
+                results = await self.process_batch([request for request, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
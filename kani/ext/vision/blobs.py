@@ -0,0 +1,207 @@
+"""
+Content-addressed storage for image data, used to save chat histories containing images compactly.
+
+When a chat history is saved with a blob store (see :meth:`.VisionKani.save`), each image's data is written to the
+store once, and the saved messages reference it by content hash (see :class:`~kani.ext.vision.parts.BlobImagePart`)
+and by the store's location relative to the saved file, so the two can be moved together. Loading the history does not
+read any image data; it is memory-mapped from the store the first time it is needed.
+"""
+
+import abc
+import contextlib
+import contextvars
+import hashlib
+import mmap
+import os
+import pathlib
+import tempfile
+import threading
+
+from kani.utils.typing import PathLike
+
+
+def blob_key(data: bytes | memoryview) -> str:
+    """Get the key that the given data is stored under. This is the same as :attr:`.ImagePart.content_hash` for image
+    parts backed by binary data.
+    """
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class BlobStore(abc.ABC):
+    """Base class for a content-addressed store of binary data."""
+
+    location: str
+    """The absolute path to the store. Saved messages use this to find the store again (see :func:`open_blob_store`)."""
+
+    @abc.abstractmethod
+    def put(self, data: bytes | memoryview) -> str:
+        """Store the given data, if it is not stored already, and return its key."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, key: str) -> memoryview:
+        """Get a read-only, memory-mapped view of the data stored under the given key.
+
+        :raises KeyError: if the key is not in this store.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __contains__(self, key: str) -> bool:
+        raise NotImplementedError
+
+
+class DirectoryBlobStore(BlobStore):
+    """Stores each blob as a file in a directory, named by its key.
+
+    .. code-block:: python
+
+        store = DirectoryBlobStore("chats/images")
+    """
+
+    def __init__(self, directory: PathLike):
+        """
+        :param directory: The directory to store blobs in. It will be created when the first blob is stored, if it does
+            not exist.
+        """
+        self.directory = pathlib.Path(directory).expanduser().absolute()
+        self.location = str(self.directory)
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / key[:2] / key[2:]
+
+    def put(self, data: bytes | memoryview) -> str:
+        key = blob_key(data)
+        fp = self._path(key)
+        if fp.exists():
+            return key
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temp file first so that a partially written blob is never visible
+        with tempfile.NamedTemporaryFile(dir=fp.parent, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, fp)
+        return key
+
+    def get(self, key: str) -> memoryview:
+        try:
+            with open(self._path(key), "rb") as f:
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+
+class PackedBlobStore(BlobStore):
+    """Stores all blobs in a single append-only pack file, with an index file alongside it (``<path>.idx``).
+
+    This keeps the number of files small when storing many images, and the whole pack is memory-mapped at once.
+
+    .. code-block:: python
+
+        store = PackedBlobStore("chats/images.pack")
+    """
+
+    def __init__(self, path: PathLike):
+        """
+        :param path: The path to the pack file. It will be created when the first blob is stored, if it does not exist.
+        """
+        self.path = pathlib.Path(path).expanduser().absolute()
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        self.location = str(self.path)
+        # key -> (offset, length)
+        self._index: dict[str, tuple[int, int]] = {}
+        self._mmap: mmap.mmap | None = None
+        self._lock = threading.Lock()
+        self._read_index()
+
+    def _read_index(self):
+        if not self.index_path.exists():
+            return
+        with open(self.index_path) as f:
+            for line in f:
+                key, offset, length = line.split()
+                self._index[key] = (int(offset), int(length))
+
+    def put(self, data: bytes | memoryview) -> str:
+        key = blob_key(data)
+        with self._lock:
+            if key in self._index:
+                return key
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+            # the index is only written after the data, so an interrupted write leaves no dangling entry
+            with open(self.index_path, "a") as f:
+                f.write(f"{key} {offset} {len(data)}\n")
+            self._index[key] = (offset, len(data))
+        return key
+
+    def get(self, key: str) -> memoryview:
+        with self._lock:
+            # the blob may have been added by another process (or another store object) since the index was read
+            if key not in self._index:
+                self._read_index()
+            offset, length = self._index[key]
+            # remap if the pack has grown past the current map
+            if self._mmap is None or len(self._mmap) < offset + length:
+                with open(self.path, "rb") as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._mmap)[offset : offset + length]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+
+_resolution = contextvars.ContextVar("_resolution", default=(None, None))
+
+_open_stores: dict[str, BlobStore] = {}
+_open_stores_lock = threading.Lock()
+
+
+def open_blob_store(location: PathLike) -> BlobStore:
+    """Get the blob store at the given location: a :class:`DirectoryBlobStore` if it is a directory, or a
+    :class:`PackedBlobStore` otherwise. Each store is only opened once per process.
+    """
+    location = str(pathlib.Path(location).expanduser().absolute())
+    with _open_stores_lock:
+        if location not in _open_stores:
+            if os.path.isdir(location):
+                _open_stores[location] = DirectoryBlobStore(location)
+            else:
+                _open_stores[location] = PackedBlobStore(location)
+        return _open_stores[location]
+
+
+def relative_location(store: BlobStore, directory: PathLike) -> str:
+    """Get the location of the given store relative to a directory (e.g. the one a chat history is saved in), or its
+    absolute location if there is no relative path (e.g. on another drive).
+    """
+    try:
+        return pathlib.Path(os.path.relpath(store.location, directory)).as_posix()
+    except ValueError:
+        return store.location
+
+
+@contextlib.contextmanager
+def resolving_blob_stores(relative_to: PathLike | None = None, store: BlobStore | None = None):
+    """Within this context manager, store locations passed to :func:`resolve_location` (e.g. by the
+    :class:`~kani.ext.vision.parts.BlobImagePart` in a chat history being loaded) are resolved relative to the given
+    directory, or replaced by the given store's location.
+    """
+    token = _resolution.set((relative_to, store))
+    try:
+        yield
+    finally:
+        _resolution.reset(token)
+
+
+def resolve_location(location: str) -> str:
+    """Resolve a store location in the current :func:`resolving_blob_stores` context."""
+    relative_to, store = _resolution.get()
+    if store is not None:
+        return store.location
+    if relative_to is not None:
+        return str((pathlib.Path(relative_to) / location).absolute())
+    return location
@@ -0,0 +1,167 @@
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+from typing import Any, Callable, Hashable
+
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions currsize nbytes maxsize max_bytes")
+
+_missing = object()
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache, bounded by number of entries and/or total size in bytes.
+
+    Like :func:`functools.lru_cache`, use :meth:`cache_info` to get the hit/miss statistics of the cache.
+    """
+
+    def __init__(self, maxsize: int | None = None, max_bytes: int | None = None):
+        """
+        :param maxsize: The maximum number of entries to keep (default unbounded).
+        :param max_bytes: The maximum total size of the entries to keep, in bytes (default unbounded). The size of each
+            entry is passed to :meth:`set`. Set to 0 to disable the cache.
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether this cache will store any entries."""
+        return self.maxsize != 0 and self.max_bytes != 0
+
+    def get(self, key: Hashable, default=None):
+        """Get the value stored at the given key and mark it as recently used, or *default* if it is not cached."""
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value, nbytes: int = 0):
+        """Store a value at the given key, evicting the least recently used entries if the cache is over its limits.
+
+        :param nbytes: The size of the value, in bytes, for the purposes of the byte budget.
+        """
+        if not self.enabled or (self.max_bytes is not None and nbytes > self.max_bytes):
+            return
+        with self._lock:
+            if key in self._data:
+                self._nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any], sizeof: Callable[[Any], int] = len):
+        """Get the value stored at the given key, or compute and store it if it is not cached.
+
+        :param compute: A function that takes no arguments and returns the value to cache.
+        :param sizeof: A function that returns the size of the computed value, in bytes (default ``len``).
+        """
+        if not self.enabled:
+            return compute()
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = compute()
+            self.set(key, value, sizeof(value))
+        return value
+
+    def pop(self, key: Hashable, default=None):
+        """Remove the given key from the cache and return its value, or *default* if it is not cached."""
+        with self._lock:
+            try:
+                value, nbytes = self._data.pop(key)
+            except KeyError:
+                return default
+            self._nbytes -= nbytes
+            return value
+
+    def keys(self) -> list[Hashable]:
+        """Get a list of the cached keys, from least to most recently used."""
+        with self._lock:
+            return list(self._data)
+
+    def cache_info(self) -> CacheInfo:
+        """Report cache statistics."""
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.evictions, len(self._data), self._nbytes, self.maxsize, self.max_bytes
+            )
+
+    def cache_clear(self):
+        """Clear the cache and its statistics."""
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _evict(self):
+        while self._data and (
+            (self.maxsize is not None and len(self._data) > self.maxsize)
+            or (self.max_bytes is not None and self._nbytes > self.max_bytes)
+        ):
+            _, (_, nbytes) = self._data.popitem(last=False)
+            self._nbytes -= nbytes
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class IdentityLRUCache(LRUCache):
+    """An :class:`LRUCache` keyed on the identity of objects rather than their value.
+
+    This is useful for caching values derived from immutable objects that are expensive (or impossible) to hash, like
+    chat messages containing images. Keys are held by weak reference, so an entry is dropped as soon as its key is
+    garbage collected rather than keeping old conversations alive. Keys that don't support weak references are kept
+    alive while they are in the cache, so their ids cannot be reused.
+    """
+
+    def get(self, key, default=None):
+        entry = super().get(id(key), _missing)
+        if entry is _missing:
+            return default
+        return entry[1]
+
+    def set(self, key, value, nbytes: int = 0):
+        key_id = id(key)
+        try:
+            ref = weakref.ref(key, lambda r: self._discard(key_id, r))
+        except TypeError:
+            ref = key
+        super().set(key_id, (ref, value), nbytes)
+
+    def pop(self, key, default=None):
+        entry = super().pop(id(key), _missing)
+        if entry is _missing:
+            return default
+        return entry[1]
+
+    def _discard(self, key_id: int, ref: weakref.ref):
+        with self._lock:
+            entry = self._data.get(key_id)
+            if entry is not None and entry[0][0] is ref:
+                self._nbytes -= self._data.pop(key_id)[1]
+
+    def __contains__(self, key):
+        return id(key) in self._data
+
+
+encoding_cache = LRUCache(max_bytes=128 * 1024 * 1024)
+"""The process-wide cache of encoded image data (PNG bytes and base64 strings), keyed by each image's content hash.
+
+This allows images that are constructed multiple times (e.g. loading the same file in different chat sessions) to be
+encoded only once. By default, this cache holds up to 128MiB; set ``encoding_cache.max_bytes`` to change this budget
+(0 to disable).
+"""
@@ -8,7 +8,7 @@ import shutil
 import sys
 import warnings
 
-from kani import Kani
+from kani import ChatRole, Kani
 from kani.models import MessagePartType
 from kani.utils.message_formatters import assistant_message_contents_thinking
 from .parts import ImagePart
@@ -34,6 +34,7 @@ BANG_IMAGE_RE = re.compile(
 async def parts_from_cli_query(query: str) -> list[MessagePartType]:
     """Parse a string with paths to images prepended by ``!`` into the right messageparts."""
     query_parts = []
+    url_indices = []  # (index in query_parts, url) of each url, to download them all at once
     last_idx = 0
     for image_match in BANG_IMAGE_RE.finditer(query):
         # push everything between the end of the last path and the start of this one to the parts
@@ -58,9 +59,15 @@ async def parts_from_cli_query(query: str) -> list[MessagePartType]:
                 query_parts.append(ImagePart.from_path(fp))
         # if a url:
         else:
-            # download the image to a named temp file and return that path
-            url = image_match["url"]
-            query_parts.append(await ImagePart.from_url(url, remote=False))
+            # save a spot for the image and download it later
+            url_indices.append((len(query_parts), image_match["url"]))
+            query_parts.append(None)
+
+    # download all the images concurrently and put them in their spots
+    if url_indices:
+        images = await ImagePart.from_urls([url for _, url in url_indices], remote=False)
+        for (idx, _), image in zip(url_indices, images):
+            query_parts[idx] = image
 
     # and make sure the rest of the query is in the parts
     query_parts.append(query[last_idx:])
@@ -96,8 +103,32 @@ def print_parts_ascii(parts: list[MessagePartType]):
     print()
 
 
+async def print_round_stream(kani: Kani, query_parts: list[MessagePartType]):
+    """Run a full chat round, printing the assistant's messages as they are generated.
+
+    Requires a version of kani that supports streaming (v1.0+). Engines that do not implement streaming print each
+    message once it is complete.
+    """
+    async for stream in kani.full_round_stream(query_parts):
+        if stream.role != ChatRole.ASSISTANT:
+            await stream.message()
+            continue
+        print("AI: ", end="", flush=True)
+        streamed = False
+        async for token in stream:
+            print(token, end="", flush=True)
+            streamed = True
+        msg = await stream.message()
+        # show any function calls (or the whole message, if nothing was streamed)
+        if not streamed:
+            print(assistant_message_contents_thinking(msg), end="")
+        elif msg.tool_calls:
+            print(f"Thinking... [{'; '.join(tc.function.name for tc in msg.tool_calls)}]", end="")
+        print()
+
+
 # ==== entrypoints ====
-async def chat_in_terminal_vision_async(kani: Kani, rounds: int = 0, stopword: str = None):
+async def chat_in_terminal_vision_async(kani: Kani, rounds: int = 0, stopword: str = None, stream: bool = True):
     """Async version of :func:`.chat_in_terminal_vision`.
     Use in environments when there is already an asyncio loop running (e.g. Google Colab).
     """
@@ -126,6 +157,9 @@ async def chat_in_terminal_vision_async(kani: Kani, rounds: int = 0, stopword: s
                 print_parts_ascii(query_parts)
 
             # and pass on to model
+            if stream and hasattr(kani, "full_round_stream"):
+                await print_round_stream(kani, query_parts)
+                continue
             async for msg in kani.full_round_str(query_parts, message_formatter=assistant_message_contents_thinking):
                 print(f"AI: {msg}")
     except KeyboardInterrupt:
@@ -134,7 +168,7 @@ async def chat_in_terminal_vision_async(kani: Kani, rounds: int = 0, stopword: s
         await kani.engine.close()
 
 
-def chat_in_terminal_vision(kani: Kani, rounds: int = 0, stopword: str = None):
+def chat_in_terminal_vision(kani: Kani, rounds: int = 0, stopword: str = None, stream: bool = True):
     """Chat with a vision-enabled kani right in your terminal.
 
     To provide an image to the vision kani, prepend a filepath or URL with a ``!``
@@ -151,6 +185,8 @@ def chat_in_terminal_vision(kani: Kani, rounds: int = 0, stopword: str = None):
 
     :param rounds: The number of chat rounds to play (defaults to 0 for infinite).
     :param stopword: Break out of the chat loop if the user sends this message.
+    :param stream: Whether to print the model's responses as they are generated (requires kani v1.0+; ignored
+        otherwise).
     """
     try:
         asyncio.get_running_loop()
@@ -169,4 +205,4 @@ def chat_in_terminal_vision(kani: Kani, rounds: int = 0, stopword: str = None):
                 f" should use `await chat_in_terminal_vision_async(...)` instead or install `nest-asyncio`."
             )
             return
-    asyncio.run(chat_in_terminal_vision_async(kani, rounds=rounds, stopword=stopword))
+    asyncio.run(chat_in_terminal_vision_async(kani, rounds=rounds, stopword=stopword, stream=stream))
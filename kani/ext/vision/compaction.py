@@ -0,0 +1,99 @@
+"""
+Steps that make the images in a chat history cheaper when it does not fit in the context window.
+
+:class:`.VisionKani` applies each step to the oldest messages first, and moves on to the next (more destructive) step
+only if the history still does not fit. Only once every step has been applied are whole messages dropped.
+"""
+
+import abc
+import asyncio
+
+from PIL import Image
+
+from kani import ChatMessage
+from kani.engines.base import BaseEngine
+from kani.models import MessagePartType
+from .cache import LRUCache
+from .parts import ImagePart, RemoteURLImagePart
+
+DEFAULT_CAPTION_PROMPT = "Describe this image in one or two sentences. Include any text it contains."
+
+
+class ImageCompactor(abc.ABC):
+    """Base class for a step of image compaction, which replaces an image with a cheaper version of itself.
+
+    To implement your own compaction step, subclass this and implement :meth:`compact`.
+    """
+
+    @abc.abstractmethod
+    async def compact(self, part: ImagePart) -> MessagePartType:
+        """Return a cheaper replacement for the given image (e.g. another image or a string), or the image itself if
+        this step cannot make it any cheaper.
+        """
+        raise NotImplementedError
+
+
+class LowDetail(ImageCompactor):
+    """Send the image in low detail mode (see :attr:`.ImagePart.detail`).
+
+    This only saves tokens on engines that support image detail levels (e.g. the
+    :class:`~kani.ext.vision.engines.openai.OpenAIVisionEngine`).
+    """
+
+    async def compact(self, part: ImagePart) -> MessagePartType:
+        if part.detail == "low":
+            return part
+        return part.copy_with(detail="low")
+
+
+class Downscale(ImageCompactor):
+    """Downscale the image so that its longest side is at most *max_side* pixels.
+
+    This saves tokens on engines whose image cost depends on resolution (e.g. the
+    :class:`~kani.ext.vision.engines.openai.OpenAIVisionEngine` in high detail mode), and upload bytes on all engines.
+    Remote images are left as-is, since their data isn't available to downscale.
+    """
+
+    def __init__(self, max_side: int = 512):
+        self.max_side = max_side
+
+    async def compact(self, part: ImagePart) -> MessagePartType:
+        if isinstance(part, RemoteURLImagePart) or max(part.size) <= self.max_side:
+            return part
+        image = await part.aimage()
+        return ImagePart.from_image(await asyncio.to_thread(self._downscale, image), detail=part.detail)
+
+    def _downscale(self, image: Image.Image) -> Image.Image:
+        image = image.copy()
+        image.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+        return image
+
+
+class Caption(ImageCompactor):
+    """Replace the image with a text caption generated by the given engine.
+
+    Captions are cached by image content, so each image is only captioned once. This saves tokens on all engines, but
+    the model can no longer see the image.
+    """
+
+    def __init__(self, engine: BaseEngine, prompt: str = DEFAULT_CAPTION_PROMPT, cache_size: int = 1024):
+        """
+        :param engine: The engine to generate captions with. It must support images.
+        :param prompt: The prompt to send with each image.
+        :param cache_size: The number of captions to keep in memory.
+        """
+        self.engine = engine
+        self.prompt = prompt
+        self.cache = LRUCache(maxsize=cache_size)
+
+    async def compact(self, part: ImagePart) -> MessagePartType:
+        caption = self.cache.get(part.content_hash)
+        if caption is None:
+            caption = await self.caption(part)
+            self.cache.set(part.content_hash, caption)
+        return f"[image: {caption}]"
+
+    async def caption(self, part: ImagePart) -> str:
+        """Generate a caption for the given image. Override this to customize how captions are generated."""
+        completion = await self.engine.predict([ChatMessage.user([self.prompt, part])])
+        return completion.message.text.strip()
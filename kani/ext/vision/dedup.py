@@ -0,0 +1,96 @@
+"""
+Collapse repeated images in a chat history into textual back-references.
+
+Users often send the same image more than once (e.g. re-pasting a screenshot), and function results may attach an image
+that is already in the conversation. Each repeat costs the full image's upload size, tokens, and encoding time, so
+:func:`dedupe_images` replaces every image that repeats an earlier one with a short text part instead.
+"""
+
+from PIL import Image
+
+from kani import ChatMessage
+from .cache import IdentityLRUCache, LRUCache
+from .parts import ImagePart
+
+DUPLICATE_IMAGE_TEXT = "[image: identical to an image shown earlier]"
+"""The text that replaces an image that exactly repeats an earlier one."""
+
+NEAR_DUPLICATE_IMAGE_TEXT = "[image: nearly identical to an image shown earlier]"
+"""The text that replaces an image that is perceptually similar to an earlier one."""
+
+perceptual_hash_cache = LRUCache(maxsize=4096)
+"""The perceptual hash of recently seen images, keyed by content hash."""
+
+# keep the same deduplicated copy of each message across rounds so that token counts and translations stay cached
+_deduped_messages = IdentityLRUCache(maxsize=1024)
+
+
+def perceptual_hash(part: ImagePart) -> int:
+    """Get the 64-bit difference hash (dHash) of the given image.
+
+    Images that look alike (e.g. the same screenshot at a different size or compression level) have hashes that differ
+    in only a few bits.
+    """
+
+    def compute():
+        pixels = list(part.image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+        bits = 0
+        for row in range(8):
+            for col in range(8):
+                bits = (bits << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+        return bits
+
+    return perceptual_hash_cache.get_or_compute(part.content_hash, compute, sizeof=lambda _: 0)
+
+
+def dedupe_images(messages: list[ChatMessage], near_duplicate_threshold: int | None = None) -> list[ChatMessage]:
+    """Replace every image that repeats an earlier image in *messages* with a text back-reference.
+
+    The first occurrence of each image is kept as-is, so the beginning of the prompt does not change as the
+    conversation grows. Messages without any repeated images are returned unchanged.
+
+    :param messages: The messages to deduplicate, oldest first.
+    :param near_duplicate_threshold: If set, also replace images whose :func:`perceptual_hash` differs from an earlier
+        image's in at most this many bits (out of 64). Small values (e.g. 4) catch resized or recompressed copies of an
+        image; by default, only exact copies are replaced.
+    :returns: A new list of messages.
+    """
+    seen = set()
+    seen_perceptual = []
+    result = []
+    for message in messages:
+        if isinstance(message.content, str) or message.content is None:
+            result.append(message)
+            continue
+        # the index and replacement text of each image that repeats an earlier one
+        refs = []
+        for idx, part in enumerate(message.parts):
+            if not isinstance(part, ImagePart):
+                continue
+            if part.content_hash in seen:
+                refs.append((idx, DUPLICATE_IMAGE_TEXT))
+                continue
+            seen.add(part.content_hash)
+            if near_duplicate_threshold is not None:
+                phash = perceptual_hash(part)
+                if any((phash ^ other).bit_count() <= near_duplicate_threshold for other in seen_perceptual):
+                    refs.append((idx, NEAR_DUPLICATE_IMAGE_TEXT))
+                    continue
+                seen_perceptual.append(phash)
+        result.append(_with_back_references(message, tuple(refs)))
+    return result
+
+
+def _with_back_references(message: ChatMessage, refs: tuple[tuple[int, str], ...]) -> ChatMessage:
+    if not refs:
+        return message
+    copies = _deduped_messages.get(message)
+    if copies is None:
+        copies = {}
+        _deduped_messages.set(message, copies)
+    if refs not in copies:
+        parts = message.parts.copy()
+        for idx, text in refs:
+            parts[idx] = text
+        copies[refs] = message.copy_with(parts=parts)
+    return copies[refs]
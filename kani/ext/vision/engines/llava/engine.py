@@ -1,8 +1,18 @@
+import asyncio
+import copy
+from concurrent.futures import Executor
+from typing import AsyncIterable
+
+from PIL import Image
+
 from kani import AIFunction, ChatMessage
 from kani.engines.base import Completion
 from kani.engines.huggingface.vicuna import VicunaEngine
 from kani.exceptions import MissingModelDependencies
+from ...batching import BatchScheduler
+from ...cache import LRUCache
 from ...parts import ImagePart
+from ...utils import release_http_session, use_http_session
 
 try:
     import sentencepiece
@@ -16,6 +26,16 @@ try:
     )
     from llava.mm_utils import process_images, tokenizer_image_token
     from torch import tensor
+    from transformers import (
+        DynamicCache,
+        GenerationConfig,
+        LogitsProcessorList,
+        RepetitionPenaltyLogitsProcessor,
+        TemperatureLogitsWarper,
+        TextStreamer,
+        TopKLogitsWarper,
+        TopPLogitsWarper,
+    )
 except ImportError as e:
     raise MissingModelDependencies(
         "The LlavaEngine requires extra dependencies. Please see the kani-vision installation documentation for"
@@ -43,6 +63,45 @@ class LlavaEngine(VicunaEngine):
     By default, the HuggingEngine loads the model on GPU if CUDA is detected on your system. To override the device
     the model is loaded on, pass ``device="cpu|cuda"`` to the constructor.
 
+    **Image Loading**
+
+    Images are decoded and preprocessed in a thread pool so that they do not block the event loop. Pass an
+    ``image_executor`` to control where images are decoded.
+
+    **Image Caching**
+
+    The preprocessed pixel values of each image are cached in memory (see :attr:`image_cache`), so each image is only
+    decoded and preprocessed once even though the whole chat history is sent each round.
+
+    The vision tower's features of each image are only cached when completions are generated by
+    :meth:`generate_batch`, i.e. with ``max_batch_size`` greater than 1 or a nonzero ``kv_cache_bytes`` (see the note
+    below). LLaVA's ``generate()``, which is used by default, runs the vision tower on every image in the chat history
+    each round. To encode each image only once, pass e.g. ``kv_cache_bytes=2 * 1024**3``.
+
+    **KV Caching**
+
+    Pass ``kv_cache_bytes`` to keep the attention keys and values of each generated sequence in memory (see
+    :attr:`kv_cache`). When the next round of a conversation extends a previous sequence, only the new messages are run
+    through the model, which greatly reduces the time to first token for long conversations. If the chat history was
+    edited or trimmed, only the unchanged prefix is reused.
+
+    **Streaming**
+
+    :meth:`stream` yields the completion's text as it is generated, which greatly reduces the perceived latency of
+    long responses. Streaming requires a version of kani that supports streaming engines (v1.0+).
+
+    **Batching**
+
+    By default, concurrent requests (e.g. from multiple chat sessions sharing one engine) are generated one at a time.
+    Pass ``max_batch_size`` to generate completions for up to that many concurrent requests at once, which uses the
+    hardware much more efficiently. Requests that arrive within ``batch_window`` seconds of each other are batched.
+
+    .. note::
+        By default, completions are generated with LLaVA's ``generate()``. With batching or KV caching enabled, they
+        are generated by :meth:`generate_batch` instead, which only supports the generation parameters
+        ``max_new_tokens``, ``max_length``, ``do_sample``, ``temperature``, ``top_k``, ``top_p``, and
+        ``repetition_penalty``.
+
     .. seealso:: https://github.com/haotian-liu/LLaVA/tree/main
 
     .. code-block:: python
@@ -57,6 +116,11 @@ class LlavaEngine(VicunaEngine):
         model_id: str = "liuhaotian/llava-v1.5-7b",
         *args,
         model_load_kwargs: dict = None,
+        image_executor: Executor | None = None,
+        max_batch_size: int = 1,
+        batch_window: float = 0.01,
+        image_cache_bytes: int = 512 * 1024 * 1024,
+        kv_cache_bytes: int = 0,
         **kwargs,
     ):
         """
@@ -65,6 +129,12 @@ class LlavaEngine(VicunaEngine):
         :param device: The hardware device to use. If not specified, uses CUDA if available; otherwise uses CPU.
         :param tokenizer_kwargs: Additional arguments to pass to ``AutoTokenizer.from_pretrained()``.
         :param model_load_kwargs: Additional arguments to pass to ``AutoModelForCausalLM.from_pretrained()``.
+        :param image_executor: The executor to decode images in (default the event loop's default thread pool).
+        :param max_batch_size: The maximum number of concurrent requests to generate completions for at once.
+        :param batch_window: How long to wait for concurrent requests to batch together, in seconds.
+        :param image_cache_bytes: The memory budget of the :attr:`image_cache`, in bytes (0 to disable). Vision tower
+            features are only cached if *max_batch_size* is greater than 1 or *kv_cache_bytes* is set.
+        :param kv_cache_bytes: The memory budget of the :attr:`kv_cache`, in bytes (default 0, disabled).
         :param hyperparams: Additional arguments to supply the model during generation.
         """
         # model kwargs
@@ -73,6 +143,24 @@ class LlavaEngine(VicunaEngine):
         model_load_kwargs.setdefault("torch_dtype", torch.float16)
         model_load_kwargs.setdefault("device_map", "auto")
         super().__init__(model_id, *args, model_load_kwargs=model_load_kwargs, **kwargs)
+        self.image_executor = image_executor
+        # keep the shared connection pool open until every engine using it is closed
+        use_http_session(self)
+        self.image_cache = LRUCache(max_bytes=image_cache_bytes)
+        """The preprocessed pixel values and vision tower features of images this engine has seen, by content hash.
+
+        Since the vision tower is a large fixed cost per image, this allows images that appear in every round of a
+        conversation (or in multiple conversations) to be encoded only once. Features are only cached (and used) when
+        completions are generated by :meth:`generate_batch`; LLaVA's ``generate()`` only uses the pixel values.
+        """
+        self.kv_cache = LRUCache(max_bytes=kv_cache_bytes)
+        """The attention keys/values of recently generated sequences, keyed by the contents of each position.
+
+        When a prompt extends a cached sequence (e.g. the next round of a conversation), only the new part of the prompt
+        needs to be run through the model.
+        """
+        # with a max batch size of 1, this just makes sure only one generation runs at a time
+        self.batch_scheduler = BatchScheduler(self._predict_batch, max_batch_size=max_batch_size, window=batch_window)
 
         # initialization for base LLaVA from https://github.com/haotian-liu/LLaVA/blob/main/llava/model/builder.py#L128
         # note: these lines (until resize_token_embeddings) are only really used in MPT, but are here for fidelity
@@ -114,8 +202,47 @@ class LlavaEngine(VicunaEngine):
     async def predict(
         self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
     ) -> Completion:
+        request = self._make_request(messages, functions, hyperparams)
+        # only requests with the same generation parameters can be batched together
+        return await self.batch_scheduler.submit(request, key=repr(sorted(request[3].items())))
+
+    async def stream(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> AsyncIterable[str | Completion]:
+        """Yield the text of the completion as it is generated, then the final :class:`.Completion`.
+
+        Generation runs in a background thread and feeds its text to an :class:`asyncio.Queue`, so waiting for text
+        doesn't hold a thread. Streamed requests are batched with concurrent requests just like :meth:`predict`.
+        """
+        streamer = _AsyncTextStreamer(
+            self.tokenizer, asyncio.get_running_loop(), skip_prompt=True, skip_special_tokens=True
+        )
+        request = self._make_request(messages, functions, hyperparams, streamer)
+        completion = asyncio.create_task(self.batch_scheduler.submit(request, key=repr(sorted(request[3].items()))))
+        try:
+            started = False
+            while (text := await streamer.queue.get()) is not None:
+                # match the completion's content, which has leading whitespace stripped
+                if not started:
+                    text = text.lstrip()
+                if text:
+                    started = True
+                    yield text
+            yield await completion
+        finally:
+            completion.cancel()
+            # if the request was cancelled before its batch ran, nothing else will end the streamer
+            streamer.end()
+
+    def _make_request(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None, hyperparams: dict, streamer=None
+    ) -> tuple:
+        """Translate the given messages and extract the images in them for the :attr:`batch_scheduler`.
+
+        Returns a tuple ``(translated_messages, functions, image_parts, hyperparams, streamer)``.
+        """
         # we need to extract all the ImageParts and pass them as a model kwarg
-        images = []
+        image_parts = []
         translated_messages = messages.copy()
         for idx, message in enumerate(translated_messages):
             # skip any simple messages
@@ -128,20 +255,320 @@ class LlavaEngine(VicunaEngine):
                 if isinstance(part, ImagePart):
                     did_translate = True
                     translated_parts[part_idx] = DEFAULT_IMAGE_TOKEN
-                    images.append(part.image)
+                    image_parts.append(part)
             # update the message if we did a translation
             if did_translate:
                 translated_messages[idx] = message.copy_with(parts=translated_parts)
 
-        # turn all the image parts into a tensor
-        image_tensor = process_images(images, self.image_processor, self.model.config)
-        if type(image_tensor) is list:
-            image_tensor = [image.to(self.device, dtype=torch.float16) for image in image_tensor]
+        hyperparams = {**self.hyperparams, **hyperparams}
+        # fail before queueing the request, rather than failing the whole batch it ends up in
+        if self._uses_decoding_loop():
+            _check_generation_params(hyperparams)
+        return translated_messages, functions, image_parts, hyperparams, streamer
+
+    def _uses_decoding_loop(self) -> bool:
+        """Whether requests are generated by :meth:`generate_batch` rather than LLaVA's ``generate()``."""
+        return self.batch_scheduler.max_batch_size > 1 or self.kv_cache.enabled
+
+    async def _predict_batch(self, requests: list[tuple]) -> list[Completion]:
+        streamers = [streamer for *_, streamer in requests]
+        try:
+            await self._load_images([part for _, _, image_parts, _, _ in requests for part in image_parts])
+            if not self._uses_decoding_loop():
+                # batches only ever contain one request here
+                return [await self._generate(*requests[0])]
+            prompts = [
+                (self.build_prompt(messages, functions), image_parts)
+                for messages, functions, image_parts, _, _ in requests
+            ]
+            # all requests in a batch have the same hyperparams
+            hyperparams = requests[0][3]
+            outputs = await asyncio.to_thread(self.generate_batch, prompts, streamers=streamers, **hyperparams)
+        finally:
+            # make sure any streams stop waiting for tokens, even if generation failed
+            for streamer in streamers:
+                if streamer is not None:
+                    streamer.end()
+        completions = []
+        for output, prompt_len in outputs:
+            content = self.tokenizer.decode(output, skip_special_tokens=True).strip()
+            completions.append(
+                Completion(ChatMessage.assistant(content), prompt_tokens=prompt_len, completion_tokens=len(output))
+            )
+        return completions
+
+    async def _generate(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None, image_parts, hyperparams, streamer
+    ) -> Completion:
+        """Generate a single completion with LLaVA's ``generate()``, via :meth:`.HuggingEngine.predict`."""
+        images = self._pixel_values(image_parts) if image_parts else None
+        if streamer is not None:
+            hyperparams = {**hyperparams, "streamer": streamer}
+        # HuggingEngine.predict generates synchronously, so run it in a thread to keep the event loop free
+        return await asyncio.to_thread(asyncio.run, super().predict(messages, functions, images=images, **hyperparams))
+
+    # ==== generation ====
+    # LLaVA's generate() only supports a single sequence at a time, since it splices the image features into the
+    # prompt inside the forward pass. To batch multiple sequences, we build the input embeddings ourselves and run the
+    # decoding loop on the underlying language model.
+    @torch.inference_mode()
+    def generate_batch(
+        self, prompts: list[tuple], streamers: list | None = None, **hyperparams
+    ) -> list[tuple[list[int], int]]:
+        """Generate a completion for each of the given prompts at once.
+
+        Each prompt is prefilled separately, reusing the :attr:`kv_cache` of any previous sequence it extends. Then,
+        the prompts are left-padded to the same length and decoded together. This blocks until generation is complete.
+
+        :param prompts: A list of ``(input_ids, image_parts)`` tuples, where *input_ids* is returned by
+            :meth:`build_prompt` and *image_parts* are the images in the prompt, in order.
+        :param streamers: An optional streamer (e.g. a :class:`transformers.TextIteratorStreamer`) for each prompt,
+            or None. Like ``generate()``, the prompt is passed to each streamer's ``put()`` first, then each generated
+            token as it is generated. The streamers are not ended.
+        :param hyperparams: Generation parameters: ``max_new_tokens``, ``max_length``, ``do_sample``, ``temperature``,
+            ``top_k``, ``top_p``, and ``repetition_penalty`` are supported. See :class:`transformers.GenerationConfig`.
+        :returns: A list of ``(completion token ids, prompt length)`` tuples, in the same order as the prompts. The
+            completion token ids do not include the stop token.
+        :raises ValueError: if any other generation parameters are given.
+        """
+        _check_generation_params(hyperparams)
+        config = copy.deepcopy(self.model.generation_config)
+        config.update(**hyperparams)
+        processors = self._logits_processors(config)
+        eos_token_id = self.tokenizer.eos_token_id
+
+        # encode any new images in the batch at once
+        all_parts = [part for _, image_parts in prompts for part in image_parts]
+        image_features = dict(zip((part.content_hash for part in all_parts), self._image_features(all_parts)))
+        prefills = [self._prefill(input_ids, image_parts, image_features) for input_ids, image_parts in prompts]
+        prompt_lens = [len(key) for key, _, _ in prefills]
+        max_prompt_len = max(prompt_lens)
+        if config.max_new_tokens is not None:
+            max_new_tokens = config.max_new_tokens
+        elif "max_length" in hyperparams:
+            max_new_tokens = config.max_length - max_prompt_len
         else:
-            image_tensor = image_tensor.to(self.device, dtype=torch.float16)
+            max_new_tokens = self.max_context_size - max_prompt_len
+
+        # left-pad the prompts' keys/values so that each sequence's next token is at the end
+        batch_size = len(prompts)
+        past_key_values = _left_pad_past([past for _, past, _ in prefills], max_prompt_len)
+        attention_mask = torch.zeros((batch_size, max_prompt_len), dtype=torch.long, device=self.device)
+        for idx, prompt_len in enumerate(prompt_lens):
+            attention_mask[idx, max_prompt_len - prompt_len :] = 1
+        position_ids = torch.tensor(prompt_lens, device=self.device)[:, None]
+        logits = torch.cat([logits for _, _, logits in prefills])
+        # the tokens that a repetition penalty applies to: the prompt's text and the generated tokens, like generate()
+        prompt_ids = [input_ids[0][input_ids[0] != IMAGE_TOKEN_INDEX] for input_ids, _ in prompts]
+        if streamers:
+            for streamer, (input_ids, _) in zip(streamers, prompts):
+                if streamer is not None:
+                    streamer.put(input_ids.cpu())
+
+        language_model = self.model.get_model()
+        generated = torch.empty((batch_size, 0), dtype=torch.long, device=self.device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+        n_fed = 0  # the number of generated tokens that have been run through the model
+        for _ in range(max_new_tokens):
+            next_tokens = self._next_tokens(
+                [torch.cat([ids, seq]) for ids, seq in zip(prompt_ids, generated)], logits, processors, config
+            )
+            # finished sequences keep generating stop tokens, which are dropped below
+            next_tokens = next_tokens.masked_fill(finished, eos_token_id)
+            generated = torch.cat([generated, next_tokens[:, None]], dim=-1)
+            finished |= next_tokens == eos_token_id
+            if streamers:
+                for idx, (streamer, done) in enumerate(zip(streamers, finished.tolist())):
+                    if streamer is not None and not done:
+                        streamer.put(next_tokens[idx : idx + 1].cpu())
+            if finished.all():
+                break
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((batch_size, 1))], dim=-1)
+            outputs = language_model(
+                inputs_embeds=language_model.embed_tokens(next_tokens[:, None]),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=_model_past(past_key_values),
+                use_cache=True,
+            )
+            past_key_values = _legacy_past(outputs.past_key_values)
+            position_ids = position_ids + 1
+            n_fed += 1
+            logits = self.model.lm_head(outputs[0][:, -1, :]).float()
+
+        results = []
+        for idx, (output, (key, _, _)) in enumerate(zip(generated.tolist(), prefills)):
+            if eos_token_id in output:
+                output = output[: output.index(eos_token_id)]
+            # save this sequence's keys/values so the next round of its conversation only needs to prefill the new part
+            seq_fed = min(len(output), n_fed)
+            seq_start = max_prompt_len - prompt_lens[idx]
+            seq_past = tuple(
+                tuple(t[idx : idx + 1, :, seq_start : seq_start + prompt_lens[idx] + seq_fed].clone() for t in layer)
+                for layer in past_key_values
+            )
+            self._save_kv(key + tuple(output[:seq_fed]), seq_past)
+            results.append((output, prompt_lens[idx]))
+        return results
 
-        # and call the prediction logic
-        return await super().predict(translated_messages, functions, images=image_tensor, **hyperparams)
+    def _prefill(self, input_ids: torch.Tensor, image_parts: list[ImagePart], image_features: dict):
+        """Run a prompt through the model, reusing the cached keys/values of the longest matching prefix.
+
+        :returns: A tuple ``(key, past_key_values, logits)``, where *key* identifies each position of the prompt (see
+            :meth:`_prompt_key`) and *logits* are the logits of the next token.
+        """
+        key = self._prompt_key(input_ids, image_parts)
+        past_key_values, n_reused = self._lookup_kv(key)
+        language_model = self.model.get_model()
+        outputs = language_model(
+            inputs_embeds=self._embed_prompt(input_ids, image_parts, image_features, start=n_reused)[None],
+            position_ids=torch.arange(n_reused, len(key), device=self.device)[None],
+            past_key_values=_model_past(past_key_values),
+            use_cache=True,
+        )
+        logits = self.model.lm_head(outputs[0][:, -1, :]).float()
+        return key, _legacy_past(outputs.past_key_values), logits
+
+    def _prompt_key(self, input_ids: torch.Tensor, image_parts: list[ImagePart]) -> tuple:
+        """Identify each position of the prompt: a token id, or an image's content hash and patch index."""
+        num_patches = self.model.get_vision_tower().num_patches
+        image_parts = iter(image_parts)
+        key = []
+        for token_id in input_ids[0].tolist():
+            if token_id == IMAGE_TOKEN_INDEX:
+                content_hash = next(image_parts).content_hash
+                key.extend((content_hash, patch) for patch in range(num_patches))
+            else:
+                key.append(token_id)
+        return tuple(key)
+
+    def _embed_prompt(
+        self, input_ids: torch.Tensor, image_parts: list[ImagePart], image_features: dict, start: int = 0
+    ) -> torch.Tensor:
+        """Embed the prompt from position *start* on, splicing in the features of each image at its <image> token.
+
+        *image_features* maps the content hash of each image to its vision tower features.
+        """
+        embed_tokens = self.model.get_model().embed_tokens
+        input_ids = input_ids[0]
+        image_parts = iter(image_parts)
+        chunks = []
+        pos = 0
+        text_start = 0
+        for image_idx in (input_ids == IMAGE_TOKEN_INDEX).nonzero().flatten().tolist() + [len(input_ids)]:
+            # the text before this image
+            text = input_ids[text_start:image_idx]
+            if pos + len(text) > start:
+                chunks.append(embed_tokens(text[max(start - pos, 0) :]))
+            pos += len(text)
+            text_start = image_idx + 1
+            if image_idx == len(input_ids):
+                break
+            # and the image itself
+            features = image_features[next(image_parts).content_hash]
+            if pos + len(features) > start:
+                chunks.append(features[max(start - pos, 0) :])
+            pos += len(features)
+        return torch.cat(chunks)
+
+    def _lookup_kv(self, key: tuple) -> tuple:
+        """Find the cached keys/values with the longest common prefix with *key*, cropped to that prefix.
+
+        Returns ``(None, 0)`` if there is no common prefix (e.g. if the chat history was edited at the start).
+        """
+        best_key, best_len = None, 0
+        for cached_key in self.kv_cache.keys():
+            prefix_len = _common_prefix_len(cached_key, key)
+            if prefix_len > best_len:
+                best_key, best_len = cached_key, prefix_len
+        if best_key is None:
+            return None, 0
+        # we always need to run at least one token through the model to get the next token's logits
+        n_reused = min(best_len, len(key) - 1)
+        if n_reused <= 0:
+            return None, 0
+        past_key_values = self.kv_cache.get(best_key)
+        return tuple(tuple(t[:, :, :n_reused] for t in layer) for layer in past_key_values), n_reused
+
+    def _save_kv(self, key: tuple, past_key_values: tuple):
+        # cached sequences that this one extends won't be needed again
+        for cached_key in self.kv_cache.keys():
+            if len(cached_key) <= len(key) and key[: len(cached_key)] == cached_key:
+                self.kv_cache.pop(cached_key)
+        nbytes = sum(_tensor_nbytes(t) for layer in past_key_values for t in layer)
+        self.kv_cache.set(key, past_key_values, nbytes)
+
+    @staticmethod
+    def _logits_processors(config: GenerationConfig) -> LogitsProcessorList:
+        processors = LogitsProcessorList()
+        if config.repetition_penalty is not None and config.repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(config.repetition_penalty))
+        if config.do_sample:
+            if config.temperature is not None and config.temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(config.temperature))
+            if config.top_k is not None and config.top_k != 0:
+                processors.append(TopKLogitsWarper(config.top_k))
+            if config.top_p is not None and config.top_p < 1.0:
+                processors.append(TopPLogitsWarper(config.top_p))
+        return processors
+
+    @staticmethod
+    def _next_tokens(
+        contexts: list[torch.Tensor], logits, processors: LogitsProcessorList, config: GenerationConfig
+    ) -> torch.Tensor:
+        # each sequence's context has a different length, so process each sequence's logits separately
+        scores = torch.cat([processors(ids[None], logits[idx : idx + 1]) for idx, ids in enumerate(contexts)])
+        if config.do_sample:
+            return torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        return torch.argmax(scores, dim=-1)
+
+    # ==== images ====
+    async def _load_images(self, parts: list[ImagePart]):
+        """Decode and preprocess any of the given images whose features and pixel values aren't cached."""
+        await asyncio.gather(*(asyncio.to_thread(getattr, part, "content_hash") for part in parts))
+        missing = {
+            part.content_hash: part
+            for part in parts
+            if (part.content_hash, "features") not in self.image_cache
+            and (part.content_hash, "pixels") not in self.image_cache
+        }
+        if not missing:
+            return
+        images = await asyncio.gather(*(part.aimage(self.image_executor) for part in missing.values()))
+        pixel_values = await asyncio.to_thread(self.process_images, images)
+        for content_hash, pixels in zip(missing, pixel_values):
+            self.image_cache.set((content_hash, "pixels"), pixels, _tensor_nbytes(pixels))
+
+    def _image_features(self, parts: list[ImagePart]) -> list[torch.Tensor]:
+        """Get the projected vision tower features of each of the given images, encoding any uncached images at once."""
+        features = {}
+        for part in parts:
+            if (cached := self.image_cache.get((part.content_hash, "features"))) is not None:
+                features[part.content_hash] = cached
+        missing = {part.content_hash: part for part in parts if part.content_hash not in features}
+        if missing:
+            encoded = self.model.encode_images(self._pixel_values(list(missing.values())))
+            for content_hash, image_features in zip(missing, encoded):
+                features[content_hash] = image_features
+                self.image_cache.set((content_hash, "features"), image_features, _tensor_nbytes(image_features))
+        return [features[part.content_hash] for part in parts]
+
+    def _pixel_values(self, parts: list[ImagePart]) -> torch.Tensor:
+        """Get the preprocessed pixel values of the given images, from the :attr:`image_cache` if possible."""
+        pixel_values = []
+        for part in parts:
+            pixels = self.image_cache.get((part.content_hash, "pixels"))
+            if pixels is None:
+                pixels = self.process_images([part.image])[0]
+            pixel_values.append(pixels)
+        return torch.stack(pixel_values)
+
+    def process_images(self, images: list[Image.Image]) -> torch.Tensor:
+        """Preprocess the given images into the tensor that the model expects, on the model's device."""
+        image_tensor = process_images(images, self.image_processor, self.model.config)
+        if type(image_tensor) is list:
+            image_tensor = torch.stack(image_tensor)
+        return image_tensor.to(self.device, dtype=torch.float16)
 
     def message_len(self, message: ChatMessage) -> int:
         if isinstance(message.content, str):
@@ -159,3 +586,93 @@ class LlavaEngine(VicunaEngine):
             return super().message_len(message.copy_with(parts=translated_parts)) + image_tokens
         # otherwise return normally
         return super().message_len(message)
+
+    async def close(self):
+        await super().close()
+        await release_http_session(self)
+
+
+class _AsyncTextStreamer(TextStreamer):
+    """A streamer that puts each piece of decoded text (then None when the stream ends) in an :class:`asyncio.Queue`.
+
+    Unlike :class:`transformers.TextIteratorStreamer`, a consumer on the event loop can wait for text without blocking
+    a thread, which would otherwise compete with generation for the default executor's threads.
+    """
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, skip_prompt: bool = False, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+def _tensor_nbytes(t: torch.Tensor) -> int:
+    return t.element_size() * t.nelement()
+
+
+def _common_prefix_len(a: tuple, b: tuple) -> int:
+    n = min(len(a), len(b))
+    for idx in range(n):
+        if a[idx] != b[idx]:
+            return idx
+    return n
+
+
+# the generation parameters that generate_batch() implements
+_DECODING_LOOP_PARAMS = {
+    "max_new_tokens",
+    "max_length",
+    "do_sample",
+    "temperature",
+    "top_k",
+    "top_p",
+    "repetition_penalty",
+}
+
+
+def _check_generation_params(hyperparams: dict):
+    if unsupported := sorted(set(hyperparams) - _DECODING_LOOP_PARAMS):
+        raise ValueError(
+            f"LlavaEngine does not support the generation parameters {unsupported} when batching or KV caching is"
+            f" enabled. The supported parameters are {sorted(_DECODING_LOOP_PARAMS)}."
+        )
+
+
+def _legacy_past(past_key_values) -> tuple:
+    # newer versions of transformers return a Cache object rather than a tuple of (key, value) per layer
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return past_key_values
+
+
+def _model_past(past_key_values: tuple | None):
+    """Convert a tuple of (key, value) per layer to a Cache object, which newer versions of transformers require."""
+    if past_key_values is None:
+        return None
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(past_key_values):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def _left_pad_past(pasts: list[tuple], length: int) -> tuple:
+    """Stack the keys/values of multiple sequences into a batch, left-padding each to *length* positions."""
+    layers = []
+    for layer in zip(*pasts):
+        tensors = []
+        for kv_idx in range(len(layer[0])):
+            tensors.append(
+                torch.cat(
+                    [torch.nn.functional.pad(seq[kv_idx], (0, 0, length - seq[kv_idx].shape[2], 0)) for seq in layer]
+                )
+            )
+        layers.append(tuple(tensors))
+    return tuple(layers)
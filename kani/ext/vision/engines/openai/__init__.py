@@ -1 +1,2 @@
+from .client import OpenAIVisionClient
 from .engine import OpenAIVisionEngine
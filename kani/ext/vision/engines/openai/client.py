@@ -0,0 +1,83 @@
+import contextvars
+import json
+import re
+
+import aiohttp
+from aiohttp.abc import AbstractStreamWriter
+
+from kani.engines.openai import OpenAIClient
+from .models import DEFERRED_IMAGE_PREFIX, DEFERRED_IMAGE_SUFFIX, OpenAIImage
+from ...parts import ImagePart
+
+_deferred_parts = contextvars.ContextVar("_deferred_parts", default=None)
+
+_placeholder_re = re.compile(f"{re.escape(DEFERRED_IMAGE_PREFIX)}([0-9a-f]+){re.escape(DEFERRED_IMAGE_SUFFIX)}")
+
+
+class StreamingJSONPayload(aiohttp.Payload):
+    """A JSON request body whose deferred images are base64-encoded as the body is written to the connection.
+
+    Only one chunk of each image's base64 encoding is held in memory at a time, rather than the entire data URI. The
+    payload can be written more than once (e.g. when a request is retried).
+    """
+
+    def __init__(self, data, parts: dict[str, ImagePart], chunk_size: int = 768 * 1024, **kwargs):
+        """
+        :param data: The JSON-serializable request body, containing deferred image placeholders.
+        :param parts: A mapping of content hash to the image part to substitute for each placeholder.
+        :param chunk_size: The number of bytes of image data to encode at a time.
+        """
+        super().__init__(data, content_type="application/json", **kwargs)
+        # split the serialized body into alternating JSON segments and image hashes
+        pieces = _placeholder_re.split(json.dumps(data))
+        self._segments = [s.encode() for s in pieces[::2]]
+        self._images = [parts[h] for h in pieces[1::2]]
+        self._chunk_size = chunk_size
+        self._size = sum(len(s) for s in self._segments) + sum(_b64_uri_len(part) for part in self._images)
+
+    def _iter_chunks(self):
+        for segment, part in zip(self._segments, self._images):
+            yield segment
+            for chunk in part.iter_b64_uri(self._chunk_size):
+                yield chunk.encode()
+        yield self._segments[-1]
+
+    async def write(self, writer: AbstractStreamWriter):
+        for chunk in self._iter_chunks():
+            await writer.write(chunk)
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return b"".join(self._iter_chunks()).decode(encoding, errors)
+
+
+def _b64_uri_len(part: ImagePart) -> int:
+    # the length of the data URI of the given image, without encoding it
+    return len(f"data:{part.mime};base64,") + 4 * -(-part.buffer.nbytes // 3)
+
+
+class OpenAIVisionClient(OpenAIClient):
+    """An :class:`~kani.engines.openai.OpenAIClient` that streams images into the request body.
+
+    Images translated with :func:`.defer_image_encoding` are base64-encoded chunk by chunk as the request is sent
+    (see :class:`.StreamingJSONPayload`), rather than building each image's full data URI in memory.
+    """
+
+    async def create_chat_completion(self, model: str, messages, **kwargs):
+        parts = {}
+        for message in messages:
+            if isinstance(message.content, str) or message.content is None:
+                continue
+            for part in message.content:
+                if isinstance(part, OpenAIImage) and part.deferred_part is not None:
+                    parts[part.deferred_part.content_hash] = part.deferred_part
+        token = _deferred_parts.set(parts or None)
+        try:
+            return await super().create_chat_completion(model, messages, **kwargs)
+        finally:
+            _deferred_parts.reset(token)
+
+    async def request(self, method: str, route: str, headers=None, retry=None, **kwargs):
+        parts = _deferred_parts.get()
+        if parts and "json" in kwargs:
+            kwargs["data"] = StreamingJSONPayload(kwargs.pop("json"), parts)
+        return await super().request(method, route, headers=headers, retry=retry, **kwargs)
@@ -1,9 +1,21 @@
-from kani import ChatMessage
+import asyncio
+from concurrent.futures import Executor
+from io import BytesIO
+from typing import AsyncIterable, Literal
+
+from PIL import ExifTags, Image, ImageOps
+
+from kani import AIFunction, ChatMessage
+from kani.engines.base import BaseCompletion
 from kani.engines.openai import OpenAIEngine
-from kani.engines.openai.models import OpenAIChatMessage
-from .img_tokens import tokens_from_image_size
-from .models import OpenAIVisionChatMessage
-from ...parts import ImagePart
+from kani.engines.openai.models import ChatCompletion, OpenAIChatMessage
+from .client import OpenAIVisionClient
+from .img_tokens import ImageCostModel, cost_model_for, scaled_image_size, tokens_from_image_size
+from .models import OpenAIVisionChatMessage, defer_image_encoding, use_translation_cache
+from ... import instrumentation
+from ...cache import IdentityLRUCache, LRUCache, encoding_cache
+from ...parts import ImagePart, PillowImagePart, RemoteURLImagePart
+from ...utils import release_http_session, use_http_session
 
 
 class OpenAIVisionEngine(OpenAIEngine):
@@ -11,19 +23,124 @@ class OpenAIVisionEngine(OpenAIEngine):
 
     This engine supports all vision-language models, chat-based models, and fine-tunes. It is a superset of the base
     :class:`~kani.engines.openai.OpenAIEngine`.
+
+    **Image Preprocessing**
+
+    By default, images are uploaded to the API as-is. Since the API downscales large images before the model sees
+    them, pass ``resize_images=True`` to downscale images to the largest size that the API will use and re-encode them
+    in a more compact format before uploading them, which can greatly reduce the size of each request.
+
+    By default, each image is base64-encoded in memory when its message is translated. Pass
+    ``stream_image_payloads=True`` to instead encode images chunk by chunk as the request body is sent, which keeps
+    memory usage low when sending many or large images in one request.
+
+    Image preprocessing and encoding run in a thread pool so that they do not block the event loop. Pass an
+    ``image_executor`` (e.g. a :class:`~concurrent.futures.ProcessPoolExecutor`) to control where this work runs.
     """
 
-    def __init__(self, api_key: str = None, model="gpt-4-vision-preview", *args, **kwargs):
+    def __init__(
+        self,
+        api_key: str = None,
+        model="gpt-4-vision-preview",
+        *args,
+        resize_images: bool = False,
+        image_format: str = "JPEG",
+        image_quality: int = 85,
+        low_detail_max_side: int | None = None,
+        default_detail: Literal["high", "low"] | None = None,
+        stream_image_payloads: bool = False,
+        image_executor: Executor | None = None,
+        message_cache_size: int = 256,
+        message_len_cache_size: int = 4096,
+        translation_cache_bytes: int = 64 * 1024 * 1024,
+        image_cost_model: ImageCostModel | None = None,
+        **kwargs,
+    ):
+        """
+        :param api_key: Your OpenAI API key. By default, the API key will be read from the `OPENAI_API_KEY` environment
+            variable.
+        :param model: The id of the model to use (e.g. "gpt-4-vision-preview").
+        :param resize_images: Whether to downscale images to the largest size the API will use before uploading them.
+        :param image_format: The Pillow format to re-encode resized images in (e.g. "JPEG", "WEBP", "PNG").
+        :param image_quality: The quality to re-encode resized images with, for lossy formats (1-100).
+        :param low_detail_max_side: If set, images whose longest side is at most this many pixels will be sent in low
+            detail mode (85 tokens) unless the image's :attr:`~.ImagePart.detail` is set. Since the model sees low
+            detail images at 512x512, a value of 512 saves tokens without losing any resolution.
+        :param default_detail: The detail level to send images at if the image's :attr:`~.ImagePart.detail` is not set
+            (default the API's default, currently "auto").
+        :param stream_image_payloads: Whether to base64-encode images as the request body is sent rather than in memory
+            beforehand. If you pass a ``client``, it must be an :class:`.OpenAIVisionClient`.
+        :param image_executor: The executor to resize and encode images in (default the event loop's default thread
+            pool).
+        :param message_cache_size: The number of preprocessed messages to keep, so that each message in the chat history
+            is only preprocessed once (0 to disable).
+        :param message_len_cache_size: The number of message token lengths to keep in the :attr:`message_len_cache`
+            (0 to disable).
+        :param translation_cache_bytes: The total size of the translated messages (including their base64-encoded
+            images) to keep in the :attr:`translation_cache`, in bytes (0 to disable).
+        :param image_cost_model: The parameters used to count the tokens of an image (by default, looked up by model
+            name with :func:`.cost_model_for`).
+        :param kwargs: Any additional arguments to pass to the :class:`~kani.engines.openai.OpenAIEngine`.
+        """
         super().__init__(api_key, model, *args, **kwargs)
         # GPT-4 visual alpha always includes a 54-token system prompt
         if model.endswith("visual"):
             self.token_reserve = 54
+        self.resize_images = resize_images
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.low_detail_max_side = low_detail_max_side
+        self.default_detail = default_detail
+        self.image_cost_model = image_cost_model or cost_model_for(model)
+        self.stream_image_payloads = stream_image_payloads
+        self.image_executor = image_executor
+        # keep the shared connection pool open until every engine using it is closed
+        use_http_session(self)
+        self._prepared_messages = IdentityLRUCache(maxsize=message_cache_size)
+        self.message_len_cache = LRUCache(maxsize=message_len_cache_size)
+        """The token lengths of messages this engine has seen, keyed by their content.
+
+        Use ``message_len_cache.cache_info()`` to get the hit rate of this cache.
+        """
+        self.translation_cache = IdentityLRUCache(max_bytes=translation_cache_bytes)
+        """The messages this engine has translated into the OpenAI format, keyed by the identity of each message.
+
+        Since chat messages are immutable, each message in a chat history only needs to be translated (and its images
+        encoded) once, rather than once per round.
+        """
+        if stream_image_payloads and not isinstance(self.client, OpenAIVisionClient):
+            if kwargs.get("client") is not None:
+                raise ValueError("stream_image_payloads=True requires the passed client to be an OpenAIVisionClient.")
+            # swap the default client for one that supports streaming
+            self.client = OpenAIVisionClient(
+                self.client.api_key,
+                organization=self.client.organization,
+                retry=self.client.retry,
+                api_base=self.client.SERVICE_BASE,
+                headers=self.client.headers,
+            )
 
     def message_len(self, message: ChatMessage) -> int:
+        return self.message_len_cache.get_or_compute(
+            self._message_len_key(message), lambda: self._message_len(message), sizeof=lambda _: 0
+        )
+
+    def _message_len_key(self, message: ChatMessage):
+        # everything that the token length of a message depends on (an image's cost only depends on its size and detail,
+        # which, unlike its content hash, don't require reading the whole image)
+        parts = tuple(
+            (part.size, self.image_detail(part)) if isinstance(part, ImagePart) else str(part) for part in message.parts
+        )
+        function_call = (message.function_call.name, message.function_call.arguments) if message.function_call else None
+        return parts, message.name, function_call
+
+    def _message_len(self, message: ChatMessage) -> int:
         mlen = 7
         for part in message.parts:
             if isinstance(part, ImagePart):
-                mlen += tokens_from_image_size(part.size)
+                mlen += tokens_from_image_size(
+                    part.size, low_detail=self.image_detail(part) == "low", cost_model=self.image_cost_model
+                )
             else:
                 mlen += len(self.tokenizer.encode(str(part)))
         if message.name:
@@ -33,6 +150,211 @@ class OpenAIVisionEngine(OpenAIEngine):
             mlen += len(self.tokenizer.encode(message.function_call.arguments))
         return mlen
 
+    async def predict(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> ChatCompletion:
+        messages = await self.aprepare_messages(messages)
+        if self.stream_image_payloads:
+            with defer_image_encoding():
+                return await super().predict(messages, functions, **hyperparams)
+        return await super().predict(messages, functions, **hyperparams)
+
+    async def stream(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> AsyncIterable[str | BaseCompletion]:
+        # requires a version of kani that supports streaming (v1.0+), like OpenAIEngine.stream
+        messages = await self.aprepare_messages(messages)
+        if self.stream_image_payloads:
+            with defer_image_encoding():
+                async for chunk in super().stream(messages, functions, **hyperparams):
+                    yield chunk
+            return
+        async for chunk in super().stream(messages, functions, **hyperparams):
+            yield chunk
+
+    async def close(self):
+        await super().close()
+        await release_http_session(self)
+
+    def translate_messages(self, messages: list[ChatMessage], cls: type[OpenAIChatMessage] = OpenAIVisionChatMessage):
+        with use_translation_cache(self.translation_cache):
+            return OpenAIEngine.translate_messages(messages, cls)
+
+    # ==== image preprocessing ====
+    def image_detail(self, part: ImagePart) -> str | None:
+        """Get the detail level the given image will be sent at."""
+        if part.detail is not None:
+            return part.detail
+        if self.low_detail_max_side is not None and max(part.size) <= self.low_detail_max_side:
+            return "low"
+        return self.default_detail
+
+    def prepare_message(self, message: ChatMessage) -> ChatMessage:
+        """Preprocess all the images in the given message before sending it to the API."""
+        return self._replace_images(message, {id(part): self.prepare_image(part) for part in _image_parts(message)})
+
+    async def aprepare_messages(self, messages: list[ChatMessage]) -> list[ChatMessage]:
+        """Preprocess all the images in the given messages concurrently, without blocking the event loop.
+
+        Unless ``stream_image_payloads`` is set, this also base64-encodes each image in the engine's ``image_executor``
+        so that translating the messages is cheap. Otherwise, images are base64-encoded as the request is sent, but
+        their binary data (e.g. the PNG encoding of a Pillow image) is still prepared in the ``image_executor``.
+        """
+        # messages are immutable, so messages prepared in a previous round can be reused as-is
+        prepared_messages = {}
+        pending = []
+        for message in messages:
+            if not _image_parts(message):
+                prepared_messages[id(message)] = message
+            elif (cached := self._prepared_messages.get(message, _missing)) is not _missing:
+                # None means unchanged (the message can't be stored in its own cache entry, or it would never be freed)
+                prepared_messages[id(message)] = message if cached is None else cached
+            else:
+                pending.append(message)
+
+        parts = {id(part): part for message in pending for part in _image_parts(message)}
+        prepared = await asyncio.gather(*(self.aprepare_image(part) for part in parts.values()))
+        local = [part for part in prepared if not isinstance(part, RemoteURLImagePart)]
+        if self.stream_image_payloads:
+            await asyncio.gather(*(_aload_image_data(part, self.image_executor) for part in local))
+        else:
+            await asyncio.gather(*(part.aencode(self.image_executor) for part in local))
+        replacements = dict(zip(parts, prepared))
+        for message in pending:
+            prepared_message = self._replace_images(message, replacements)
+            self._prepared_messages.set(message, None if prepared_message is message else prepared_message)
+            prepared_messages[id(message)] = prepared_message
+        return [prepared_messages[id(message)] for message in messages]
+
+    def prepare_image(self, part: ImagePart) -> ImagePart:
+        """Preprocess an image before sending it to the API.
+
+        This sets the image's detail level and, if ``resize_images`` is set, downscales it to the largest size the API
+        will use at that detail level and re-encodes it with the engine's ``image_format`` and ``image_quality``.
+        Resized images are stored in the :data:`.encoding_cache`.
+        """
+        detail = self.image_detail(part)
+        if isinstance(part, RemoteURLImagePart) or not self.resize_images:
+            return _with_detail(part, detail)
+        data = encoding_cache.get_or_compute(
+            self._resize_cache_key(part, detail),
+            lambda: _resize_image(part, self._resize_target(part, detail), self.image_format, self.image_quality),
+            sizeof=_sizeof_resized,
+        )
+        return _with_detail(part, detail, data)
+
+    async def aprepare_image(self, part: ImagePart) -> ImagePart:
+        """Like :meth:`prepare_image`, but resizes the image in the engine's ``image_executor``."""
+        detail = self.image_detail(part)
+        if isinstance(part, RemoteURLImagePart) or not self.resize_images:
+            return _with_detail(part, detail)
+        # hashing may read the image from disk, so do it in a thread
+        await asyncio.to_thread(getattr, part, "content_hash")
+        key = self._resize_cache_key(part, detail)
+        if key in encoding_cache:
+            data = encoding_cache.get(key)
+        else:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(
+                self.image_executor,
+                instrumentation.propagate_context(_resize_image, self.image_executor),
+                part,
+                self._resize_target(part, detail),
+                self.image_format,
+                self.image_quality,
+            )
+            encoding_cache.set(key, data, _sizeof_resized(data))
+        return _with_detail(part, detail, data)
+
+    def _resize_cache_key(self, part: ImagePart, detail: str | None):
+        return (
+            part.content_hash,
+            "openai-resize",
+            self._resize_target(part, detail),
+            self.image_format,
+            self.image_quality,
+        )
+
+    def _resize_target(self, part: ImagePart, detail: str | None) -> tuple[int, int]:
+        # low detail images are seen in a 512x512 box; high detail images at the API's rescaled size
+        if detail == "low":
+            return 512, 512
+        return scaled_image_size(part.size, self.image_cost_model)
+
     @staticmethod
-    def translate_messages(messages: list[ChatMessage], cls: type[OpenAIChatMessage] = OpenAIVisionChatMessage):
-        return OpenAIEngine.translate_messages(messages, cls)
+    def _replace_images(message: ChatMessage, replacements: dict[int, ImagePart]) -> ChatMessage:
+        if isinstance(message.content, str) or message.content is None:
+            return message
+        parts = [replacements.get(id(part), part) for part in message.parts]
+        if all(new is old for new, old in zip(parts, message.parts)):
+            return message
+        return message.copy_with(parts=parts)
+
+
+_missing = object()
+
+
+def _image_parts(message: ChatMessage) -> list[ImagePart]:
+    if isinstance(message.content, str) or message.content is None:
+        return []
+    return [part for part in message.parts if isinstance(part, ImagePart)]
+
+
+async def _aload_image_data(part: ImagePart, executor: Executor | None):
+    # a streamed request body reads each image's binary data and content hash on the event loop, so make sure neither
+    # needs to be computed then (the default buffer encodes the image; file and buffer-backed parts have their own)
+    if type(part).buffer is ImagePart.buffer:
+        await part.abytes(executor)
+    await asyncio.to_thread(getattr, part, "content_hash")
+
+
+def _with_detail(part: ImagePart, detail: str | None, resized: bytes | None = None) -> ImagePart:
+    if resized is not None:
+        return ImagePart.from_bytes(resized).copy_with(detail=detail)
+    return part if detail == part.detail else part.copy_with(detail=detail)
+
+
+def _sizeof_resized(data: bytes | None) -> int:
+    return len(data) if data is not None else 0
+
+
+# this is a module-level function so that it can be run in a process pool
+def _resize_image(part: ImagePart, target: tuple[int, int], image_format: str, image_quality: int) -> bytes | None:
+    with instrumentation.span("resize", format=image_format, width=target[0], height=target[1]) as span:
+        data = _resize_image_data(part, target, image_format, image_quality)
+        span.set(nbytes=None if data is None else len(data), resized=data is not None)
+    return data
+
+
+def _resize_image_data(part: ImagePart, target: tuple[int, int], image_format: str, image_quality: int) -> bytes | None:
+    img = part.image
+    # for JPEGs, this lets Pillow decode at a reduced scale, which is much faster
+    # (but don't modify a user's Pillow image)
+    if not isinstance(part, PillowImagePart):
+        img.draft("RGB", target)
+    # re-encoding drops the EXIF orientation (e.g. of phone photos), so apply it to the pixels
+    orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+        # orientations 5-8 rotate the image by 90 degrees; the API's scaling is symmetric, so swapping the target gives
+        # the target of the upright image
+        if orientation >= 5:
+            target = target[::-1]
+    resized = img.width > target[0] or img.height > target[1]
+    if resized:
+        img = ImageOps.contain(img, target, Image.Resampling.LANCZOS)
+
+    # JPEGs don't support transparency, so composite it onto a white background
+    if image_format.upper() == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+
+    io = BytesIO()
+    img.save(io, format=image_format, quality=image_quality)
+    data = io.getvalue()
+    # if we didn't shrink or rotate the image and re-encoding didn't help, keep the original data (returned as None)
+    if not resized and orientation == 1 and len(data) >= len(part.bytes):
+        return None
+    return data
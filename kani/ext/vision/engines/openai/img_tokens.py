@@ -1,31 +1,194 @@
+import json
 import math
+from typing import TYPE_CHECKING, Iterable, NamedTuple
 
+from kani.utils.typing import PathLike
 
-def tokens_from_image_size(size: tuple[int, int], low_detail: bool = False) -> int:
+if TYPE_CHECKING:
+    import numpy as np
+
+
+class ImageCostModel(NamedTuple):
+    """The parameters OpenAI uses to count the tokens of an image for a family of models.
+
+    In high detail mode, an image is rescaled to fit within ``max_long_side`` x ``max_short_side``, then split into
+    ``tile_size`` px square tiles. It uses ``base_tokens`` plus ``tile_tokens`` for each tile. In low detail mode, an
+    image always uses ``low_detail_tokens``.
+    """
+
+    base_tokens: int = 85
+    tile_tokens: int = 170
+    low_detail_tokens: int = 85
+    tile_size: int = 512
+    max_long_side: int = 2048
+    max_short_side: int = 768
+
+
+GPT_4V_COST_MODEL = ImageCostModel()
+"""The image token costs of GPT-4V, GPT-4 Turbo, and GPT-4o."""
+
+# see https://platform.openai.com/docs/guides/vision/calculating-costs and https://openai.com/api/pricing/
+# like kani's CONTEXT_SIZES_BY_PREFIX, the first matching prefix is used
+COST_MODELS_BY_PREFIX = [
+    ("gpt-4o-mini", ImageCostModel(base_tokens=2833, tile_tokens=5667, low_detail_tokens=2833)),
+    ("gpt-4o", GPT_4V_COST_MODEL),
+    ("o1", ImageCostModel(base_tokens=75, tile_tokens=150, low_detail_tokens=75)),
+    ("gpt-4-turbo", GPT_4V_COST_MODEL),
+    ("gpt-4-vision", GPT_4V_COST_MODEL),
+    # fine-tunes
+    ("ft:gpt-4o-mini", ImageCostModel(base_tokens=2833, tile_tokens=5667, low_detail_tokens=2833)),
+    ("ft:gpt-4o", GPT_4V_COST_MODEL),
+    # catch-all
+    ("", GPT_4V_COST_MODEL),
+]
+
+
+def cost_model_for(model: str) -> ImageCostModel:
+    """Get the image cost model used by the given OpenAI model (e.g. "gpt-4o")."""
+    return next(cost_model for prefix, cost_model in COST_MODELS_BY_PREFIX if model.startswith(prefix))
+
+
+def register_cost_model(prefix: str, cost_model: ImageCostModel):
+    """Use the given cost model for all models whose ID starts with *prefix*, taking priority over existing entries."""
+    COST_MODELS_BY_PREFIX.insert(0, (prefix, cost_model))
+
+
+def load_cost_models(fp: PathLike):
+    """Register the cost models in the given JSON file, which maps model ID prefixes to :class:`ImageCostModel` fields.
+
+    The calibration script at ``scripts/calibrate-image-costs.py`` outputs files in this format.
+    """
+    with open(fp) as f:
+        data = json.load(f)
+    for prefix, params in data.items():
+        register_cost_model(prefix, ImageCostModel(**params))
+
+
+def scaled_image_size(size: tuple[int, int], cost_model: ImageCostModel = GPT_4V_COST_MODEL) -> tuple[int, int]:
+    """Get the size that OpenAI rescales an image to before tiling it in high detail mode.
+
+    Any resolution past this size is discarded by the API, so an image can be downscaled to this size before uploading
+    without changing how many tokens it uses.
+    """
+    width, height = size
+    long, short = _rescale(*size, cost_model) if width >= height else _rescale(height, width, cost_model)
+    if width >= height:
+        return int(long), int(short)
+    return int(short), int(long)
+
+
+def tokens_from_image_size(
+    size: tuple[int, int], low_detail: bool = False, cost_model: ImageCostModel = GPT_4V_COST_MODEL
+) -> int:
     """Estimate the number of tokens used after providing this image.
 
     See https://platform.openai.com/docs/guides/vision/calculating-costs for more details.
     """
     if low_detail:
-        return 85
+        return cost_model.low_detail_tokens
 
     long, short = size
     if long < short:
         long, short = short, long
 
-    # rescale so the larger side is 2048px
-    if long > 2048:
-        ratio = long / 2048
-        long = 2048
-        short //= ratio
+    long, short = _rescale(long, short, cost_model)
+    n_patches = math.ceil(long / cost_model.tile_size) * math.ceil(short / cost_model.tile_size)
 
-    # rescale so the smaller side is 768px
-    if short > 768:
-        ratio = short / 768
-        short = 768
-        long //= ratio
+    # e.g. +170 tokens for each 512x512 patch
+    return cost_model.base_tokens + (n_patches * cost_model.tile_tokens)
+
+
+def tokens_from_image_sizes(sizes, low_detail=False, cost_model: ImageCostModel = GPT_4V_COST_MODEL) -> "np.ndarray":
+    """Like :func:`tokens_from_image_size`, but for many images at once. Requires NumPy.
+
+    This gives exactly the same results as calling :func:`tokens_from_image_size` on each size.
+
+    :param sizes: An array-like of shape ``(n, 2)`` containing the size of each image, in pixels.
+    :param low_detail: Whether each image is sent in low detail mode: either a single bool for all images, or an
+        array-like of shape ``(n,)``.
+    :param cost_model: The cost model to use (default GPT-4V's).
+    :returns: An integer array of shape ``(n,)`` containing the number of tokens used by each image.
+    """
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError("tokens_from_image_sizes requires NumPy. You can install it with `pip install numpy`.") from e
+
+    sizes = np.asarray(sizes)
+    if sizes.ndim != 2 or sizes.shape[1] != 2:
+        raise ValueError(f"sizes must have shape (n, 2), not {sizes.shape}")
+    # use floats throughout, since that's what the scalar implementation's floor divisions do
+    long = sizes.max(axis=1).astype(np.float64)
+    short = sizes.min(axis=1).astype(np.float64)
+
+    # rescale so the larger side is at most max_long_side (e.g. 2048px)
+    mask = long > cost_model.max_long_side
+    ratio = long[mask] / cost_model.max_long_side
+    long[mask] = cost_model.max_long_side
+    short[mask] = np.floor_divide(short[mask], ratio)
+
+    # rescale so the smaller side is at most max_short_side (e.g. 768px)
+    mask = short > cost_model.max_short_side
+    ratio = short[mask] / cost_model.max_short_side
+    short[mask] = cost_model.max_short_side
+    long[mask] = np.floor_divide(long[mask], ratio)
 
-    n_patches = math.ceil(long / 512) * math.ceil(short / 512)
+    n_patches = np.ceil(long / cost_model.tile_size) * np.ceil(short / cost_model.tile_size)
+    tokens = (cost_model.base_tokens + n_patches * cost_model.tile_tokens).astype(np.int64)
+    return np.where(np.asarray(low_detail, dtype=bool), cost_model.low_detail_tokens, tokens)
 
-    # +170 tokens for each 512x512 patch
-    return 85 + (n_patches * 170)
+
+def fit_cost_model(
+    observations: Iterable[tuple[tuple[int, int], bool, int]], base: ImageCostModel = GPT_4V_COST_MODEL
+) -> ImageCostModel:
+    """Fit the token costs of a cost model to a set of observed image token counts.
+
+    The tiling parameters (``tile_size``, ``max_long_side``, and ``max_short_side``) are taken from *base*; the base
+    and per-tile token costs are fit to the high detail observations with least squares, and the low detail cost is
+    the median of the low detail observations.
+
+    :param observations: An iterable of ``(size, low_detail, tokens)`` tuples, where ``tokens`` is the number of
+        tokens the image used.
+    :param base: The cost model to take the tiling parameters (and any costs that cannot be fit) from.
+    """
+    tiles = []
+    high_tokens = []
+    low_tokens = []
+    for size, low_detail, tokens in observations:
+        if low_detail:
+            low_tokens.append(tokens)
+        else:
+            # count the tiles with a cost model that has 0 base tokens and 1 token per tile
+            tiles.append(tokens_from_image_size(size, cost_model=base._replace(base_tokens=0, tile_tokens=1)))
+            high_tokens.append(tokens)
+
+    fitted = {}
+    if low_tokens:
+        low_tokens.sort()
+        fitted["low_detail_tokens"] = low_tokens[len(low_tokens) // 2]
+    # we need at least two different tile counts to separate the base and per-tile costs
+    if len(set(tiles)) >= 2:
+        n = len(tiles)
+        mean_x = sum(tiles) / n
+        mean_y = sum(high_tokens) / n
+        cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(tiles, high_tokens))
+        var = sum((x - mean_x) ** 2 for x in tiles)
+        tile_tokens = cov / var
+        fitted["tile_tokens"] = round(tile_tokens)
+        fitted["base_tokens"] = round(mean_y - tile_tokens * mean_x)
+    return base._replace(**fitted)
+
+
+def _rescale(long, short, cost_model: ImageCostModel = GPT_4V_COST_MODEL):
+    # rescale so the larger side is at most max_long_side (e.g. 2048px)
+    if long > cost_model.max_long_side:
+        ratio = long / cost_model.max_long_side
+        long = cost_model.max_long_side
+        short //= ratio
+
+    # rescale so the smaller side is at most max_short_side (e.g. 768px)
+    if short > cost_model.max_short_side:
+        ratio = short / cost_model.max_short_side
+        short = cost_model.max_short_side
+        long //= ratio
+    return long, short
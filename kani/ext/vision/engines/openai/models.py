@@ -1,11 +1,47 @@
+import contextlib
+import contextvars
 from typing import Annotated, Literal, Union
 
-from pydantic import Field
+from pydantic import Field, PrivateAttr
 
 from kani.engines.openai.models import OpenAIChatMessage
 from kani.models import BaseModel, ChatMessage, ChatRole
+from ... import instrumentation
+from ...cache import IdentityLRUCache
 from ...parts import ImagePart, RemoteURLImagePart
 
+_defer_image_encoding = contextvars.ContextVar("_defer_image_encoding", default=False)
+_translation_cache = contextvars.ContextVar("_translation_cache", default=None)
+
+DEFERRED_IMAGE_PREFIX = "@@kani-vision-deferred-image:"
+DEFERRED_IMAGE_SUFFIX = "@@"
+
+
+@contextlib.contextmanager
+def defer_image_encoding():
+    """Within this context manager, :meth:`.OpenAIImage.from_imagepart` will not encode images.
+
+    Instead, the created :class:`.OpenAIImage` will have a placeholder URL and keep a reference to the image part so
+    that an :class:`.OpenAIVisionClient` can stream the encoded image directly into the request body.
+    """
+    token = _defer_image_encoding.set(True)
+    try:
+        yield
+    finally:
+        _defer_image_encoding.reset(token)
+
+
+@contextlib.contextmanager
+def use_translation_cache(cache: IdentityLRUCache):
+    """Within this context manager, :meth:`.OpenAIVisionChatMessage.from_chatmessage` will cache translated messages
+    in the given cache, keyed by the identity of each :class:`~kani.ChatMessage`.
+    """
+    token = _translation_cache.set(cache)
+    try:
+        yield
+    finally:
+        _translation_cache.reset(token)
+
 
 # note: `type` does not have default since we use `.model_dump(..., exclude_defaults=True)`
 class OpenAIText(BaseModel):
@@ -22,11 +58,23 @@ class OpenAIImage(BaseModel):
     image_url: str
     detail: Literal["high"] | Literal["low"] | None = None
 
+    _deferred_part: ImagePart | None = PrivateAttr(default=None)
+
+    @property
+    def deferred_part(self) -> ImagePart | None:
+        """If this image was created with deferred encoding, the image part to encode when sending the request."""
+        return self._deferred_part
+
     @classmethod
     def from_imagepart(cls, part: ImagePart):
         if isinstance(part, RemoteURLImagePart):
-            return cls(type="image_url", image_url=part.url)
-        return cls(type="image_url", image_url=part.b64_uri)
+            return cls(type="image_url", image_url=part.url, detail=part.detail)
+        if _defer_image_encoding.get():
+            placeholder = f"{DEFERRED_IMAGE_PREFIX}{part.content_hash}{DEFERRED_IMAGE_SUFFIX}"
+            inst = cls(type="image_url", image_url=placeholder, detail=part.detail)
+            inst._deferred_part = part
+            return inst
+        return cls(type="image_url", image_url=part.b64_uri, detail=part.detail)
 
 
 OpenAIPart = Annotated[Union[OpenAIText, OpenAIImage], Field(discriminator="type")]
@@ -39,6 +87,27 @@ class OpenAIVisionChatMessage(OpenAIChatMessage):
 
     @classmethod
     def from_chatmessage(cls, m: ChatMessage):
+        # messages with deferred images are cheap to translate and are only valid for one request, so don't cache them
+        if _defer_image_encoding.get():
+            return cls._from_chatmessage(m)
+        cache = _translation_cache.get()
+        cached = cache.get(m) if cache is not None else None
+        if cached is None or type(cached) is not cls:
+            with instrumentation.span("translate_message", role=m.role.value):
+                cached = cls._from_chatmessage(m)
+            if cache is not None:
+                cache.set(m, cached, cached.content_nbytes)
+        return cached
+
+    @property
+    def content_nbytes(self) -> int:
+        """The approximate size of this message's content (e.g. its base64-encoded images), in bytes."""
+        if not isinstance(self.content, list):
+            return len(self.content or "")
+        return sum(len(part.image_url if isinstance(part, OpenAIImage) else part.text) for part in self.content)
+
+    @classmethod
+    def _from_chatmessage(cls, m: ChatMessage):
         # leave primitive content as is
         if isinstance(m.content, str) or m.content is None:
             content = m.content
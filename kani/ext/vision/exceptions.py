@@ -11,3 +11,12 @@ class RemoteImageError(KaniVisionException):
 
 class ImageFormatException(KaniVisionException):
     """This image does not have a valid MIME type."""
+
+
+class ImageMetadataException(KaniVisionException):
+    """The size of this image could not be determined."""
+
+
+class BlobNotFoundException(KaniVisionException):
+    """This image's data could not be found in its blob store (e.g. the store was moved, or a saved chat history was
+    loaded without resolving the store's relative location)."""
@@ -0,0 +1,214 @@
+"""
+Opt-in instrumentation of where time is spent preparing images.
+
+kani-vision emits an :class:`ImageEvent` with the duration and size in bytes of each of the following:
+
+- ``encode``: encoding an :class:`.ImagePart`'s binary data (``kind="png"``) or base64 (``kind="b64"``)
+- ``resize``: decoding, resizing, and re-encoding an image before sending it to the OpenAI API
+- ``download``: downloading an image (see :func:`.download_image`)
+- ``metadata_from_url``: reading the metadata of a remote image (see :func:`.image_metadata_from_url`)
+- ``translate_message``: translating a message into the OpenAI format
+
+To receive events, either register a callback with :func:`add_listener` (e.g. an :class:`OpenTelemetryListener`), or
+total them up for a single request with :func:`collect_stats`:
+
+.. code-block:: python
+
+    with collect_stats() as stats:
+        await ai.chat_round("What's in this image?")
+    print(stats.durations["encode"], stats.nbytes["download"])
+
+When there are no listeners and no :func:`collect_stats` scope, instrumentation has near-zero overhead.
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Iterator
+
+ImageEvent = namedtuple("ImageEvent", "name start_time duration nbytes attributes error")
+"""A single image preparation step.
+
+- **name** (*str*): The kind of step (e.g. ``"encode"``).
+- **start_time** (*int*): When the step started, in nanoseconds since the UNIX epoch.
+- **duration** (*float*): How long the step took, in seconds.
+- **nbytes** (*int | None*): The size of the step's output (e.g. the encoded or downloaded data), in bytes, if known.
+- **attributes** (*dict*): Additional information about the step (e.g. the URL of a download).
+- **error** (*BaseException | None*): The exception raised by the step, if it failed.
+"""
+
+_listeners: list[Callable[[ImageEvent], Any]] = []
+_stats = contextvars.ContextVar("_stats", default=None)
+_current_span = contextvars.ContextVar("_current_span", default=None)
+
+
+def add_listener(callback: Callable[[ImageEvent], Any]):
+    """Call the given function with every :class:`ImageEvent`, in any thread. It should return quickly."""
+    _listeners.append(callback)
+
+
+def remove_listener(callback: Callable[[ImageEvent], Any]):
+    """Stop calling a function registered with :func:`add_listener`."""
+    _listeners.remove(callback)
+
+
+def enabled() -> bool:
+    """Whether any events will be recorded in the current context."""
+    return bool(_listeners) or _stats.get() is not None
+
+
+# ==== stats ====
+class ImageStats:
+    """The totals of the :class:`ImageEvent` recorded in a :func:`collect_stats` scope, by event name."""
+
+    def __init__(self):
+        self.counts: dict[str, int] = defaultdict(int)
+        """The number of events."""
+        self.durations: dict[str, float] = defaultdict(float)
+        """The total duration of the events, in seconds. Time spent in nested events (e.g. encoding an image's PNG
+        data to encode its base64) is only counted towards the innermost event, so durations can be summed."""
+        self.nbytes: dict[str, int] = defaultdict(int)
+        """The total size of the events' outputs, in bytes."""
+        self._lock = threading.Lock()
+
+    def record(self, event: ImageEvent, self_duration: float | None = None):
+        with self._lock:
+            self.counts[event.name] += 1
+            self.durations[event.name] += event.duration if self_duration is None else self_duration
+            if event.nbytes is not None:
+                self.nbytes[event.name] += event.nbytes
+
+    def __repr__(self):
+        totals = ", ".join(
+            f"{name}: {count} in {self.durations[name]:.3f}s ({self.nbytes[name]}B)"
+            for name, count in self.counts.items()
+        )
+        return f"ImageStats({totals})"
+
+
+@contextlib.contextmanager
+def collect_stats() -> Iterator[ImageStats]:
+    """Total up the image preparation events in this block, including in any tasks and threads it starts.
+
+    Scopes can be nested; events are recorded in the innermost scope only.
+    """
+    stats = ImageStats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+
+
+def propagate_context(fn: Callable, executor: Executor | None) -> Callable:
+    """If instrumentation is enabled, bind *fn* to the current context so that events it emits when run in the given
+    executor are recorded in the current :func:`collect_stats` scope and parented to the current OpenTelemetry span.
+
+    ``loop.run_in_executor`` does not copy the context like ``asyncio.to_thread`` does. Process pools can't share the
+    context, so functions run in them are returned as-is.
+    """
+    if not enabled() or not (executor is None or isinstance(executor, ThreadPoolExecutor)):
+        return fn
+    ctx = contextvars.copy_context()
+    return lambda *args: ctx.run(fn, *args)
+
+
+# ==== spans ====
+class _Span:
+    __slots__ = ("name", "attributes", "nbytes", "_start_time", "_start", "_child_duration", "_parent", "_token")
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.nbytes = None
+        self._child_duration = 0.0
+
+    def set(self, nbytes: int | None = None, **attributes):
+        if nbytes is not None:
+            self.nbytes = nbytes
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self._start_time = time.time_ns()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+        if self._parent is not None:
+            self._parent._child_duration += duration
+        event = ImageEvent(self.name, self._start_time, duration, self.nbytes, self.attributes, exc_val)
+        if (stats := _stats.get()) is not None:
+            stats.record(event, duration - self._child_duration)
+        for listener in _listeners:
+            listener(event)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, nbytes: int | None = None, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_noop_span = _NoopSpan()
+
+
+def span(name: str, **attributes) -> _Span | _NoopSpan:
+    """Time the enclosed block as an :class:`ImageEvent` with the given name. Use ``span.set(nbytes=...)`` in the block
+    to record the size of its output.
+    """
+    if not _listeners and _stats.get() is None:
+        return _noop_span
+    return _Span(name, attributes)
+
+
+# ==== opentelemetry ====
+class OpenTelemetryListener:
+    """Emit each :class:`ImageEvent` as an OpenTelemetry span (named e.g. ``kani_vision.encode``), as a child of the
+    span that was current when the event ended. Requires ``opentelemetry-api``.
+
+    .. code-block:: python
+
+        add_listener(OpenTelemetryListener())
+    """
+
+    def __init__(self, tracer=None, prefix: str = "kani_vision."):
+        """
+        :param tracer: The OpenTelemetry tracer to create spans with (default a tracer named ``kani.ext.vision``).
+        :param prefix: A prefix to add to each span's name.
+        """
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError(
+                "OpenTelemetryListener requires the OpenTelemetry API. You can install it with `pip install"
+                " opentelemetry-api`."
+            ) from e
+        self.tracer = tracer or trace.get_tracer("kani.ext.vision")
+        self.prefix = prefix
+        self._error_status = trace.Status(trace.StatusCode.ERROR)
+
+    def __call__(self, event: ImageEvent):
+        attributes = {
+            f"kani_vision.{k}": v for k, v in event.attributes.items() if isinstance(v, (str, bool, int, float))
+        }
+        if event.nbytes is not None:
+            attributes["kani_vision.nbytes"] = event.nbytes
+        span = self.tracer.start_span(self.prefix + event.name, start_time=event.start_time, attributes=attributes)
+        if event.error is not None:
+            span.record_exception(event.error)
+            span.set_status(self._error_status)
+        span.end(end_time=event.start_time + int(event.duration * 1e9))
@@ -0,0 +1,195 @@
+import logging
+import pathlib
+
+from kani import ChatMessage, Kani
+from kani.exceptions import MessageTooLong
+from kani.utils.typing import PathLike
+from .blobs import BlobStore, open_blob_store, resolving_blob_stores
+from .cache import IdentityLRUCache
+from .compaction import ImageCompactor, LowDetail
+from .dedup import dedupe_images
+from .parts import ImagePart
+
+log = logging.getLogger(__name__)
+
+
+class VisionKani(Kani):
+    """A :class:`~kani.Kani` with extra context management for images.
+
+    **Image Compaction**
+
+    When the chat history is too long to fit in the context window, a Kani normally drops the oldest messages. Since
+    images are by far the most expensive parts of a message, this Kani first makes the images in the oldest messages
+    cheaper, newest last, until the history fits (as measured by the engine's ``message_len``). Only if it still does
+    not fit are messages dropped.
+
+    Compaction is a ladder of :class:`.ImageCompactor` steps: each step is applied to the oldest messages first, and the
+    next step is only used if the history still does not fit after applying the previous one to every message. By
+    default, images are sent at low detail (see :class:`.LowDetail`), which saves tokens on engines that support image
+    detail levels (e.g. the :class:`~kani.ext.vision.engines.openai.OpenAIVisionEngine`). Engines with a fixed cost per
+    image (e.g. the :class:`~kani.ext.vision.engines.llava.LlavaEngine`) can replace images with a caption instead::
+
+        ai = VisionKani(engine, image_compaction=[LowDetail(), Caption(engine)])
+
+    **Image Deduplication**
+
+    If ``dedupe_images`` is set, images that repeat an earlier image in the prompt (e.g. a re-pasted screenshot) are
+    replaced with a short text back-reference, so each image is only uploaded, counted, and encoded once. Token
+    counting uses the deduplicated messages; if the first occurrence of an image is dropped from the prompt, the next
+    occurrence is sent in full instead.
+
+    **Saving Images**
+
+    Pass a blob store to :meth:`save` to write each image's data to the store once (see :mod:`kani.ext.vision.blobs`)
+    and reference it by content hash in the saved chat history. The store's location is saved relative to the saved
+    file, so they can be moved together. Loading the history does not read any image data; it is memory-mapped from the
+    store when it is needed.
+    """
+
+    def __init__(
+        self,
+        *args,
+        low_detail_fallback: bool = True,
+        image_compaction: list[ImageCompactor] | None = None,
+        dedupe_images: bool = False,
+        near_duplicate_threshold: int | None = None,
+        **kwargs,
+    ):
+        """
+        :param low_detail_fallback: Whether to send images in older messages at low detail rather than dropping
+            messages when the chat history does not fit in the context window. Ignored if *image_compaction* is given.
+        :param image_compaction: The compaction steps to apply to images in older messages, in order, when the chat
+            history does not fit in the context window (default ``[LowDetail()]``, or none if *low_detail_fallback* is
+            False).
+        :param dedupe_images: Whether to replace images that repeat an earlier image in the prompt with a text
+            back-reference (see :func:`.dedupe_images`).
+        :param near_duplicate_threshold: If *dedupe_images* is set, also replace images that are perceptually similar
+            to an earlier image (see :func:`.dedupe_images`).
+        :param kwargs: Any additional arguments to pass to :class:`~kani.Kani`.
+        """
+        super().__init__(*args, **kwargs)
+        if image_compaction is None:
+            image_compaction = [LowDetail()] if low_detail_fallback else []
+        self.image_compaction = image_compaction
+        self.dedupe_images = dedupe_images
+        self.near_duplicate_threshold = near_duplicate_threshold
+        # keep the same compacted copy of each message across rounds so that engines can cache its translation
+        self._compacted_messages = IdentityLRUCache(maxsize=1024)
+
+    def save(self, fp: PathLike, blob_store: BlobStore | PathLike | None = None, **kwargs):
+        """Save the chat state of this kani to a JSON file. This will overwrite the file if it exists!
+
+        :param fp: The path to the file to save.
+        :param blob_store: A :class:`.BlobStore` (or the path to one, see :func:`.open_blob_store`) to write images to.
+            The saved chat state references images in the store by content hash rather than embedding their data.
+        :param kwargs: Additional arguments to pass to Pydantic's ``model_dump_json``.
+        """
+        if blob_store is not None:
+            if not isinstance(blob_store, BlobStore):
+                blob_store = open_blob_store(blob_store)
+            kwargs["context"] = {
+                **kwargs.get("context", {}),
+                "blob_store": blob_store,
+                "blob_store_relative_to": pathlib.Path(fp).absolute().parent,
+            }
+            # messages' parts are typed as MessageParts, so the image parts' own serializer is only used like this
+            kwargs.setdefault("serialize_as_any", True)
+        super().save(fp, **kwargs)
+
+    def load(self, fp: PathLike, blob_store: BlobStore | PathLike | None = None, **kwargs):
+        """Load chat state from a JSON file into this kani. This will overwrite any existing chat state!
+
+        :param fp: The path to the file containing the chat state.
+        :param blob_store: The :class:`.BlobStore` (or the path to one) that the chat state's images were saved to, if it
+            has been moved separately from the file. By default, the store is found relative to the file.
+        :param kwargs: Additional arguments to pass to Pydantic's ``model_validate_json``.
+        """
+        if blob_store is not None and not isinstance(blob_store, BlobStore):
+            blob_store = open_blob_store(blob_store)
+        with resolving_blob_stores(relative_to=pathlib.Path(fp).absolute().parent, store=blob_store):
+            super().load(fp, **kwargs)
+
+    async def get_prompt(self) -> list[ChatMessage]:
+        if not (self.image_compaction or self.dedupe_images):
+            return await super().get_prompt()
+
+        max_size = self.max_context_size - self.always_len
+        history = list(self.chat_history)
+        start = 0
+        while True:
+            window = history[start:]
+            if self.dedupe_images:
+                window = dedupe_images(window, self.near_duplicate_threshold)
+            window, lens = await self._fit_window(window, max_size)
+            to_keep = self._num_to_keep(window, lens, max_size)
+            # if the first occurrence of a repeated image was dropped, its later copies need to be sent again, so
+            # deduplicate what's left and check that it still fits
+            if to_keep == len(window) or not self.dedupe_images:
+                break
+            start += len(window) - to_keep
+
+        log.debug(
+            f"get_prompt() returned {self.always_len + sum(lens[len(lens) - to_keep :])} tokens in"
+            f" {len(self.always_included_messages) + to_keep} messages"
+        )
+        if not to_keep:
+            return self.always_included_messages
+        return self.always_included_messages + window[-to_keep:]
+
+    async def _fit_window(self, window: list[ChatMessage], max_size: int) -> tuple[list[ChatMessage], list[int]]:
+        """Compact the images in the oldest messages until the window fits.
+
+        Returns the new window and the token length of each of its messages.
+        """
+        lens = [self.message_token_len(message) for message in window]
+        total = sum(lens)
+        window = window.copy()
+        for step in self.image_compaction:
+            for idx, message in enumerate(window):
+                if total <= max_size:
+                    return window, lens
+                compacted = await self.compact_message(message, step)
+                if compacted is message:
+                    continue
+                window[idx] = compacted
+                compacted_len = self.message_token_len(compacted)
+                total += compacted_len - lens[idx]
+                lens[idx] = compacted_len
+        return window, lens
+
+    @staticmethod
+    def _num_to_keep(window: list[ChatMessage], lens: list[int], max_size: int) -> int:
+        """Get the number of most recent messages that fit in the context window, like :meth:`.Kani.get_prompt`."""
+        to_keep = 0
+        total_tokens = 0
+        for message, message_len in zip(reversed(window), reversed(lens)):
+            if message_len > max_size:
+                raise MessageTooLong(
+                    "The chat message's size is longer than the allowed context window (after including system"
+                    " messages, always included messages, and desired response tokens).\n"
+                    f"Content: {message.text[:100]}..."
+                )
+            if total_tokens + message_len > max_size:
+                break
+            total_tokens += message_len
+            to_keep += 1
+        return to_keep
+
+    async def compact_message(self, message: ChatMessage, step: ImageCompactor) -> ChatMessage:
+        """Get a copy of the given message with the compaction step applied to each of its images (or the message if
+        the step does not change any of them).
+        """
+        if isinstance(message.content, str) or message.content is None:
+            return message
+        copies = self._compacted_messages.get(message)
+        if copies is None:
+            copies = {}
+            self._compacted_messages.set(message, copies)
+        if step not in copies:
+            parts = [await step.compact(part) if isinstance(part, ImagePart) else part for part in message.parts]
+            # None means unchanged: storing the message in its own cache entry would keep it alive forever
+            if all(new is old for new, old in zip(parts, message.parts)):
+                copies[step] = None
+            else:
+                copies[step] = message.copy_with(parts=parts)
+        return message if copies[step] is None else copies[step]
@@ -1,16 +1,33 @@
 import abc
+import asyncio
 import base64
 import functools
+import hashlib
+import mmap
+import operator
 import pathlib
+import tempfile
+from concurrent.futures import Executor
 from io import BytesIO
+from typing import IO, Iterable, Iterator, Literal
 
 from PIL import Image
-from pydantic import ConfigDict, SkipValidation
+from pydantic import ConfigDict, SerializationInfo, SkipValidation, field_validator, model_serializer
 
 from kani import MessagePart
 from kani.utils.typing import PathLike
-from .exceptions import RemoteImageError
-from .utils import download_image, image_metadata_from_url
+from . import instrumentation
+from .blobs import BlobStore, open_blob_store, relative_location, resolve_location
+from .cache import encoding_cache
+from .exceptions import BlobNotFoundException, RemoteImageError
+from .utils import (
+    ImageMetadata,
+    download_image,
+    image_metadata_from_buffer,
+    image_metadata_from_file,
+    image_metadata_from_url,
+    mime_from_format,
+)
 
 
 class ImagePart(MessagePart, abc.ABC):
@@ -22,24 +39,55 @@ class ImagePart(MessagePart, abc.ABC):
 
     model_config = ConfigDict(ignored_types=(functools.cached_property,))
 
+    detail: Literal["high", "low"] | None = None
+    """The level of detail the model should see this image at, for engines that support it (e.g. GPT-4V).
+    If None, the engine will decide."""
+
     # constructors
     @staticmethod
-    def from_path(fp: PathLike):
-        """Load an image from a path on the local filesystem."""
-        return FileImagePart(path=fp)
+    def from_path(fp: PathLike, memory_map: bool = False, detail: Literal["high", "low"] | None = None):
+        """Load an image from a path on the local filesystem.
+
+        :param memory_map: Whether to memory-map the file rather than reading it each time its data is needed. The file
+            must not be modified while the image part is in use.
+        :param detail: The level of detail the model should see this image at (see :attr:`detail`).
+        """
+        if memory_map:
+            with open(fp, "rb") as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            return BufferImagePart(data=data, detail=detail)
+        return FileImagePart(path=fp, detail=detail)
 
     @staticmethod
-    def from_bytes(data: bytes):
-        """Load an image from binary data in memory."""
-        return BytesImagePart(data=data)
+    def from_bytes(data: bytes | bytearray | memoryview | mmap.mmap, detail: Literal["high", "low"] | None = None):
+        """Load an image from binary data in memory.
+
+        If the data is a mutable buffer (e.g. a :class:`bytearray`, :class:`memoryview`, or :class:`mmap.mmap`), the
+        image part will reference the buffer without copying it, so the buffer must not be modified while the image
+        part is in use.
+
+        :param detail: The level of detail the model should see this image at (see :attr:`detail`).
+        """
+        if isinstance(data, bytes):
+            return BytesImagePart(data=data, detail=detail)
+        return BufferImagePart(data=memoryview(data), detail=detail)
 
     @staticmethod
-    def from_image(image: Image.Image):
-        """Create an image part from an existing :class:`PIL.Image.Image`."""
-        return PillowImagePart(pil_image=image)
+    def from_image(image: Image.Image, detail: Literal["high", "low"] | None = None):
+        """Create an image part from an existing :class:`PIL.Image.Image`.
+
+        :param detail: The level of detail the model should see this image at (see :attr:`detail`).
+        """
+        return PillowImagePart(pil_image=image, detail=detail)
 
     @classmethod
-    async def from_url(cls, url: str, remote: bool = True):
+    async def from_url(
+        cls,
+        url: str,
+        remote: bool = True,
+        spool_max_size: int | None = None,
+        detail: Literal["high", "low"] | None = None,
+    ):
         """Create an image part from a URL.
 
         If *remote* is True, this will not download the image - it will be up to the engine to do so!
@@ -48,13 +96,55 @@ class ImagePart(MessagePart, abc.ABC):
             Note that this classmethod is *asynchronous*, unlike the other classmethods!
 
             This is because we need to check the image headers and metadata before returning a valid image part.
+
+        :param spool_max_size: If *remote* is False and this is set, download the image to a
+            :class:`tempfile.SpooledTemporaryFile` which is kept in memory until it is larger than this many bytes, then
+            moved to disk. The image's data will only be read from the file when needed.
+        :param detail: The level of detail the model should see this image at (see :attr:`detail`).
         """
         if not remote:
+            if spool_max_size is not None:
+                f = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+                try:
+                    await download_image(url, f)
+                except BaseException:
+                    f.close()
+                    raise
+                return TempFileImagePart(file=f, detail=detail)
             io = BytesIO()
             await download_image(url, io)
-            return BytesImagePart(data=io.getvalue())
+            return BytesImagePart(data=io.getvalue(), detail=detail)
         size, mime = await image_metadata_from_url(url)
-        return RemoteURLImagePart(url=url, size_=size, mime_=mime)
+        return RemoteURLImagePart(url=url, size_=size, mime_=mime, detail=detail)
+
+    @classmethod
+    async def from_urls(
+        cls,
+        urls: Iterable[str],
+        remote: bool = True,
+        concurrency: int = 8,
+        on_error: Literal["raise", "return", "skip"] = "raise",
+        spool_max_size: int | None = None,
+        detail: Literal["high", "low"] | None = None,
+    ) -> list["ImagePart | BaseException"]:
+        """Create image parts from multiple URLs concurrently, in the same order as the given URLs.
+
+        See :meth:`from_url` for details on the *remote*, *spool_max_size*, and *detail* arguments.
+
+        :param concurrency: The maximum number of URLs to fetch at once.
+        :param on_error: What to do if any URL fails to load: ``"raise"`` the first exception, ``"return"`` the
+            exception in place of the image part, or ``"skip"`` the URL (i.e., the returned list will be shorter).
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def load_one(url):
+            async with semaphore:
+                return await cls.from_url(url, remote=remote, spool_max_size=spool_max_size, detail=detail)
+
+        results = await asyncio.gather(*(load_one(url) for url in urls), return_exceptions=on_error != "raise")
+        if on_error == "skip":
+            return [result for result in results if not isinstance(result, BaseException)]
+        return results
 
     # interface
     @property
@@ -62,28 +152,88 @@ class ImagePart(MessagePart, abc.ABC):
         """Get a :class:`PIL.Image.Image` representing the image."""
         raise NotImplementedError
 
-    @property
+    @functools.cached_property
     def bytes(self) -> bytes:
         """The binary image data."""
-        io = BytesIO()
-        self.image.save(io, format="PNG")
-        return io.getvalue()
+        return self._cached_encoding("png", self._encode_png)
 
-    @property
+    @functools.cached_property
     def b64(self) -> str:
         """The binary image data encoded in a base64 string.
 
         Note that this is *not* a web-suitable ``data:image/...`` string; just the raw binary of the image. Use
         :attr:`b64_uri` for a web-suitable string.
         """
-        return base64.b64encode(self.bytes).decode()
+        return self._cached_encoding("b64", lambda: "".join(self.iter_b64()))
 
     @property
     def b64_uri(self) -> str:
         """Get the binary image data encoded in a web-suitable base64 string."""
         return f"data:{self.mime};base64,{self.b64}"
 
+    def iter_b64_uri(self, chunk_size: int = 768 * 1024) -> Iterator[str]:
+        """Like :attr:`b64_uri`, but yields the web-suitable base64 string in chunks rather than building it in memory.
+
+        See :meth:`iter_b64`.
+        """
+        yield f"data:{self.mime};base64,"
+        # if we've already encoded this image, just reuse that
+        if "b64" in self.__dict__:
+            b64 = self.b64
+            for start in range(0, len(b64), chunk_size):
+                yield b64[start : start + chunk_size]
+        else:
+            yield from self.iter_b64(chunk_size)
+
+    @property
+    def buffer(self) -> memoryview:
+        """A read-only view of the binary image data. Unlike :attr:`bytes`, this avoids copying the data if possible."""
+        return memoryview(self.bytes)
+
+    def iter_b64(self, chunk_size: int = 768 * 1024) -> Iterator[str]:
+        """Encode the binary image data in base64, yielding the encoded string in chunks.
+
+        This encodes directly from :attr:`buffer`, so only one chunk of encoded data is in memory at a time.
+
+        :param chunk_size: The number of bytes of image data to encode per chunk (rounded down to a multiple of 3).
+        """
+        buf = self.buffer.cast("B")
+        chunk_size -= chunk_size % 3
+        for start in range(0, len(buf), chunk_size):
+            yield base64.b64encode(buf[start : start + chunk_size]).decode()
+
+    # async
+    async def aimage(self, executor: Executor | None = None) -> Image.Image:
+        """Like :attr:`image`, but loads the image in an executor rather than blocking the event loop.
+
+        :param executor: The executor to load the image in (default the event loop's default thread pool). A
+            :class:`~concurrent.futures.ProcessPoolExecutor` may be used for any part that can be pickled (i.e. not
+            buffer- or temporary file-backed parts).
+        """
+        return await self._run_in_executor("image", executor)
+
+    async def abytes(self, executor: Executor | None = None) -> bytes:
+        """Like :attr:`bytes`, but encodes the image in an executor rather than blocking the event loop.
+
+        See :meth:`aimage`.
+        """
+        return await self._run_in_executor("bytes", executor)
+
+    async def aencode(self, executor: Executor | None = None) -> str:
+        """Like :attr:`b64`, but encodes the image in an executor rather than blocking the event loop.
+
+        The result is memoized, so accessing :attr:`b64` or :attr:`b64_uri` afterwards is free. See :meth:`aimage`.
+        """
+        return await self._run_in_executor("b64", executor)
+
     # metadata
+    @functools.cached_property
+    def content_hash(self) -> str:
+        """A hex digest of the image's binary data. Two parts containing the same image have the same hash."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self.buffer)
+        return h.hexdigest()
+
     @property
     def size(self) -> tuple[int, int]:
         """Get the size of the image, in pixels."""
@@ -92,8 +242,65 @@ class ImagePart(MessagePart, abc.ABC):
     @property
     def mime(self) -> str:
         """Get the MIME filetype of the image."""
-        img_format = self.image.format
-        return Image.MIME.get(img_format, f"image/{img_format.lower()}")
+        return mime_from_format(self.image.format)
+
+    # serialization
+    @model_serializer(mode="wrap")
+    def _serialize(self, nxt, info: SerializationInfo):
+        """If a blob store is given in the serialization context (``context={"blob_store": store}``), write the image
+        data to the store and serialize this part as a reference to it (see :class:`BlobImagePart`). If a directory is
+        also given (``"blob_store_relative_to"``), the store's location is saved relative to it.
+        """
+        store = info.context.get("blob_store") if isinstance(info.context, dict) else None
+        if store is None:
+            return MessagePart._serialize(self, nxt)
+        data = self.to_blob(store).model_dump(mode=info.mode)
+        if (relative_to := info.context.get("blob_store_relative_to")) is not None and "store" in data:
+            data["store"] = relative_location(store, relative_to)
+        return data
+
+    def to_blob(self, store: BlobStore) -> "ImagePart":
+        """Write the image data to the given blob store, and return a :class:`BlobImagePart` referencing it.
+
+        Images that are already in the store, and remote images (which are referenced by URL), are returned as-is.
+        """
+        return BlobImagePart(blob=store.put(self.buffer), store=store.location, detail=self.detail)
+
+    # helpers
+    def _encode_png(self) -> bytes:
+        io = BytesIO()
+        self.image.save(io, format="PNG")
+        return io.getvalue()
+
+    def _cached_encoding(self, kind: str, encoder):
+        """Get an encoded form of this image from the process-wide :data:`.encoding_cache`, or encode it if needed.
+
+        Encodings are also memoized on each part, so this is only called once per part and encoding kind.
+        """
+        # the default content hash is computed from the PNG data, so it can't be used to look the PNG data up
+        hash_needs_png = type(self).content_hash is ImagePart.content_hash and "content_hash" not in self.__dict__
+        if not encoding_cache.enabled or (kind == "png" and hash_needs_png):
+            return self._encode(kind, encoder)
+        return encoding_cache.get_or_compute((self.content_hash, kind), lambda: self._encode(kind, encoder))
+
+    @staticmethod
+    def _encode(kind: str, encoder):
+        with instrumentation.span("encode", kind=kind) as span:
+            data = encoder()
+            span.set(nbytes=len(data))
+        return data
+
+    async def _run_in_executor(self, attr: str, executor: Executor | None):
+        """Get the given attribute of this part in an executor, memoizing it on this part if it is memoizable."""
+        if attr in self.__dict__:
+            return self.__dict__[attr]
+        loop = asyncio.get_running_loop()
+        getter = instrumentation.propagate_context(operator.attrgetter(attr), executor)
+        value = await loop.run_in_executor(executor, getter, self)
+        # if this ran in another process, the memoized value is not set on this copy of the part
+        if isinstance(getattr(type(self), attr, None), functools.cached_property):
+            value = self.__dict__.setdefault(attr, value)
+        return value
 
 
 class FileImagePart(ImagePart):
@@ -113,6 +320,33 @@ class FileImagePart(ImagePart):
         with open(self.path, "rb") as f:
             return f.read()
 
+    @property
+    def buffer(self):
+        with open(self.path, "rb") as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @functools.cached_property
+    def content_hash(self):
+        h = hashlib.blake2b(digest_size=20)
+        with open(self.path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @functools.cached_property
+    def metadata(self) -> ImageMetadata:
+        """The size and MIME type of the image, read once from the file's header."""
+        with open(self.path, "rb") as f:
+            return image_metadata_from_file(f)
+
+    @property
+    def size(self):
+        return self.metadata.size
+
+    @property
+    def mime(self):
+        return self.metadata.mime
+
 
 class BytesImagePart(ImagePart):
     """An image whose data lives in memory.
@@ -130,6 +364,98 @@ class BytesImagePart(ImagePart):
     def bytes(self):
         return self.data
 
+    @functools.cached_property
+    def metadata(self) -> ImageMetadata:
+        """The size and MIME type of the image, read once from the image's header."""
+        return image_metadata_from_file(BytesIO(self.data))
+
+    @property
+    def size(self):
+        return self.metadata.size
+
+    @property
+    def mime(self):
+        return self.metadata.mime
+
+
+class BufferImagePart(ImagePart, arbitrary_types_allowed=True):
+    """An image whose data lives in a buffer in memory (e.g. a :class:`bytearray` or memory-mapped file), which is
+    referenced without copying.
+
+    Use :meth:`.ImagePart.from_bytes` or :meth:`.ImagePart.from_path` with ``memory_map=True`` to construct.
+    """
+
+    data: SkipValidation[memoryview]
+
+    @property
+    def image(self):
+        return Image.open(BytesIO(self.data))
+
+    @property
+    def bytes(self):
+        return self.data.tobytes()
+
+    @property
+    def buffer(self):
+        return self.data
+
+    @functools.cached_property
+    def metadata(self) -> ImageMetadata:
+        """The size and MIME type of the image, read once from the image's header."""
+        return image_metadata_from_buffer(self.data)
+
+    @property
+    def size(self):
+        return self.metadata.size
+
+    @property
+    def mime(self):
+        return self.metadata.mime
+
+    def __hash__(self):
+        # writable memoryviews aren't hashable, but messages containing this part need to be (e.g. to cache their length)
+        return hash((self.content_hash, self.detail))
+
+
+class TempFileImagePart(ImagePart, arbitrary_types_allowed=True):
+    """An image whose data lives in a temporary file, which is only read when the image's data is needed.
+
+    Use :meth:`.ImagePart.from_url` with ``spool_max_size`` to construct.
+    """
+
+    file: SkipValidation[IO[bytes]]
+
+    @property
+    def image(self):
+        return Image.open(BytesIO(self.bytes))
+
+    @property
+    def bytes(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    @functools.cached_property
+    def content_hash(self):
+        h = hashlib.blake2b(digest_size=20)
+        self.file.seek(0)
+        while chunk := self.file.read(1024 * 1024):
+            h.update(chunk)
+        return h.hexdigest()
+
+    @functools.cached_property
+    def metadata(self) -> ImageMetadata:
+        """The size and MIME type of the image, read once from the image's header."""
+        self.file.seek(0)
+        return image_metadata_from_file(self.file)
+
+    @property
+    def size(self):
+        return self.metadata.size
+
+    @property
+    def mime(self):
+        return self.metadata.mime
+
 
 class PillowImagePart(ImagePart, arbitrary_types_allowed=True):
     """An image represented by a Pillow Image.
@@ -143,6 +469,25 @@ class PillowImagePart(ImagePart, arbitrary_types_allowed=True):
     def image(self):
         return self.pil_image
 
+    @functools.cached_property
+    def content_hash(self):
+        # hash the raw pixel data rather than encoding to PNG first
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{self.pil_image.mode}:{self.pil_image.size}:".encode())
+        if palette := self.pil_image.getpalette():
+            h.update(bytes(palette))
+        h.update(self.pil_image.tobytes())
+        return h.hexdigest()
+
+    @property
+    def mime(self):
+        # the binary data of a Pillow image is always encoded as a PNG
+        return "image/png"
+
+    def __hash__(self):
+        # Pillow images aren't hashable, but messages containing this part need to be (e.g. to cache their length)
+        return hash((self.content_hash, self.detail))
+
 
 class RemoteURLImagePart(ImagePart):
     """A reference to a remote image stored at the given URL.
@@ -161,6 +506,13 @@ class RemoteURLImagePart(ImagePart):
             " the image before using it in this engine."
         )
 
+    @functools.cached_property
+    def content_hash(self):
+        return hashlib.blake2b(self.url.encode(), digest_size=20).hexdigest()
+
+    def to_blob(self, store):
+        return self
+
     @property
     def size(self):
         return self.size_
@@ -168,3 +520,66 @@ class RemoteURLImagePart(ImagePart):
     @property
     def mime(self):
         return self.mime_
+
+
+class BlobImagePart(ImagePart):
+    """An image whose data lives in a content-addressed :class:`.BlobStore`, referenced by its content hash.
+
+    The data is memory-mapped from the store when it is needed, so loading a saved chat history containing these
+    parts does not read any image data. Saving a chat history with a blob store converts images to this type (see
+    :meth:`.ImagePart.to_blob`).
+    """
+
+    blob: str
+    """The key of the image data in the store, which is also its content hash."""
+    store: str
+    """The location of the blob store (see :func:`.open_blob_store`). In a saved chat history, this is relative to the
+    saved file; it is resolved to an absolute location when the history is loaded (see :meth:`.VisionKani.load`).
+    """
+
+    # noinspection PyNestedDecorators
+    @field_validator("store")
+    @classmethod
+    def _resolve_store(cls, v: str) -> str:
+        return resolve_location(v)
+
+    @property
+    def image(self):
+        return Image.open(BytesIO(self.buffer))
+
+    @property
+    def bytes(self):
+        return self.buffer.tobytes()
+
+    @property
+    def buffer(self):
+        try:
+            return open_blob_store(self.store).get(self.blob)
+        except KeyError:
+            raise BlobNotFoundException(
+                f"The image {self.blob!r} was not found in the blob store at {self.store!r}. If this is from a chat history"
+                " saved with a blob store, load it with `VisionKani.load()`, which resolves the store's location relative"
+                " to the saved file (or pass `blob_store=...` if the store was moved separately)."
+            ) from None
+
+    @property
+    def content_hash(self):
+        return self.blob
+
+    @functools.cached_property
+    def metadata(self) -> ImageMetadata:
+        """The size and MIME type of the image, read once from the image's header."""
+        return image_metadata_from_buffer(self.buffer)
+
+    @property
+    def size(self):
+        return self.metadata.size
+
+    @property
+    def mime(self):
+        return self.metadata.mime
+
+    def to_blob(self, store):
+        if self.store == store.location:
+            return self
+        return super().to_blob(store)
@@ -1,39 +1,589 @@
+import asyncio
+import hashlib
 import logging
+import mmap
+import os
+import pathlib
+import re
+import struct
+import tempfile
+import time
+import weakref
 from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from io import BytesIO
 from typing import IO
 
 import aiohttp
-from PIL import ImageFile
+from PIL import Image, ImageFile
 
-from .exceptions import ImageFormatException
+from kani.models import BaseModel
+from kani.utils.typing import PathLike
+from . import instrumentation
+from .exceptions import ImageFormatException, ImageMetadataException
 
 log = logging.getLogger(__name__)
 
 ImageMetadata = namedtuple("ImageMetadata", "size mime")
 
+# ==== http ====
+_http: aiohttp.ClientSession | None = None
+_http_loop: asyncio.AbstractEventLoop | None = None
+_http_config = dict(limit=100, limit_per_host=8, keepalive_timeout=30, timeout=60)
+_http_users = weakref.WeakSet()
 
-async def download_image(url: str, f: IO):
-    """Download the image at the given URL to the given file-like object."""
+
+def configure_http_session(
+    *,
+    limit: int = 100,
+    limit_per_host: int = 8,
+    keepalive_timeout: float = 30,
+    timeout: float | None = 60,
+):
+    """Configure the shared connection pool used to download images and read their metadata.
+
+    The new configuration is used the next time the pool is created (i.e., after :func:`close_http_session`).
+
+    :param limit: The maximum number of simultaneous connections.
+    :param limit_per_host: The maximum number of simultaneous connections to a single host.
+    :param keepalive_timeout: How long to keep idle connections open for reuse, in seconds.
+    :param timeout: The total timeout of each request, in seconds (None for no timeout).
+    """
+    _http_config.update(
+        limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive_timeout, timeout=timeout
+    )
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Get the shared :class:`aiohttp.ClientSession` used to download images, creating it if necessary.
+
+    Reusing this session keeps connections alive between requests, so fetching multiple images from the same host
+    (or reading an image's metadata and then downloading it) only pays for one TCP/TLS handshake.
+    """
+    global _http, _http_loop
+    loop = asyncio.get_running_loop()
+    # sessions are bound to the event loop they were created in
+    if _http is None or _http.closed or _http_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=_http_config["limit"],
+            limit_per_host=_http_config["limit_per_host"],
+            keepalive_timeout=_http_config["keepalive_timeout"],
+        )
+        _http = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=_http_config["timeout"]))
+        _http_loop = loop
+    return _http
+
+
+def use_http_session(user):
+    """Register an object (e.g. an engine) as a user of the shared connection pool, so that the pool is kept open until
+    every registered user has called :func:`release_http_session`. Vision engines register themselves when they are
+    created.
+    """
+    _http_users.add(user)
+
+
+async def release_http_session(user):
+    """Unregister a user added with :func:`use_http_session`, and close the shared connection pool if it was the last
+    one. Vision engines call this when they are closed.
+    """
+    _http_users.discard(user)
+    if not _http_users:
+        await close_http_session()
+
+
+async def close_http_session():
+    """Close the shared connection pool now, regardless of its users (e.g. when shutting down). Any requests in flight
+    are aborted; the pool is recreated the next time it is used.
+    """
+    global _http, _http_loop
+    if _http is None:
+        return
+    # a session from a different (likely closed) event loop can't be closed from here; just drop it
+    if _http_loop is asyncio.get_running_loop():
+        await _http.close()
+    _http = None
+    _http_loop = None
+
+
+# ==== metadata ====
+
+
+def mime_from_format(img_format: str) -> str:
+    """Get the MIME type of the given Pillow image format (e.g. "PNG" -> "image/png")."""
+    return Image.MIME.get(img_format, f"image/{img_format.lower()}")
+
+
+def image_metadata_from_file(f: IO[bytes]) -> ImageMetadata:
+    """Read the header of a seekable binary image file to get its dimensions and type without decoding the image.
+
+    Pillow opens images lazily, so this only reads as much of the file as it needs to parse the header.
+    """
+    with Image.open(f) as img:
+        return ImageMetadata(size=img.size, mime=mime_from_format(img.format))
+
+
+def image_metadata_from_buffer(buf: memoryview, max_prefix: int = 64 * 1024) -> ImageMetadata:
+    """Read the header of an image in a buffer to get its dimensions and type without copying or decoding the image.
+
+    :param max_prefix: The maximum number of bytes to parse incrementally. Images whose header can't be parsed from
+        a prefix of the data (e.g. WEBP) are copied and opened with Pillow instead.
+    """
+    buf = buf.cast("B")
+    p = ImageFile.Parser()
+    # the parser re-parses all the data fed so far until it succeeds, so feed a few growing chunks rather than many
+    # small ones
+    start = 0
+    chunk_size = 1024
+    while start < min(len(buf), max_prefix):
+        p.feed(bytes(buf[start : start + chunk_size]))
+        if p.image:
+            return ImageMetadata(size=p.image.size, mime=mime_from_format(p.image.format))
+        start += chunk_size
+        chunk_size *= 4
+    if (size := webp_size(bytes(buf[:30]))) is not None:
+        return ImageMetadata(size=size, mime="image/webp")
+    return image_metadata_from_file(BytesIO(buf))
+
+
+def webp_size(header: bytes) -> tuple[int, int] | None:
+    """Read the dimensions of a WEBP image from its first 30 bytes, or None if it is not a WEBP image.
+
+    Pillow can only parse WEBP images once it has the whole file, so this reads the RIFF header directly.
+    """
+    if len(header) < 30 or header[:4] != b"RIFF" or header[8:12] != b"WEBP":
+        return None
+    chunk = header[12:16]
+    # lossy: a VP8 key frame header, with 14-bit dimensions
+    if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack_from("<HH", header, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    # lossless: 14-bit dimensions minus one, packed after the signature byte
+    if chunk == b"VP8L" and header[20] == 0x2F:
+        (bits,) = struct.unpack_from("<I", header, 21)
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    # extended: 24-bit canvas dimensions minus one
+    if chunk == b"VP8X":
+        return int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+    return None
+
+
+def download_chunk_size(content_length: int | None) -> int:
+    """Choose how many bytes to read at a time when downloading a response of the given length.
+
+    Larger images are read in larger chunks (up to 1MiB) to reduce per-chunk overhead.
+    """
+    if content_length is None:
+        return 64 * 1024
+    return min(max(content_length // 16, 16 * 1024), 1024 * 1024)
+
+
+async def download_image(url: str, f: IO, session: aiohttp.ClientSession = None):
+    """Download the image at the given URL to the given file-like object.
+
+    :param session: The aiohttp session to use (defaults to the shared session; see :func:`get_http_session`).
+    :raises aiohttp.ClientResponseError: The server responded with an error status.
+    """
     log.debug(f"Downloading image url: {url}")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            mime = resp.content_type
-            if not mime.lower().startswith("image"):
-                raise ImageFormatException(f"Expected an image/* MIME type, got {mime!r}")
-            async for chunk in resp.content.iter_chunked(4096):
-                f.write(chunk)
+    with instrumentation.span("download", url=url) as span:
+        source, nbytes = await _download_image(url, f, session or get_http_session())
+        span.set(nbytes=nbytes, source=source)
+
+
+async def _download_image(url: str, f: IO, session: aiohttp.ClientSession) -> tuple[str, int | None]:
+    """Download the image; return where it came from ("cache", "revalidated", or "network") and its size in bytes."""
+    # check the disk cache first, and revalidate the cached image if it is stale
+    headers = {}
+    cache = _disk_cache
+    entry = cache.get(url) if cache is not None else None
+    if entry is not None and entry.nbytes is not None:
+        if entry.is_fresh and cache.copy_body(url, f):
+            log.debug(f"Using cached image for url: {url}")
+            return "cache", entry.nbytes
+        headers = entry.revalidation_headers()
 
+    async with session.get(url, headers=headers) as resp:
+        if resp.status != 304:
+            return "network", await _read_image_response(url, resp, f, cache)
+        if entry is not None and cache.copy_body(url, f):
+            log.debug(f"Revalidated cached image for url: {url}")
+            cache.refresh(url, resp.headers)
+            return "revalidated", entry.nbytes
+    # the cached image is still valid, but its data is gone (e.g. evicted by another process), so download it again
+    log.debug(f"Cached image for url was removed during revalidation, downloading again: {url}")
+    async with session.get(url) as resp:
+        return "network", await _read_image_response(url, resp, f, cache)
+
+
+async def _read_image_response(url: str, resp: aiohttp.ClientResponse, f: IO, cache: "DiskImageCache | None") -> int:
+    """Write the image in the response to the file (and the disk cache, if possible); return its size in bytes."""
+    # error pages can have image content types too (e.g. a CDN's placeholder image), so never read them as the image
+    resp.raise_for_status()
+    _check_image_mime(resp.content_type)
+    chunk_size = download_chunk_size(resp.content_length)
+    nbytes = 0
+    if cache is None or not DiskImageCache.is_cacheable(resp.headers):
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            f.write(chunk)
+            nbytes += len(chunk)
+        return nbytes
+    # tee the download into the cache
+    with cache.body_writer(url, resp.content_type, resp.headers) as cache_f:
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            f.write(chunk)
+            cache_f.write(chunk)
+            nbytes += len(chunk)
+    return nbytes
+
+
+async def image_metadata_from_url(
+    url: str, session: aiohttp.ClientSession = None, *, max_bytes: int = 1024 * 1024, head: bool = False
+) -> ImageMetadata:
+    """Read the first few bytes of an image file to get its dimensions without downloading the entire image.
+
+    This uses HTTP range requests of increasing size to read only as much of the image as needed to parse its header.
+    If the server ignores range requests, this streams the image instead and closes the connection as soon as the
+    header is parsed.
+
+    :param session: The aiohttp session to use (defaults to the shared session; see :func:`get_http_session`).
+    :param max_bytes: The maximum number of bytes of the image to read.
+    :param head: Whether to send a HEAD request first to check the MIME type of the URL before reading any data.
+    :raises ImageFormatException: The URL does not point to an image.
+    :raises ImageMetadataException: The image's header could not be parsed within the first *max_bytes* bytes.
+    :raises aiohttp.ClientResponseError: The server responded with an error status.
+    """
+    with instrumentation.span("metadata_from_url", url=url) as span:
+        cache = _disk_cache
+        if cache is not None and (metadata := cache.get_metadata(url)) is not None:
+            span.set(source="cache")
+            return metadata
+        metadata, headers = await _probe_metadata(url, session, max_bytes=max_bytes, head=head)
+        span.set(source="network")
+        if cache is not None and DiskImageCache.is_cacheable(headers):
+            cache.put_metadata(url, metadata, headers)
+        return metadata
+
+
+async def _probe_metadata(url: str, session: aiohttp.ClientSession | None, max_bytes: int, head: bool):
+    session = session or get_http_session()
+    if head:
+        async with session.head(url, allow_redirects=True) as resp:
+            resp.raise_for_status()
+            _check_image_mime(resp.content_type)
 
-async def image_metadata_from_url(url: str) -> ImageMetadata:
-    """Read the first few bytes of an image file to get its dimensions without downloading the entire image."""
     p = ImageFile.Parser()
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            mime = resp.content_type
-            if not mime.lower().startswith("image"):
-                raise ImageFormatException(f"Expected an image/* MIME type, got {mime!r}")
-            async for chunk in resp.content.iter_chunked(256):
-                p.feed(chunk)
-                if p.image:
-                    return ImageMetadata(size=p.image.size, mime=mime)
-    return ImageMetadata(size=None, mime=mime)
+    # the first bytes of the image, for formats that the parser can't read from a prefix (i.e. WEBP)
+    header = b""
+    start = 0
+    range_size = 2048
+    while start < max_bytes:
+        end = min(start + range_size, max_bytes) - 1
+        async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as resp:
+            # the range starts past the end of the file
+            if resp.status == 416:
+                break
+            resp.raise_for_status()
+            mime = _check_image_mime(resp.content_type)
+            # the server supports ranges: feed this range and request a larger one if needed
+            if resp.status == 206:
+                data = await resp.read()
+                p.feed(data)
+                header = (header + data)[:30]
+                size = p.image.size if p.image else webp_size(header)
+                if size is not None:
+                    return ImageMetadata(size=size, mime=mime), resp.headers
+                # the server sent less than we asked for, so we're at the end of the file
+                if len(data) < end - start + 1:
+                    break
+                start = end + 1
+                range_size *= 4
+                continue
+            # otherwise the server ignored the range and is sending the whole image from the start
+            log.debug(f"Server ignored range request for {url}, streaming up to {max_bytes} bytes")
+            p = ImageFile.Parser()
+            read = 0
+            async for chunk in resp.content.iter_chunked(4096):
+                p.feed(chunk[: max_bytes - read])
+                read += len(chunk)
+                header = (header + chunk)[:30]
+                size = p.image.size if p.image else webp_size(header)
+                if size is not None:
+                    # don't bother reading the rest of the body
+                    resp.close()
+                    return ImageMetadata(size=size, mime=mime), resp.headers
+                if read >= max_bytes:
+                    resp.close()
+                    break
+            break
+    raise ImageMetadataException(f"Could not read the size of the image at {url} within the first {max_bytes} bytes.")
+
+
+def _check_image_mime(mime: str) -> str:
+    if not mime.lower().startswith("image"):
+        raise ImageFormatException(f"Expected an image/* MIME type, got {mime!r}")
+    return mime
+
+
+# ==== disk cache ====
+_disk_cache: "DiskImageCache | None" = None
+
+
+def set_disk_cache(cache: "DiskImageCache | None"):
+    """Set the disk cache used by :func:`download_image` and :func:`image_metadata_from_url` (None to disable)."""
+    global _disk_cache
+    _disk_cache = cache
+
+
+def get_disk_cache() -> "DiskImageCache | None":
+    """Get the disk cache set by :func:`set_disk_cache`, if any."""
+    return _disk_cache
+
+
+class DiskCacheEntry(BaseModel):
+    """The metadata about a single URL stored in a :class:`DiskImageCache`."""
+
+    url: str
+    mime: str
+    size: tuple[int, int] | None = None
+    nbytes: int | None = None
+    """The size of the cached image data, or None if only the metadata is cached."""
+    etag: str | None = None
+    last_modified: str | None = None
+    expires: float = 0
+    """The UNIX timestamp after which the entry must be revalidated."""
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def revalidation_headers(self) -> dict[str, str]:
+        """The headers to send to conditionally request the URL, if it has changed since it was cached."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class DiskImageCache:
+    """A persistent, size-bounded cache of downloaded images and their metadata, keyed by URL.
+
+    Each URL is stored as a JSON entry file and (if downloaded) a body file containing the image data. Entries are
+    considered fresh for as long as the server's ``Cache-Control: max-age`` (or *default_ttl* seconds if the server does
+    not send one) and are revalidated with the server's ``ETag``/``Last-Modified`` headers once stale. When the cache
+    exceeds *max_bytes*, the least recently used images are evicted.
+
+    .. code-block:: python
+
+        from kani.ext.vision.utils import DiskImageCache, set_disk_cache
+
+        set_disk_cache(DiskImageCache("~/.cache/kani-vision"))
+    """
+
+    def __init__(self, directory: PathLike, max_bytes: int = 1024 * 1024 * 1024, default_ttl: float = 0):
+        """
+        :param directory: The directory to store cached images in. It will be created if it does not exist.
+        :param max_bytes: The maximum total size of the cached image data, in bytes (default 1GiB).
+        :param default_ttl: How long to consider a cached image fresh if the server does not specify, in seconds.
+        """
+        self.directory = pathlib.Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        # key -> size of the body file; the entry files' mtimes are used as access times
+        self._sizes: dict[str, int] = {}
+        for fp in self.directory.glob("*.bin"):
+            self._sizes[fp.stem] = fp.stat().st_size
+
+    # ==== paths ====
+    @staticmethod
+    def key(url: str) -> str:
+        """The key that the given URL is stored under."""
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.json"
+
+    def body_path(self, url: str) -> pathlib.Path | None:
+        """Get the path to the cached image data for the given URL, if it is cached."""
+        key = self.key(url)
+        fp = self.directory / f"{key}.bin"
+        # check the disk rather than our own index, since another process (or cache object) may share the directory
+        try:
+            nbytes = fp.stat().st_size
+        except FileNotFoundError:
+            self._sizes.pop(key, None)
+            return None
+        self._sizes[key] = nbytes
+        return fp
+
+    # ==== read ====
+    def get(self, url: str) -> DiskCacheEntry | None:
+        """Get the cache entry for the given URL, if it is cached."""
+        fp = self._entry_path(self.key(url))
+        try:
+            entry = DiskCacheEntry.model_validate_json(fp.read_bytes())
+        except (FileNotFoundError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(fp)
+        return entry
+
+    def get_metadata(self, url: str) -> ImageMetadata | None:
+        """Get the metadata of the image at the given URL, if it is cached and fresh."""
+        entry = self.get(url)
+        if entry is None or not entry.is_fresh:
+            return None
+        if entry.size is None:
+            # we have the body but haven't read its header yet
+            if (mm := self.open_body(url)) is None:
+                return None
+            with mm:
+                metadata = image_metadata_from_file(mm)
+            self._write_entry(entry.copy_with(size=metadata.size))
+            return ImageMetadata(size=metadata.size, mime=entry.mime)
+        return ImageMetadata(size=tuple(entry.size), mime=entry.mime)
+
+    def open_body(self, url: str) -> mmap.mmap | None:
+        """Get a read-only memory map of the cached image data for the given URL, if it is cached.
+
+        The caller is responsible for closing the returned map.
+        """
+        fp = self.body_path(url)
+        if fp is None:
+            return None
+        try:
+            with open(fp, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):  # ValueError: empty file
+            return None
+
+    def copy_body(self, url: str, f: IO) -> bool:
+        """Write the cached image data for the given URL to the file-like object. Returns whether the data was cached."""
+        if (mm := self.open_body(url)) is None:
+            return False
+        with mm:
+            f.write(mm)
+        return True
+
+    # ==== write ====
+    @staticmethod
+    def is_cacheable(headers) -> bool:
+        """Whether a response with the given headers may be stored."""
+        return "no-store" not in headers.get("Cache-Control", "")
+
+    def put_metadata(self, url: str, metadata: ImageMetadata, headers):
+        """Store the metadata of the image at the given URL."""
+        entry = self.get(url)
+        if entry is not None and self._is_same_version(entry, headers):
+            entry = entry.copy_with(size=metadata.size, mime=metadata.mime, expires=self._expires(headers))
+        else:
+            entry = self._new_entry(url, metadata.mime, headers).copy_with(size=metadata.size)
+            self._remove_body(self.key(url))
+        self._write_entry(entry)
+
+    @staticmethod
+    def _is_same_version(entry: DiskCacheEntry, headers) -> bool:
+        return (entry.etag is not None and entry.etag == headers.get("ETag")) or (
+            entry.last_modified is not None and entry.last_modified == headers.get("Last-Modified")
+        )
+
+    def refresh(self, url: str, headers):
+        """Mark the entry for the given URL as fresh after a successful revalidation."""
+        if (entry := self.get(url)) is not None:
+            self._write_entry(entry.copy_with(expires=self._expires(headers)))
+
+    def body_writer(self, url: str, mime: str, headers) -> "_CacheBodyWriter":
+        """Get a context manager returning a file to write the image data for the given URL to.
+
+        The data is only added to the cache if the context manager exits without an exception.
+        """
+        return _CacheBodyWriter(self, self._new_entry(url, mime, headers))
+
+    def _commit_body(self, tmp_path: pathlib.Path, entry: DiskCacheEntry):
+        key = self.key(entry.url)
+        nbytes = tmp_path.stat().st_size
+        os.replace(tmp_path, self.directory / f"{key}.bin")
+        self._sizes[key] = nbytes
+        self._write_entry(entry.copy_with(nbytes=nbytes))
+        self.evict()
+
+    def _new_entry(self, url: str, mime: str, headers) -> DiskCacheEntry:
+        return DiskCacheEntry(
+            url=url,
+            mime=mime,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            expires=self._expires(headers),
+        )
+
+    def _expires(self, headers) -> float:
+        cache_control = headers.get("Cache-Control", "")
+        if "no-cache" in cache_control:
+            return 0
+        if match := re.search(r"max-age=(\d+)", cache_control):
+            return time.time() + int(match[1])
+        if expires := headers.get("Expires"):
+            try:
+                return parsedate_to_datetime(expires).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return time.time() + self.default_ttl
+
+    def _write_entry(self, entry: DiskCacheEntry):
+        fp = self._entry_path(self.key(entry.url))
+        tmp = fp.with_suffix(".json.tmp")
+        tmp.write_text(entry.model_dump_json())
+        os.replace(tmp, fp)
+
+    # ==== eviction ====
+    def evict(self):
+        """Evict the least recently used images until the cache is within its size limit."""
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        by_access = sorted(self._sizes, key=self._last_access)
+        for key in by_access:
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes.get(key, 0)
+            self._remove_body(key)
+            self._entry_path(key).unlink(missing_ok=True)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        for fp in self.directory.glob("*.json"):
+            fp.unlink(missing_ok=True)
+        for key in list(self._sizes):
+            self._remove_body(key)
+
+    def _last_access(self, key: str) -> float:
+        try:
+            return self._entry_path(key).stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def _remove_body(self, key: str):
+        self._sizes.pop(key, None)
+        (self.directory / f"{key}.bin").unlink(missing_ok=True)
+
+
+class _CacheBodyWriter:
+    """Writes to a temporary file in the cache directory, then moves it into place if no exception was raised."""
+
+    def __init__(self, cache: DiskImageCache, entry: DiskCacheEntry):
+        self.cache = cache
+        self.entry = entry
+        self.f = None
+
+    def __enter__(self):
+        self.f = tempfile.NamedTemporaryFile(dir=self.cache.directory, suffix=".tmp", delete=False)
+        return self.f
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.f.close()
+        tmp_path = pathlib.Path(self.f.name)
+        if exc_type is None:
+            self.cache._commit_body(tmp_path, self.entry)
+        else:
+            tmp_path.unlink(missing_ok=True)
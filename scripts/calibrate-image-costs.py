@@ -0,0 +1,97 @@
+"""
+Calibrate the image token cost model of an OpenAI model family.
+
+Like gpt-4v-image-sizes.py, this sends images of various sizes to the API and records how many prompt tokens each one
+used (relative to the same prompt without the image). Then, it fits the parameters of an ImageCostModel to the
+recorded response log.
+
+Usage:
+    python calibrate-image-costs.py record gpt-4o log.jsonl
+    python calibrate-image-costs.py fit log.jsonl gpt-4o > cost-models.json
+
+The output of `fit` can be loaded with `kani.ext.vision.engines.openai.img_tokens.load_cost_models`.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from io import BytesIO
+
+from PIL import Image
+
+from kani.engines.openai import OpenAIClient
+from kani.ext.vision import ImagePart
+from kani.ext.vision.engines.openai.img_tokens import cost_model_for, fit_cost_model
+from kani.ext.vision.engines.openai.models import OpenAIImage, OpenAIText, OpenAIVisionChatMessage
+
+# a spread of sizes that exercises both rescaling steps and many tile counts
+SIZES = [
+    (64, 64),
+    (512, 512),
+    (513, 512),
+    (1024, 512),
+    (1024, 1024),
+    (1536, 768),
+    (2048, 768),
+    (2048, 2048),
+    (4096, 1024),
+    (2048, 4096),
+    (800, 600),
+    (100, 5000),
+]
+
+
+async def prompt_tokens(client: OpenAIClient, model: str, image: ImagePart | None, detail: str | None) -> int:
+    content = [OpenAIText.from_text("hi")]
+    if image is not None:
+        content.append(OpenAIImage.from_imagepart(image.copy_with(detail=detail)))
+    resp = await client.create_chat_completion(
+        model=model, messages=[OpenAIVisionChatMessage(role="user", content=content)], max_tokens=1
+    )
+    return resp.prompt_tokens
+
+
+async def record(model: str, fp: str):
+    client = OpenAIClient(api_key=os.getenv("OPENAI_API_KEY"))
+    baseline = await prompt_tokens(client, model, None, None)
+    with open(fp, "a") as f:
+        for size in SIZES:
+            img_bytes = BytesIO()
+            Image.new("RGB", size).save(img_bytes, "PNG")
+            image = ImagePart.from_bytes(img_bytes.getvalue())
+            for detail in ("high", "low"):
+                tokens = await prompt_tokens(client, model, image, detail) - baseline
+                print(f"{size} ({detail}): {tokens} tokens", file=sys.stderr)
+                entry = {"model": model, "width": size[0], "height": size[1], "detail": detail, "tokens": tokens}
+                f.write(json.dumps(entry) + "\n")
+    await client.close()
+
+
+def fit(fp: str, prefix: str):
+    with open(fp) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records = [r for r in records if r["model"].startswith(prefix)]
+    if not records:
+        raise ValueError(f"No records for models starting with {prefix!r} in {fp}")
+    observations = [((r["width"], r["height"]), r["detail"] == "low", r["tokens"]) for r in records]
+    cost_model = fit_cost_model(observations, base=cost_model_for(records[0]["model"]))
+    print(json.dumps({prefix: cost_model._asdict()}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="Record the token usage of images to a log.")
+    record_parser.add_argument("model")
+    record_parser.add_argument("log")
+    fit_parser = subparsers.add_parser("fit", help="Fit a cost model to a recorded log.")
+    fit_parser.add_argument("log")
+    fit_parser.add_argument("prefix", help="The model ID prefix to fit (and register the cost model as).")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        asyncio.run(record(args.model, args.log))
+    else:
+        fit(args.log, args.prefix)
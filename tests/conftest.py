@@ -0,0 +1,112 @@
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from PIL import Image
+
+from kani.ext.vision import utils
+
+
+def make_png(size=(320, 240)) -> bytes:
+    io = BytesIO()
+    Image.new("RGB", size, (0, 128, 255)).save(io, format="PNG")
+    return io.getvalue()
+
+
+def make_webp(size=(1024, 768)) -> bytes:
+    io = BytesIO()
+    Image.effect_noise(size, 64).convert("RGB").save(io, format="WEBP")
+    return io.getvalue()
+
+
+PNG_DATA = make_png()
+WEBP_DATA = make_webp()
+INVALID_SIZE = 4 * 1024 * 1024
+ETAG = '"v1"'
+
+
+class WhitespaceTokenizer:
+    """Stand-in for tiktoken so that tests don't need to download the encoding."""
+
+    @staticmethod
+    def encode(text):
+        return text.split()
+
+
+@pytest.fixture
+def offline_tokenizer(monkeypatch):
+    """Count OpenAI tokens by whitespace rather than with tiktoken."""
+    from kani.ext.vision.engines.openai import OpenAIVisionEngine
+
+    monkeypatch.setattr(
+        OpenAIVisionEngine, "_load_tokenizer", lambda self: setattr(self, "tokenizer", WhitespaceTokenizer())
+    )
+
+
+@pytest.fixture
+async def image_server():
+    """A local HTTP server serving a PNG at /image.png (with range support) and /norange.png (without), a large WEBP at
+    /image.webp, some invalid image data at /invalid.png, a 404 with a placeholder image at /missing.png, and some text at
+    /text.txt."""
+    connections = set()
+    requested_ranges = []
+    full_downloads = []
+
+    def ranged_response(request, data, content_type="image/png"):
+        connections.add(request.transport)
+        if request.headers.get("If-None-Match") == ETAG:
+            return web.Response(status=304, headers={"ETag": ETAG})
+        if request.http_range.start is None:
+            full_downloads.append(request.path)
+            return web.Response(body=data, content_type=content_type, headers={"ETag": ETAG})
+        requested_ranges.append(request.http_range)
+        start, stop = request.http_range.start, min(request.http_range.stop, len(data))
+        if start >= len(data):
+            return web.Response(status=416)
+        return web.Response(
+            status=206,
+            body=data[start:stop],
+            content_type=content_type,
+            headers={"Content-Range": f"bytes {start}-{stop - 1}/{len(data)}", "ETag": ETAG},
+        )
+
+    async def image(request):
+        return ranged_response(request, PNG_DATA)
+
+    async def webp(request):
+        return ranged_response(request, WEBP_DATA, "image/webp")
+
+    async def invalid(request):
+        return ranged_response(request, bytes(INVALID_SIZE))
+
+    async def image_norange(request):
+        connections.add(request.transport)
+        return web.Response(body=PNG_DATA, content_type="image/png")
+
+    async def missing(_):
+        return web.Response(status=404, body=PNG_DATA, content_type="image/png", headers={"ETag": ETAG})
+
+    async def text(_):
+        return web.Response(text="not an image")
+
+    app = web.Application()
+    app.router.add_get("/image.png", image)
+    app.router.add_get("/image.webp", webp)
+    app.router.add_get("/invalid.png", invalid)
+    app.router.add_get("/norange.png", image_norange)
+    app.router.add_get("/missing.png", missing)
+    app.router.add_get("/text.txt", text)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    yield SimpleNamespace(
+        base=f"http://127.0.0.1:{port}",
+        connections=connections,
+        requested_ranges=requested_ranges,
+        full_downloads=full_downloads,
+    )
+    await utils.close_http_session()
+    await runner.cleanup()
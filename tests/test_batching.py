@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from kani.ext.vision.batching import BatchScheduler
+
+
+async def test_batches_concurrent_requests():
+    batches = []
+
+    async def process(requests):
+        batches.append(requests)
+        await asyncio.sleep(0.01)
+        return [r * 2 for r in requests]
+
+    scheduler = BatchScheduler(process, max_batch_size=3, window=0.05)
+    results = await asyncio.gather(*(scheduler.submit(i) for i in range(5)))
+    assert results == [0, 2, 4, 6, 8]
+    # the first batch is flushed when full; the rest wait for the window
+    assert batches == [[0, 1, 2], [3, 4]]
+
+
+async def test_batches_by_key():
+    batches = []
+
+    async def process(requests):
+        batches.append(requests)
+        return requests
+
+    scheduler = BatchScheduler(process, max_batch_size=8, window=0.01)
+    await asyncio.gather(
+        scheduler.submit("a1", key="a"), scheduler.submit("b1", key="b"), scheduler.submit("a2", key="a")
+    )
+    assert sorted(batches) == [["a1", "a2"], ["b1"]]
+
+
+async def test_batch_errors():
+    async def process(requests):
+        raise ValueError("oops")
+
+    scheduler = BatchScheduler(process, max_batch_size=2)
+    results = await asyncio.gather(scheduler.submit(1), scheduler.submit(2), return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+    with pytest.raises(ValueError):
+        await scheduler.submit(3)
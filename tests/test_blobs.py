@@ -0,0 +1,113 @@
+import pytest
+from PIL import Image
+
+from kani import ChatMessage, Kani
+from kani.engines.base import BaseEngine
+from kani.ext.vision import ImagePart, VisionKani
+from kani.ext.vision.blobs import DirectoryBlobStore, PackedBlobStore, blob_key, open_blob_store
+from kani.ext.vision.exceptions import BlobNotFoundException
+from kani.ext.vision.parts import BlobImagePart
+
+
+class DummyEngine(BaseEngine):
+    max_context_size = 4096
+
+    def message_len(self, message):
+        return 1
+
+    async def predict(self, messages, functions=None, **hyperparams):
+        raise NotImplementedError
+
+
+@pytest.mark.parametrize("store_type", [DirectoryBlobStore, PackedBlobStore])
+def test_blob_store(tmp_path, store_type):
+    store = store_type(tmp_path / "blobs")
+    key = store.put(b"hello")
+    assert key == blob_key(b"hello")
+    assert store.put(b"hello") == key
+    assert store.put(b"world") != key
+    assert key in store
+    assert bytes(store.get(key)) == b"hello"
+    with pytest.raises(KeyError):
+        store.get(blob_key(b"missing"))
+    # a new store object sees the existing blobs
+    assert bytes(store_type(tmp_path / "blobs").get(key)) == b"hello"
+    # opening a store doesn't create it until something is stored
+    empty = store_type(tmp_path / "empty")
+    with pytest.raises(KeyError):
+        empty.get(key)
+    assert not list(tmp_path.glob("empty*"))
+
+
+@pytest.mark.parametrize("store_name", ["images", "images.pack"])
+def test_save_with_blob_store(tmp_path, store_name):
+    image = Image.effect_noise((64, 48), 64).convert("RGB")
+    png = ImagePart.from_image(image).bytes
+    history = [
+        ChatMessage.user(["look", ImagePart.from_image(image)]),
+        ChatMessage.assistant("ok"),
+        ChatMessage.user([ImagePart.from_bytes(png, detail="low"), "again"]),
+    ]
+    if store_name == "images":
+        (tmp_path / store_name).mkdir()
+    store = open_blob_store(tmp_path / store_name)
+    ai = VisionKani(DummyEngine(), chat_history=history)
+    ai.save(tmp_path / "chat.json", blob_store=store)
+    # the image data is only written to the store once, and not to the saved chat
+    assert len((tmp_path / "chat.json").read_bytes()) < len(png)
+
+    loaded = VisionKani(DummyEngine())
+    loaded.load(tmp_path / "chat.json")
+    first, second = loaded.chat_history[0].parts[1], loaded.chat_history[2].parts[0]
+    assert isinstance(first, BlobImagePart) and isinstance(second, BlobImagePart)
+    assert first.blob == second.blob == blob_key(png)
+    assert second.detail == "low"
+    assert first.size == (64, 48)
+    assert first.image.tobytes() == image.tobytes()
+    assert first.content_hash == ImagePart.from_bytes(png).content_hash
+    assert loaded.chat_history[2].parts[1] == "again"
+    # saving again reuses the existing blobs
+    loaded.save(tmp_path / "chat2.json", blob_store=store)
+    assert (tmp_path / "chat2.json").read_text() == (tmp_path / "chat.json").read_text()
+
+
+@pytest.mark.parametrize("store_name", ["images", "images.pack"])
+def test_load_moved_history(tmp_path, store_name):
+    image = Image.effect_noise((32, 32), 64).convert("RGB")
+    history = [ChatMessage.user(["look", ImagePart.from_image(image)])]
+    (tmp_path / "a").mkdir()
+    if store_name == "images":
+        (tmp_path / "a" / store_name).mkdir()
+    ai = VisionKani(DummyEngine(), chat_history=history)
+    ai.save(tmp_path / "a" / "chat.json", blob_store=tmp_path / "a" / store_name)
+    # the store's location is saved relative to the chat
+    assert str(tmp_path) not in (tmp_path / "a" / "chat.json").read_text()
+
+    # the chat and store can be moved together
+    (tmp_path / "a").rename(tmp_path / "b")
+    loaded = VisionKani(DummyEngine())
+    loaded.load(tmp_path / "b" / "chat.json")
+    assert loaded.chat_history[0].parts[1].store == str(tmp_path / "b" / store_name)
+    assert loaded.chat_history[0].parts[1].image.tobytes() == image.tobytes()
+
+    # or the store can be given explicitly if it was moved separately
+    for fp in (tmp_path / "b").glob(f"{store_name}*"):
+        fp.rename(tmp_path / fp.name)
+    loaded.load(tmp_path / "b" / "chat.json", blob_store=tmp_path / store_name)
+    assert loaded.chat_history[0].parts[1].image.tobytes() == image.tobytes()
+
+
+def test_load_unresolved_store(tmp_path, monkeypatch):
+    history = [ChatMessage.user(["look", ImagePart.from_image(Image.new("RGB", (32, 32)))])]
+    (tmp_path / "chat").mkdir()
+    VisionKani(DummyEngine(), chat_history=history).save(
+        tmp_path / "chat" / "chat.json", blob_store=tmp_path / "chat" / "images.pack"
+    )
+    # a plain Kani resolves the relative store location against the working directory, where there is no store
+    (tmp_path / "cwd").mkdir()
+    monkeypatch.chdir(tmp_path / "cwd")
+    loaded = Kani(DummyEngine())
+    loaded.load(tmp_path / "chat" / "chat.json")
+    with pytest.raises(BlobNotFoundException, match="images.pack"):
+        _ = loaded.chat_history[0].parts[1].size
+    assert not list((tmp_path / "cwd").iterdir())
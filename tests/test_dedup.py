@@ -0,0 +1,82 @@
+import gc
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from kani import ChatMessage
+from kani.ext.vision import ImagePart, VisionKani
+from kani.ext.vision.dedup import (
+    DUPLICATE_IMAGE_TEXT,
+    NEAR_DUPLICATE_IMAGE_TEXT,
+    _deduped_messages,
+    dedupe_images,
+    perceptual_hash,
+)
+from kani.ext.vision.engines.openai import OpenAIVisionEngine
+
+pytestmark = pytest.mark.usefixtures("offline_tokenizer")
+
+
+def gradient(size=(256, 128)) -> Image.Image:
+    return Image.linear_gradient("L").resize(size).convert("RGB")
+
+
+def test_dedupe_exact():
+    image = Image.effect_noise((64, 64), 64).convert("RGB")
+    first = ChatMessage.user(["a", ImagePart.from_image(image)])
+    other = ChatMessage.user([ImagePart.from_image(Image.new("RGB", (64, 64)))])
+    repeat = ChatMessage.user([ImagePart.from_image(image), "b"])
+    deduped = dedupe_images([first, ChatMessage.assistant("ok"), other, repeat])
+    assert deduped[:3] == [first, ChatMessage.assistant("ok"), other]
+    assert deduped[0] is first
+    assert deduped[3].parts == [DUPLICATE_IMAGE_TEXT, "b"]
+    # the same copy is returned each time so that engines can cache it
+    assert dedupe_images([first, repeat])[1] is dedupe_images([first, repeat])[1]
+    # the first occurrence is kept when the original is dropped
+    assert dedupe_images([repeat]) == [repeat]
+    # deduplicated copies don't keep old messages alive
+    assert repeat in _deduped_messages
+    del first, repeat
+    gc.collect()
+    assert not _deduped_messages.keys()
+
+
+def test_dedupe_near_duplicates():
+    io = BytesIO()
+    gradient().save(io, format="JPEG", quality=30)
+    original = ImagePart.from_image(gradient())
+    recompressed = ImagePart.from_bytes(io.getvalue())
+    resized = ImagePart.from_image(gradient((512, 256)))
+    assert (perceptual_hash(original) ^ perceptual_hash(resized)).bit_count() <= 4
+
+    messages = [ChatMessage.user([original]), ChatMessage.user([recompressed, resized])]
+    assert dedupe_images(messages) == messages
+    deduped = dedupe_images(messages, near_duplicate_threshold=4)
+    assert deduped[1].parts == [NEAR_DUPLICATE_IMAGE_TEXT, NEAR_DUPLICATE_IMAGE_TEXT]
+
+
+async def test_vision_kani_dedupe():
+    engine = OpenAIVisionEngine("sk-test", max_context_size=2000)
+    image = Image.effect_noise((1024, 1024), 64).convert("RGB")
+    history = [
+        ChatMessage.user(["a", ImagePart.from_image(image)]),
+        ChatMessage.assistant("b"),
+        ChatMessage.user(["c", ImagePart.from_image(image)]),
+        ChatMessage.assistant("d"),
+        ChatMessage.user(["e", ImagePart.from_image(image)]),
+    ]
+    ai = VisionKani(engine, desired_response_tokens=0, chat_history=history, dedupe_images=True)
+    prompt = await ai.get_prompt()
+    assert prompt[:2] == history[:2]
+    assert prompt[2].parts == ["c", DUPLICATE_IMAGE_TEXT]
+    assert prompt[4].parts == ["e", DUPLICATE_IMAGE_TEXT]
+
+    # when the first occurrence is dropped, the next one is sent in full (773 + 8 + 15 + 8 + 15 tokens doesn't fit)
+    engine = OpenAIVisionEngine("sk-test", max_context_size=810)
+    ai = VisionKani(
+        engine, desired_response_tokens=0, chat_history=history, dedupe_images=True, low_detail_fallback=False
+    )
+    prompt = await ai.get_prompt()
+    assert prompt[:3] == history[1:4]
+    assert prompt[3].parts == ["e", DUPLICATE_IMAGE_TEXT]
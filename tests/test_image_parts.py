@@ -0,0 +1,184 @@
+import base64
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageFile
+
+from kani import ChatMessage
+from kani.ext.vision import ImagePart, VisionKani
+from kani.ext.vision.cache import LRUCache, encoding_cache
+from kani.ext.vision.engines.openai import OpenAIVisionEngine
+
+
+@pytest.fixture(autouse=True)
+def clear_encoding_cache():
+    encoding_cache.cache_clear()
+    yield
+    encoding_cache.cache_clear()
+
+
+def make_png(size=(64, 32), color=(255, 0, 0)) -> bytes:
+    io = BytesIO()
+    Image.new("RGB", size, color).save(io, format="PNG")
+    return io.getvalue()
+
+
+class CheckerboardImagePart(ImagePart):
+    """A minimal image part that only implements ``image``."""
+
+    @property
+    def image(self):
+        return Image.new("1", (8, 8)).resize((64, 64))
+
+
+def test_custom_image_part():
+    part = CheckerboardImagePart()
+    assert part.bytes == ImagePart.from_image(part.image).bytes
+    assert part.content_hash == ImagePart.from_bytes(part.bytes).content_hash
+    assert base64.b64decode(part.b64) == part.bytes
+    # the b64 encoding is shared through the process-wide cache, but the PNG data isn't (it is needed for the hash)
+    assert CheckerboardImagePart().b64 is part.b64
+
+
+def test_lru_cache_byte_budget():
+    cache = LRUCache(max_bytes=10)
+    cache.set("a", "aaaa", 4)
+    cache.set("b", "bbbb", 4)
+    assert cache.get("a") == "aaaa"  # a is now most recently used
+    cache.set("c", "cccc", 4)
+    assert "b" not in cache
+    assert cache.get("a") == "aaaa"
+    assert cache.get("b") is None
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.currsize, info.nbytes) == (2, 1, 1, 2, 8)
+    assert cache.keys() == ["c", "a"]
+
+
+def test_encodings_memoized_per_part(monkeypatch):
+    part = ImagePart.from_image(Image.new("RGB", (64, 32)))
+    calls = 0
+    orig_save = Image.Image.save
+
+    def counting_save(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        return orig_save(*args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "save", counting_save)
+    assert part.b64 == part.b64
+    assert part.b64_uri.endswith(part.b64)
+    _ = part.bytes
+    assert calls == 1
+
+
+def test_encodings_shared_by_content():
+    img = Image.new("RGB", (64, 32), (0, 255, 0))
+    first = ImagePart.from_image(img)
+    second = ImagePart.from_image(img.copy())
+    assert first.content_hash == second.content_hash
+    assert first.b64 is second.b64
+    assert encoding_cache.cache_info().hits >= 1
+
+
+def test_content_hash_matches_across_sources(tmp_path):
+    data = make_png()
+    fp = tmp_path / "image.png"
+    fp.write_bytes(data)
+    assert ImagePart.from_path(fp).content_hash == ImagePart.from_bytes(data).content_hash
+    assert ImagePart.from_bytes(data).content_hash != ImagePart.from_bytes(make_png(color=(0, 0, 255))).content_hash
+
+
+def test_header_metadata(tmp_path):
+    data = make_png(size=(640, 480))
+    fp = tmp_path / "image.png"
+    fp.write_bytes(data)
+    file_part = ImagePart.from_path(fp)
+    bytes_part = ImagePart.from_bytes(data)
+    for part in (file_part, bytes_part):
+        assert part.size == (640, 480)
+        assert part.mime == "image/png"
+
+    # the metadata is only read once, so we shouldn't need the file anymore
+    fp.unlink()
+    assert file_part.size == (640, 480)
+
+
+def test_header_metadata_webp(tmp_path, monkeypatch):
+    # WEBP headers can't be parsed incrementally, so make sure we don't retry the parser on every chunk
+    feeds = 0
+    orig_feed = ImageFile.Parser.feed
+
+    def counting_feed(self, data):
+        nonlocal feeds
+        feeds += 1
+        return orig_feed(self, data)
+
+    monkeypatch.setattr(ImageFile.Parser, "feed", counting_feed)
+    io = BytesIO()
+    Image.effect_noise((512, 384), 64).convert("RGB").save(io, format="WEBP", lossless=True)
+    data = io.getvalue()
+    fp = tmp_path / "image.webp"
+    fp.write_bytes(data)
+    for part in (ImagePart.from_path(fp), ImagePart.from_bytes(data), ImagePart.from_bytes(bytearray(data))):
+        assert part.size == (512, 384)
+        assert part.mime == "image/webp"
+    assert feeds <= 4
+
+
+def test_zero_copy_buffers(tmp_path):
+    data = make_png(size=(640, 480))
+    fp = tmp_path / "image.png"
+    fp.write_bytes(data)
+    expected = ImagePart.from_bytes(data)
+    buf = bytearray(data)
+    for part in (ImagePart.from_bytes(buf), ImagePart.from_bytes(memoryview(buf)), ImagePart.from_path(fp, True)):
+        assert type(part).__name__ == "BufferImagePart"
+        assert part.size == (640, 480)
+        assert part.mime == "image/png"
+        assert part.content_hash == expected.content_hash
+        assert part.b64 == expected.b64
+        assert part.image.size == (640, 480)
+    # the bytearray is referenced, not copied
+    assert ImagePart.from_bytes(buf).buffer.obj is buf
+
+
+def test_iter_b64_chunks():
+    part = ImagePart.from_bytes(make_png(size=(640, 480)))
+    chunks = list(part.iter_b64(chunk_size=100))
+    assert len(chunks) > 1
+    assert "".join(chunks) == base64.b64encode(part.bytes).decode()
+
+
+async def test_async_encoding(tmp_path):
+    data = make_png()
+    fp = tmp_path / "image.png"
+    fp.write_bytes(data)
+    part = ImagePart.from_path(fp)
+    assert (await part.aimage()).size == (64, 32)
+    assert await part.abytes() == data
+    assert await part.aencode() == base64.b64encode(data).decode()
+    assert "b64" in part.__dict__
+
+    # parts that can be pickled can be encoded in another process, and the result is memoized on this part
+    pillow_part = ImagePart.from_image(Image.new("RGB", (64, 32), (255, 0, 0)))
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        b64 = await pillow_part.aencode(executor)
+    assert pillow_part.__dict__["b64"] == b64
+    assert Image.open(BytesIO(base64.b64decode(b64))).size == (64, 32)
+
+
+def test_constructor_detail(tmp_path):
+    fp = tmp_path / "image.png"
+    fp.write_bytes(make_png())
+    assert ImagePart.from_path(fp, detail="low").detail == "low"
+    assert ImagePart.from_path(fp, memory_map=True, detail="high").detail == "high"
+    assert ImagePart.from_bytes(make_png(), detail="low").detail == "low"
+    assert ImagePart.from_image(Image.new("RGB", (4, 4))).detail is None
+
+
+async def test_buffer_part_in_prompt(offline_tokenizer):
+    # messages containing writable buffers can still be hashed to cache their token length
+    msg = ChatMessage.user(["what is this?", ImagePart.from_bytes(bytearray(make_png()))])
+    ai = VisionKani(OpenAIVisionEngine("sk-test"), chat_history=[msg])
+    assert await ai.get_prompt() == [msg]
@@ -0,0 +1,116 @@
+import time
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from kani.ext.vision import ImagePart, instrumentation, utils
+from kani.ext.vision.cache import encoding_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_encoding_cache():
+    encoding_cache.cache_clear()
+    yield
+    encoding_cache.cache_clear()
+
+
+@pytest.fixture
+def events():
+    events = []
+    instrumentation.add_listener(events.append)
+    yield events
+    instrumentation.remove_listener(events.append)
+
+
+def test_disabled():
+    assert not instrumentation.enabled()
+    assert instrumentation.span("encode") is instrumentation.span("resize")
+
+
+async def test_collect_stats():
+    part = ImagePart.from_image(Image.new("RGB", (64, 32)))
+    with instrumentation.collect_stats() as stats:
+        assert instrumentation.enabled()
+        # encoded in the default executor, which doesn't copy the context by itself
+        await part.aencode()
+    assert not instrumentation.enabled()
+    assert stats.counts == {"encode": 2}  # png, then b64
+    assert stats.nbytes["encode"] == len(part.bytes) + len(part.b64)
+    assert stats.durations["encode"] > 0
+    # cached encodings aren't recorded
+    with instrumentation.collect_stats() as stats:
+        _ = ImagePart.from_image(Image.new("RGB", (64, 32))).b64
+    assert not stats.counts
+
+
+def test_nested_spans(monkeypatch, events):
+    encode_png = ImagePart._encode_png
+
+    def slow_encode_png(self):
+        time.sleep(0.1)
+        return encode_png(self)
+
+    monkeypatch.setattr(ImagePart, "_encode_png", slow_encode_png)
+    # encoding the base64 encodes the PNG in a nested span, which is only counted once in the stats
+    with instrumentation.collect_stats() as stats:
+        _ = ImagePart.from_image(Image.new("RGB", (64, 32))).b64
+    png, b64 = events
+    assert png.attributes["kind"] == "png" and b64.attributes["kind"] == "b64"
+    assert b64.duration > png.duration >= 0.1
+    assert stats.counts == {"encode": 2}
+    assert 0.1 <= stats.durations["encode"] <= b64.duration
+
+
+async def test_listener(image_server, events):
+    io = BytesIO()
+    await utils.download_image(f"{image_server.base}/image.png", io)
+    await utils.image_metadata_from_url(f"{image_server.base}/image.png")
+    with pytest.raises(Exception):
+        await utils.download_image(f"{image_server.base}/text.txt", BytesIO())
+
+    download, metadata, failed = events
+    assert download.name == "download"
+    assert download.nbytes == len(io.getvalue())
+    assert download.attributes == {"url": f"{image_server.base}/image.png", "source": "network"}
+    assert download.error is None
+    assert metadata.name == "metadata_from_url"
+    assert failed.error is not None
+
+
+@pytest.fixture
+def otel():
+    sdk_trace = pytest.importorskip("opentelemetry.sdk.trace")
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = sdk_trace.TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    tracer = provider.get_tracer("test")
+    listener = instrumentation.OpenTelemetryListener(tracer)
+    instrumentation.add_listener(listener)
+    yield tracer, exporter
+    instrumentation.remove_listener(listener)
+
+
+def test_opentelemetry(otel, events):
+    _, exporter = otel
+    _ = ImagePart.from_image(Image.new("RGB", (64, 32))).bytes
+
+    (span,) = exporter.get_finished_spans()
+    (event,) = events
+    assert span.name == "kani_vision.encode"
+    assert span.attributes == {"kani_vision.kind": "png", "kani_vision.nbytes": event.nbytes}
+    assert span.start_time == event.start_time
+    assert span.end_time - span.start_time == int(event.duration * 1e9)
+
+
+async def test_opentelemetry_executor(otel):
+    tracer, exporter = otel
+    # without a collect_stats scope, spans of images encoded in the default executor are still parented correctly
+    with tracer.start_as_current_span("request") as parent:
+        await ImagePart.from_image(Image.new("RGB", (64, 32))).aencode()
+    *encodes, _ = exporter.get_finished_spans()
+    assert [span.name for span in encodes] == ["kani_vision.encode"] * 2
+    assert all(span.parent.span_id == parent.get_span_context().span_id for span in encodes)
@@ -0,0 +1,188 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from kani import ChatMessage
+from kani.ext.vision import ImagePart
+from kani.ext.vision.batching import BatchScheduler
+from kani.ext.vision.cache import LRUCache
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("sentencepiece")
+pytest.importorskip("llava")
+
+from kani.ext.vision.engines.llava.engine import (  # noqa: E402
+    IMAGE_TOKEN_INDEX,
+    LlavaEngine,
+    _common_prefix_len,
+    _left_pad_past,
+)
+
+NUM_PATCHES = 3
+EOS = 0
+
+
+class TinyLlava(transformers.LlamaForCausalLM):
+    """A tiny, randomly initialized LLaMA in place of LLaVA's language model. Image features are set in the engine's
+    image cache, so the vision tower is never run."""
+
+    def get_model(self):
+        return self.model
+
+    def get_vision_tower(self):
+        return SimpleNamespace(num_patches=NUM_PATCHES)
+
+
+@pytest.fixture
+def engine():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        eos_token_id=EOS,
+    )
+    # skip loading a pretrained model and tokenizer
+    engine = LlavaEngine.__new__(LlavaEngine)
+    engine.model = TinyLlava(config).eval()
+    engine.tokenizer = SimpleNamespace(eos_token_id=EOS)
+    engine.device = "cpu"
+    engine.max_context_size = 128
+    engine.hyperparams = {}
+    engine.image_cache = LRUCache()
+    engine.kv_cache = LRUCache(max_bytes=64 * 1024 * 1024)
+    engine.batch_scheduler = BatchScheduler(engine._predict_batch, max_batch_size=4)
+    return engine
+
+
+def image_part(engine, color) -> ImagePart:
+    part = ImagePart.from_image(Image.new("RGB", (8, 8), color))
+    features = torch.randn(NUM_PATCHES, engine.model.config.hidden_size)
+    engine.image_cache.set((part.content_hash, "features"), features)
+    return part
+
+
+@torch.inference_mode()
+def reference_greedy(engine, input_ids, image_parts, max_new_tokens, repetition_penalty=1.0):
+    """Decode a single prompt greedily by running the whole sequence through the model at each step."""
+    features = {part.content_hash: engine.image_cache.get((part.content_hash, "features")) for part in image_parts}
+    embeds = engine._embed_prompt(input_ids, image_parts, features)
+    context = input_ids[0][input_ids[0] != IMAGE_TOKEN_INDEX]
+    penalty = transformers.RepetitionPenaltyLogitsProcessor(repetition_penalty)
+    output = []
+    for _ in range(max_new_tokens):
+        logits = engine.model.lm_head(engine.model.model(inputs_embeds=embeds[None])[0][:, -1]).float()
+        token = int(penalty(context[None], logits).argmax())
+        if token == EOS:
+            break
+        output.append(token)
+        context = torch.cat([context, torch.tensor([token])])
+        embeds = torch.cat([embeds, engine.model.model.embed_tokens(torch.tensor([token]))])
+    return output
+
+
+def test_common_prefix_len():
+    assert _common_prefix_len((1, 2, 3), (1, 2, 4)) == 2
+    assert _common_prefix_len((1, 2), (1, 2, 3)) == 2
+    assert _common_prefix_len((1, ("abc", 0)), (1, ("abc", 0))) == 2
+    assert _common_prefix_len((1, ("abc", 0)), (1, ("def", 0))) == 1
+    assert _common_prefix_len((), (1,)) == 0
+
+
+def test_left_pad_past():
+    short = ((torch.ones(1, 2, 2, 4), torch.ones(1, 2, 2, 4) * 2),)
+    long = ((torch.ones(1, 2, 3, 4) * 3, torch.ones(1, 2, 3, 4) * 4),)
+    ((keys, values),) = _left_pad_past([short, long], 3)
+    assert keys.shape == values.shape == (2, 2, 3, 4)
+    assert (keys[0, :, 0] == 0).all() and (keys[0, :, 1:] == 1).all()
+    assert (values[0, :, 0] == 0).all() and (values[0, :, 1:] == 2).all()
+    assert (keys[1] == 3).all() and (values[1] == 4).all()
+
+
+@torch.inference_mode()
+def test_embed_prompt(engine):
+    part = image_part(engine, (255, 0, 0))
+    features = {part.content_hash: engine.image_cache.get((part.content_hash, "features"))}
+    input_ids = torch.tensor([[5, 6, IMAGE_TOKEN_INDEX, 7]])
+    embeds = engine._embed_prompt(input_ids, [part], features)
+    embed_tokens = engine.model.model.embed_tokens
+    assert embeds.shape == (3 + NUM_PATCHES, engine.model.config.hidden_size)
+    assert torch.equal(embeds[:2], embed_tokens(torch.tensor([5, 6])))
+    assert torch.equal(embeds[2 : 2 + NUM_PATCHES], features[part.content_hash])
+    assert torch.equal(embeds[-1], embed_tokens(torch.tensor(7)))
+    # starting partway through the prompt (e.g. after reusing cached keys/values) only embeds the rest
+    for start in (1, 3, 2 + NUM_PATCHES):
+        assert torch.equal(engine._embed_prompt(input_ids, [part], features, start=start), embeds[start:])
+
+
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.5])
+def test_generate_batch(engine, repetition_penalty):
+    part = image_part(engine, (0, 255, 0))
+    prompts = [
+        (torch.tensor([[1, 5, 6, 7]]), []),
+        (torch.tensor([[1, 8, IMAGE_TOKEN_INDEX, 9, 10, 11]]), [part]),
+    ]
+    outputs = engine.generate_batch(prompts, max_new_tokens=6, repetition_penalty=repetition_penalty)
+    for (input_ids, image_parts), (output, prompt_len) in zip(prompts, outputs):
+        assert output == reference_greedy(engine, input_ids, image_parts, 6, repetition_penalty)
+        assert prompt_len == input_ids.shape[1] + len(image_parts) * (NUM_PATCHES - 1)
+
+    # the next round of the first conversation reuses its cached keys/values
+    hits = engine.kv_cache.hits
+    input_ids = torch.cat([prompts[0][0], torch.tensor([outputs[0][0] + [12, 13]])], dim=1)
+    ((output, _),) = engine.generate_batch([(input_ids, [])], max_new_tokens=6, repetition_penalty=repetition_penalty)
+    assert engine.kv_cache.hits == hits + 1
+    assert output == reference_greedy(engine, input_ids, [], 6, repetition_penalty)
+
+
+def test_unsupported_generation_params(engine):
+    with pytest.raises(ValueError):
+        engine.generate_batch([(torch.tensor([[1, 5]]), [])], num_beams=2)
+    with pytest.raises(ValueError):
+        engine._make_request([], None, {"no_repeat_ngram_size": 3})
+
+    # LLaVA's generate() is used unless batching or KV caching is enabled, so any parameters are allowed
+    engine.kv_cache = LRUCache(max_bytes=0)
+    engine.batch_scheduler.max_batch_size = 1
+    assert not engine._uses_decoding_loop()
+    assert engine._make_request([], None, {"no_repeat_ngram_size": 3})[3] == {"no_repeat_ngram_size": 3}
+
+
+async def test_cancelled_stream(engine):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+    # cancel the stream while its request is still waiting to be batched
+    engine.batch_scheduler.window = 1
+    stream = engine.stream([ChatMessage.user("hello")])
+    task = asyncio.create_task(anext(stream))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # the thread that was waiting for the stream's text is freed
+    await asyncio.wait_for(asyncio.to_thread(lambda: None), timeout=1)
+
+
+async def test_concurrent_streams(engine):
+    n_workers = 2
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=n_workers))
+    engine.tokenizer = SimpleNamespace(eos_token_id=EOS, decode=lambda ids, **kwargs: "".join(f" {i}" for i in ids))
+    engine.build_prompt = lambda messages, functions: torch.tensor([[1, 5, 6, len(messages[0].text)]])
+
+    async def consume(idx):
+        chunks = [chunk async for chunk in engine.stream([ChatMessage.user("x" * idx)], max_new_tokens=4)]
+        *texts, completion = chunks
+        assert "".join(texts) == completion.message.text
+        return completion
+
+    # waiting for streamed text doesn't hold any of the executor's threads, so generation can still run
+    completions = await asyncio.wait_for(asyncio.gather(*(consume(idx) for idx in range(n_workers * 2))), timeout=30)
+    assert len(completions) == n_workers * 2
@@ -0,0 +1,322 @@
+import gc
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+from aiohttp import web
+from PIL import ExifTags, Image
+
+from kani import ChatMessage
+from kani.engines.base import Completion
+from kani.engines.openai import OpenAIClient, OpenAIEngine
+from kani.ext.vision import ImagePart, VisionKani
+from kani.ext.vision.compaction import Caption, Downscale, LowDetail
+from kani.ext.vision.engines.openai import OpenAIVisionClient, OpenAIVisionEngine
+from kani.ext.vision.engines.openai.client import _b64_uri_len
+from kani.ext.vision.engines.openai.img_tokens import tokens_from_image_size
+from kani.ext.vision.engines.openai.models import OpenAIImage
+from kani.ext.vision.parts import RemoteURLImagePart
+
+pytestmark = pytest.mark.usefixtures("offline_tokenizer")
+
+
+def make_png(size) -> bytes:
+    io = BytesIO()
+    Image.effect_noise(size, 64).convert("RGB").save(io, format="PNG")
+    return io.getvalue()
+
+
+def test_resize_images():
+    engine = OpenAIVisionEngine("sk-test", resize_images=True)
+    data = make_png((3000, 2000))
+    part = ImagePart.from_bytes(data)
+    prepared = engine.prepare_image(part)
+    assert prepared.size == (1152, 768)
+    assert prepared.mime == "image/jpeg"
+    assert len(prepared.bytes) < len(data)
+    assert tokens_from_image_size(prepared.size) == tokens_from_image_size(part.size)
+    # resized images are cached
+    assert engine.prepare_image(ImagePart.from_bytes(data)).bytes is prepared.bytes
+
+
+def test_resize_images_exif_orientation():
+    engine = OpenAIVisionEngine("sk-test", resize_images=True)
+    # a phone photo taken in portrait, stored as landscape pixels and rotated by its EXIF orientation
+    image = Image.new("RGB", (4000, 3000), (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, 2000, 3000))
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6
+    io = BytesIO()
+    image.save(io, format="JPEG", exif=exif)
+    prepared = engine.prepare_image(ImagePart.from_bytes(io.getvalue()))
+    assert prepared.size == (768, 1024)
+    assert ExifTags.Base.Orientation not in prepared.image.getexif()
+    # rotated 90 degrees clockwise, so the left half of the stored pixels is now the top
+    assert prepared.image.getpixel((384, 100))[0] > 200
+    assert prepared.image.getpixel((384, 900))[2] > 200
+
+
+def test_low_detail_max_side():
+    engine = OpenAIVisionEngine("sk-test", low_detail_max_side=512)
+    small = ImagePart.from_image(Image.new("RGB", (256, 256)))
+    large = ImagePart.from_image(Image.new("RGB", (1024, 1024)))
+    msg = ChatMessage.user([small, large])
+    assert engine.message_len(msg) == 7 + 85 + 765
+    translated = engine.translate_messages([engine.prepare_message(msg)])[0]
+    assert [part.detail for part in translated.content] == ["low", None]
+
+
+async def test_stream_image_payloads():
+    bodies = []
+
+    async def chat_completions(request):
+        bodies.append((await request.read(), request.content_length))
+        return web.json_response(
+            {
+                "id": "chatcmpl-test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-4-vision-preview",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    engine = OpenAIVisionEngine("sk-test", stream_image_payloads=True, api_base=f"http://127.0.0.1:{port}/v1", retry=1)
+    assert isinstance(engine.client, OpenAIVisionClient)
+    images = [ImagePart.from_bytes(make_png((300, 200))), ImagePart.from_image(Image.new("RGB", (64, 64)))]
+    msg = ChatMessage.user(["what is this?", *images])
+    try:
+        completion = await engine.predict([msg])
+    finally:
+        await engine.close()
+        await runner.cleanup()
+
+    assert completion.message.text == "ok"
+    body, content_length = bodies[0]
+    assert len(body) == content_length
+    # the streamed body is the same as the in-memory translation
+    data = json.loads(body)
+    expected = [m.model_dump(exclude_defaults=True, mode="json") for m in engine.translate_messages([msg])]
+    assert data["messages"] == expected
+    assert data["messages"][0]["content"][1]["image_url"] == images[0].b64_uri
+
+
+async def test_stream_image_payloads_off_loop(monkeypatch):
+    threads = []
+    encode_png = ImagePart._encode_png
+
+    def recording_encode_png(self):
+        threads.append(threading.current_thread())
+        return encode_png(self)
+
+    monkeypatch.setattr(ImagePart, "_encode_png", recording_encode_png)
+    engine = OpenAIVisionEngine("sk-test", stream_image_payloads=True)
+    msg = ChatMessage.user(["hi", ImagePart.from_image(Image.effect_noise((64, 64), 64))])
+    (prepared,) = await engine.aprepare_messages([msg])
+    # sizing the streamed request body doesn't encode the image on the event loop
+    assert _b64_uri_len(prepared.parts[1]) == len(prepared.parts[1].b64_uri)
+    assert threads and threading.main_thread() not in threads
+
+
+def test_stream_image_payloads_client():
+    with pytest.raises(ValueError):
+        OpenAIVisionEngine(client=OpenAIClient("sk-test"), stream_image_payloads=True)
+
+
+async def test_aprepare_messages():
+    engine = OpenAIVisionEngine("sk-test", resize_images=True, low_detail_max_side=512)
+    with ThreadPoolExecutor(max_workers=2) as engine.image_executor:
+        large = ImagePart.from_bytes(make_png((3000, 2000)))
+        small = ImagePart.from_image(Image.new("RGB", (256, 256)))
+        msg = ChatMessage.user(["hello", large, small, large])
+        prepared = await engine.aprepare_messages([ChatMessage.user("hi"), msg])
+    assert prepared[0].content == "hi"
+    _, p_large, p_small, p_large_again = prepared[1].parts
+    assert p_large.size == (1152, 768)
+    assert p_large_again is p_large
+    assert p_small.detail == "low"
+    # images are encoded ahead of translation
+    assert "b64" in p_large.__dict__
+    assert engine.prepare_image(large).bytes == p_large.bytes
+
+
+async def test_messages_translated_once(monkeypatch):
+    engine = OpenAIVisionEngine("sk-test", low_detail_max_side=512)
+    history = [ChatMessage.user(["look at this", ImagePart.from_image(Image.new("RGB", (256, 256)))])]
+    calls = 0
+    orig_from_imagepart = OpenAIImage.from_imagepart
+
+    def counting_from_imagepart(part):
+        nonlocal calls
+        calls += 1
+        return orig_from_imagepart(part)
+
+    monkeypatch.setattr(OpenAIImage, "from_imagepart", counting_from_imagepart)
+    first = engine.translate_messages(await engine.aprepare_messages(history))
+    history.append(ChatMessage.assistant("a black square"))
+    history.append(ChatMessage.user(["and this?", ImagePart.from_image(Image.new("RGB", (128, 128)))]))
+    second = engine.translate_messages(await engine.aprepare_messages(history))
+    assert calls == 2
+    assert second[0] is first[0]
+    assert second[2].content[1].detail == "low"
+
+
+def test_translation_cache():
+    engine = OpenAIVisionEngine("sk-test")
+    history = [ChatMessage.user([f"image {idx}", ImagePart.from_image(Image.new("RGB", (64, 64)))]) for idx in range(3)]
+    translated = engine.translate_messages(history)
+    assert engine.translate_messages(history)[0] is translated[0]
+    # each engine has its own cache, bounded by the size of the translated messages
+    small = OpenAIVisionEngine("sk-test", translation_cache_bytes=2 * translated[0].content_nbytes)
+    assert small.translate_messages(history)[0] is not translated[0]
+    assert len(small.translation_cache) == 2
+    # messages are dropped from the cache once they are no longer in use
+    del history
+    gc.collect()
+    assert len(engine.translation_cache) == len(small.translation_cache) == 0
+
+
+def test_message_len_cached(monkeypatch):
+    engine = OpenAIVisionEngine("sk-test")
+    image = Image.new("RGB", (1024, 1024))
+    msg = ChatMessage.user(["what is this?", ImagePart.from_image(image)])
+    assert engine.message_len(msg) == 7 + 3 + 765
+    # an equal message with a different image part is a cache hit
+    monkeypatch.setattr(engine.tokenizer, "encode", None)
+    assert engine.message_len(ChatMessage.user(["what is this?", ImagePart.from_image(image.copy())])) == 775
+    info = engine.message_len_cache.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+    # messages containing Pillow images can be hashed (e.g. for kani's own token length cache)
+    assert hash(msg) == hash(msg.copy_with(content=msg.parts))
+    # counting tokens only reads an image's size, not its data
+    other = ImagePart.from_bytes(make_png((1024, 1024)))
+    assert engine.message_len(ChatMessage.user(["what is this?", other])) == 775
+    assert "content_hash" not in other.__dict__
+
+
+def test_default_detail():
+    engine = OpenAIVisionEngine("sk-test", default_detail="low")
+    image = Image.new("RGB", (1024, 1024))
+    assert engine.message_len(ChatMessage.user([ImagePart.from_image(image)])) == 7 + 85
+    assert engine.message_len(ChatMessage.user([ImagePart.from_image(image, detail="high")])) == 7 + 765
+
+
+async def test_stream_prepares_messages(monkeypatch):
+    sent = []
+
+    async def stream(self, messages, functions=None, **hyperparams):
+        sent.extend(messages)
+        yield "ok"
+
+    # the base engine only supports streaming in kani v1.0+
+    monkeypatch.setattr(OpenAIEngine, "stream", stream, raising=False)
+    engine = OpenAIVisionEngine("sk-test", default_detail="low", resize_images=True)
+    msg = ChatMessage.user(["what is this?", ImagePart.from_bytes(make_png((3000, 2000)))])
+    assert [chunk async for chunk in engine.stream([msg])] == ["ok"]
+    assert sent[0].parts[1].detail == "low"
+    assert sent[0].parts[1].size == (512, 341)
+
+
+async def test_low_detail_fallback():
+    engine = OpenAIVisionEngine("sk-test", max_context_size=2000)
+    image = Image.new("RGB", (1024, 1024))
+    history = [
+        ChatMessage.user(["a", ImagePart.from_image(image)]),
+        ChatMessage.assistant("b"),
+        ChatMessage.user(["c", ImagePart.from_image(image)]),
+        ChatMessage.assistant("d"),
+        ChatMessage.user(["e", ImagePart.from_image(image)]),
+    ]
+    # 3 * 773 + 2 * 8 tokens doesn't fit, so the oldest image is sent at low detail
+    ai = VisionKani(engine, desired_response_tokens=0, chat_history=history)
+    prompt = await ai.get_prompt()
+    assert len(prompt) == 5
+    assert [part.detail for m in prompt for part in m.parts if isinstance(part, ImagePart)] == ["low", None, None]
+    assert (await ai.get_prompt())[0] is prompt[0]
+
+    # without the fallback, the oldest message is dropped
+    ai = VisionKani(engine, desired_response_tokens=0, chat_history=history, low_detail_fallback=False)
+    assert await ai.get_prompt() == history[1:]
+
+
+async def test_unchanged_messages_not_kept_alive():
+    engine = OpenAIVisionEngine("sk-test")
+    ai = VisionKani(engine)
+    msg = ChatMessage.user(["a", ImagePart.from_image(Image.new("RGB", (64, 64)), detail="low")])
+    # neither step changes the message, which is remembered without keeping the message alive
+    assert await ai.compact_message(msg, LowDetail()) is msg
+    assert await ai.compact_message(msg, LowDetail()) is msg
+    assert (await engine.aprepare_messages([msg]))[0] is msg
+    assert (await engine.aprepare_messages([msg]))[0] is msg
+    assert msg in ai._compacted_messages and msg in engine._prepared_messages
+    del msg
+    gc.collect()
+    assert not ai._compacted_messages.keys() and not engine._prepared_messages.keys()
+
+
+async def test_image_compaction():
+    class CaptionEngine:
+        calls = 0
+
+        async def predict(self, messages, functions=None, **hyperparams):
+            self.calls += 1
+            return Completion(ChatMessage.assistant(" a black square "))
+
+    image = Image.new("RGB", (1024, 1024))
+    history = [
+        ChatMessage.user(["a", ImagePart.from_image(image)]),
+        ChatMessage.assistant("b"),
+        ChatMessage.user(["c", ImagePart.from_image(image)]),
+        ChatMessage.assistant("d"),
+        ChatMessage.user(["e", ImagePart.from_image(image)]),
+    ]
+    captioner = CaptionEngine()
+    steps = [Downscale(256), Caption(captioner)]
+
+    # downscaling the oldest image to 256px (255 tokens) is enough
+    engine = OpenAIVisionEngine("sk-test", max_context_size=2000)
+    ai = VisionKani(engine, desired_response_tokens=0, chat_history=history, image_compaction=steps)
+    prompt = await ai.get_prompt()
+    assert [part.size for m in prompt for part in m.parts if isinstance(part, ImagePart)] == [
+        (256, 256),
+        (1024, 1024),
+        (1024, 1024),
+    ]
+    assert captioner.calls == 0
+
+    # with a smaller budget, every image is downscaled and then the oldest is captioned
+    engine = OpenAIVisionEngine("sk-test", max_context_size=700)
+    ai = VisionKani(engine, desired_response_tokens=0, chat_history=history, image_compaction=steps)
+    prompt = await ai.get_prompt()
+    assert len(prompt) == 5
+    assert prompt[0].parts == ["a", "[image: a black square]"]
+    assert [part.size for m in prompt for part in m.parts if isinstance(part, ImagePart)] == [(256, 256), (256, 256)]
+    assert sum(ai.message_token_len(m) for m in prompt) <= 700
+    # captions are cached by image
+    assert (await ai.compact_message(prompt[2], steps[1])).parts == ["c", "[image: a black square]"]
+    assert captioner.calls == 1
+
+
+async def test_downscale_remote_images():
+    remote = RemoteURLImagePart(url="https://example.com/image.png", size_=(1024, 1024), mime_="image/png")
+    history = [ChatMessage.user(["a", remote]), ChatMessage.assistant("b"), ChatMessage.user(["c", remote])]
+    # remote images can't be downscaled, so the oldest message is dropped (773 + 8 + 773 tokens doesn't fit)
+    engine = OpenAIVisionEngine("sk-test", max_context_size=800)
+    ai = VisionKani(engine, desired_response_tokens=0, chat_history=history, image_compaction=[Downscale(256)])
+    assert await ai.get_prompt() == history[1:]
+    # or compaction moves on to the next step
+    ai.image_compaction = [Downscale(256), LowDetail()]
+    prompt = await ai.get_prompt()
+    assert len(prompt) == 3
+    assert [(m.parts[1].url, m.parts[1].detail) for m in prompt[::2]] == [(remote.url, "low")] * 2
@@ -1,4 +1,16 @@
-from kani.ext.vision.engines.openai.img_tokens import tokens_from_image_size
+import pytest
+
+from kani.ext.vision.engines.openai import img_tokens
+from kani.ext.vision.engines.openai.img_tokens import (
+    GPT_4V_COST_MODEL,
+    ImageCostModel,
+    cost_model_for,
+    fit_cost_model,
+    load_cost_models,
+    scaled_image_size,
+    tokens_from_image_size,
+    tokens_from_image_sizes,
+)
 
 # from the openai docs
 KNOWN_RES = [
@@ -11,3 +23,58 @@ KNOWN_RES = [
 def test_known_resolutions():
     for size, toks in KNOWN_RES:
         assert tokens_from_image_size(size) == toks
+
+
+def test_scaled_size_keeps_tokens():
+    for size in [(512, 512), (1024, 1024), (2048, 4096), (4096, 2048), (4032, 3024), (100, 5000), (800, 600)]:
+        scaled = scaled_image_size(size)
+        assert (scaled[0] >= scaled[1]) == (size[0] >= size[1])
+        assert max(scaled) <= 2048 and min(scaled) <= 768
+        assert tokens_from_image_size(scaled) == tokens_from_image_size(size)
+
+
+def test_batch_known_resolutions():
+    np = pytest.importorskip("numpy")
+    sizes = np.array([size for size, _ in KNOWN_RES])
+    assert tokens_from_image_sizes(sizes).tolist() == [toks for _, toks in KNOWN_RES]
+    assert tokens_from_image_sizes(sizes, low_detail=[True, False, True]).tolist() == [85, 765, 85]
+
+
+def test_batch_matches_scalar():
+    pytest.importorskip("numpy")
+    hypothesis = pytest.importorskip("hypothesis")
+    st = hypothesis.strategies
+    sides = st.integers(min_value=1, max_value=100_000)
+
+    @hypothesis.given(st.lists(st.tuples(st.tuples(sides, sides), st.booleans()), min_size=1, max_size=50))
+    def check(cases):
+        sizes, low_detail = zip(*cases)
+        expected = [tokens_from_image_size(size, low_detail=low) for size, low in cases]
+        assert tokens_from_image_sizes(sizes, low_detail=low_detail).tolist() == expected
+
+    check()
+
+
+def test_cost_models_by_model():
+    assert cost_model_for("gpt-4-vision-preview") == GPT_4V_COST_MODEL
+    assert cost_model_for("gpt-4o-2024-05-13") == GPT_4V_COST_MODEL
+    mini = cost_model_for("gpt-4o-mini")
+    assert tokens_from_image_size((1024, 1024), cost_model=mini) == 2833 + 4 * 5667
+    assert tokens_from_image_size((1024, 1024), low_detail=True, cost_model=mini) == 2833
+
+
+def test_load_cost_models(tmp_path, monkeypatch):
+    monkeypatch.setattr(img_tokens, "COST_MODELS_BY_PREFIX", img_tokens.COST_MODELS_BY_PREFIX.copy())
+    fp = tmp_path / "cost-models.json"
+    fp.write_text('{"my-model": {"base_tokens": 10, "tile_tokens": 20}}')
+    load_cost_models(fp)
+    assert cost_model_for("my-model-v2") == ImageCostModel(base_tokens=10, tile_tokens=20)
+    assert cost_model_for("gpt-4o") == GPT_4V_COST_MODEL
+
+
+def test_fit_cost_model():
+    true_model = ImageCostModel(base_tokens=75, tile_tokens=150, low_detail_tokens=75)
+    sizes = [(512, 512), (1024, 512), (1024, 1024), (2048, 4096), (800, 600), (100, 5000)]
+    observations = [(size, False, tokens_from_image_size(size, cost_model=true_model)) for size in sizes]
+    observations += [(size, True, 75) for size in sizes]
+    assert fit_cost_model(observations) == true_model
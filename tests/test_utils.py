@@ -0,0 +1,182 @@
+import os
+import weakref
+from io import BytesIO
+
+import aiohttp
+import pytest
+from PIL import Image
+
+from kani.ext.vision import ImagePart, utils
+from kani.ext.vision.cli import parts_from_cli_query
+from kani.ext.vision.engines.openai import OpenAIVisionEngine
+from kani.ext.vision.exceptions import ImageFormatException, ImageMetadataException
+from tests.conftest import PNG_DATA, WEBP_DATA
+
+
+async def test_download_image(image_server):
+    io = BytesIO()
+    await utils.download_image(f"{image_server.base}/image.png", io)
+    assert io.getvalue() == PNG_DATA
+
+
+async def test_metadata_from_url(image_server):
+    meta = await utils.image_metadata_from_url(f"{image_server.base}/image.png")
+    assert meta == utils.ImageMetadata(size=(320, 240), mime="image/png")
+
+
+async def test_metadata_from_url_no_range(image_server):
+    meta = await utils.image_metadata_from_url(f"{image_server.base}/norange.png", head=True)
+    assert meta == utils.ImageMetadata(size=(320, 240), mime="image/png")
+
+
+async def test_metadata_from_url_webp(image_server):
+    # Pillow can't parse a WEBP from a truncated file, so the size is read from the RIFF header in the first range
+    assert len(WEBP_DATA) > 64 * 1024
+    meta = await utils.image_metadata_from_url(f"{image_server.base}/image.webp", max_bytes=64 * 1024)
+    assert meta == utils.ImageMetadata(size=(1024, 768), mime="image/webp")
+    assert len(image_server.requested_ranges) == 1
+
+
+@pytest.mark.parametrize("lossless", [False, True])
+@pytest.mark.parametrize("extended", [False, True])
+def test_webp_size(lossless, extended):
+    io = BytesIO()
+    # an ICC profile needs the extended (VP8X) format
+    kwargs = {"icc_profile": bytes(64)} if extended else {}
+    Image.new("RGB", (1023, 517)).save(io, format="WEBP", lossless=lossless, **kwargs)
+    data = io.getvalue()
+    assert (data[12:16] == b"VP8X") == extended
+    assert utils.webp_size(data[:30]) == (1023, 517)
+    assert utils.webp_size(PNG_DATA[:30]) is None
+
+
+async def test_metadata_from_url_byte_cap(image_server):
+    with pytest.raises(ImageMetadataException):
+        await utils.image_metadata_from_url(f"{image_server.base}/invalid.png", max_bytes=64 * 1024)
+    assert image_server.requested_ranges[-1].stop <= 64 * 1024
+
+
+async def test_not_an_image(image_server):
+    with pytest.raises(ImageFormatException):
+        await utils.image_metadata_from_url(f"{image_server.base}/text.txt")
+
+
+async def test_shared_session_reuses_connections(image_server):
+    url = f"{image_server.base}/image.png"
+    await utils.image_metadata_from_url(url)
+    await utils.download_image(url, BytesIO())
+    await utils.download_image(url, BytesIO())
+    assert len(image_server.connections) == 1
+
+
+async def test_shared_session_users(image_server, offline_tokenizer, monkeypatch):
+    monkeypatch.setattr(utils, "_http_users", weakref.WeakSet())
+    first, second = OpenAIVisionEngine("sk-test"), OpenAIVisionEngine("sk-test")
+    session = utils.get_http_session()
+    # closing one engine doesn't close the pool that the other is still using
+    await first.close()
+    await first.close()
+    assert not session.closed
+    await utils.download_image(f"{image_server.base}/image.png", BytesIO())
+    await second.close()
+    assert session.closed
+
+
+async def test_from_urls(image_server):
+    urls = [f"{image_server.base}/image.png", f"{image_server.base}/text.txt", f"{image_server.base}/norange.png"]
+    with pytest.raises(ImageFormatException):
+        await ImagePart.from_urls(urls)
+
+    parts = await ImagePart.from_urls(urls, on_error="return", concurrency=2)
+    assert [type(p).__name__ for p in parts] == ["RemoteURLImagePart", "ImageFormatException", "RemoteURLImagePart"]
+    assert parts[0].url == urls[0]
+
+    parts = await ImagePart.from_urls(urls, remote=False, on_error="skip")
+    assert [p.bytes for p in parts] == [PNG_DATA, PNG_DATA]
+
+
+async def test_parts_from_cli_query(image_server):
+    parts = await parts_from_cli_query(f"compare !{image_server.base}/image.png and !{image_server.base}/norange.png")
+    assert parts[0] == "compare "
+    assert parts[2] == " and "
+    assert parts[1].bytes == parts[3].bytes == PNG_DATA
+
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    cache = utils.DiskImageCache(tmp_path / "cache", max_bytes=2 * len(PNG_DATA))
+    utils.set_disk_cache(cache)
+    yield cache
+    utils.set_disk_cache(None)
+
+
+async def test_disk_cache_revalidation(image_server, disk_cache):
+    url = f"{image_server.base}/image.png"
+    for _ in range(3):
+        io = BytesIO()
+        await utils.download_image(url, io)
+        assert io.getvalue() == PNG_DATA
+    # only the first request transfers the image; the rest are revalidated with the ETag
+    assert image_server.full_downloads == ["/image.png"]
+    assert disk_cache.get(url).etag == '"v1"'
+    with disk_cache.open_body(url) as mm:
+        assert mm[:] == PNG_DATA
+
+
+async def test_disk_cache_shared_directory(image_server, disk_cache):
+    url = f"{image_server.base}/image.png"
+    other = utils.DiskImageCache(disk_cache.directory)
+    await utils.download_image(url, BytesIO())
+    # another cache on the same directory revalidates the image the first one downloaded
+    utils.set_disk_cache(other)
+    io = BytesIO()
+    await utils.download_image(url, io)
+    assert io.getvalue() == PNG_DATA
+    assert image_server.full_downloads == ["/image.png"]
+
+    # if the image's data is removed by another process, it is downloaded again after the server says it's unchanged
+    (disk_cache.directory / f"{disk_cache.key(url)}.bin").unlink()
+    io = BytesIO()
+    await utils.download_image(url, io)
+    assert io.getvalue() == PNG_DATA
+    assert image_server.full_downloads == ["/image.png", "/image.png"]
+
+
+async def test_disk_cache_error_response(image_server, disk_cache):
+    url = f"{image_server.base}/missing.png"
+    # the server's placeholder image for errors is neither returned nor cached
+    with pytest.raises(aiohttp.ClientResponseError):
+        await utils.download_image(url, BytesIO())
+    with pytest.raises(aiohttp.ClientResponseError):
+        await utils.image_metadata_from_url(url)
+    assert disk_cache.get(url) is None
+    assert disk_cache.get_metadata(url) is None
+
+
+async def test_disk_cache_fresh_metadata(image_server, disk_cache):
+    disk_cache.default_ttl = 60
+    url = f"{image_server.base}/image.png"
+    await utils.download_image(url, BytesIO())
+    n_requests = len(image_server.requested_ranges)
+    # the metadata is read from the cached image without any network requests
+    meta = await utils.image_metadata_from_url(url)
+    assert meta == utils.ImageMetadata(size=(320, 240), mime="image/png")
+    assert len(image_server.requested_ranges) == n_requests
+
+
+def test_disk_cache_eviction(disk_cache):
+    for idx in range(3):
+        url = f"http://example.com/{idx}.png"
+        with disk_cache.body_writer(url, "image/png", {}) as f:
+            f.write(PNG_DATA)
+        os.utime(disk_cache.directory / f"{disk_cache.key(url)}.json", (idx, idx))
+    assert disk_cache.body_path("http://example.com/0.png") is None
+    assert disk_cache.body_path("http://example.com/2.png") is not None
+
+
+async def test_from_url_spooled(image_server):
+    part = await ImagePart.from_url(f"{image_server.base}/image.png", remote=False, spool_max_size=16)
+    assert part.file._rolled  # larger than the max size, so it was moved to disk
+    assert part.size == (320, 240)
+    assert part.bytes == PNG_DATA
+    assert part.b64 == ImagePart.from_bytes(PNG_DATA).b64